@@ -1,76 +1,142 @@
 # author: Muhammet Bastan, mubastan@gmail.com
 # date: August 2012
 
+# Qt adapter of the annotation model (AnnotationCore): object masks and regions
+# as QImages, and their loading and saving through the mask stores (MaskStore)
+
 import os
-import glob
-import numpy
-import scipy
 from PyQt4.QtGui import *
+from MemoryManager import memoryManager
+from MaskImage import *
+from MaskStore import readMaskFile, writeMaskFile, maskStore, maskExists, saveMasksParallel
+from AnnotationCore import *
+import AnnotationCore
+import ColumnarAnnotation as columnar
 
-# whole image annotation labels
-LPOS, LNEG, LSKIP = 1, -1, 0
-
-# difficulty level: 
-# skip: no label (default)
-# simple L1: one object on clean background
-# simple L2: multiple objects on clean background
-# medium L3: single/multiple objects, but not cluttered
-# difficult L4: cluttered
-# very difficult L5: very hard or impossible to identify the contents
-L0, L1, L2, L3, L4, L5 = 0, 1, 2, 3, 4, 5
-
-# view type:
-# skip V0: no label
-# good view V1: a typical, easy to recognize view @ zero angle
-# moderate V2: at some angle, but clearly visible
-# side view V3: side, hard to recognize view
-V0, V1, V2, V3 = 0, 1, 2, 3
-
-# set
-# S0: skip this image, do not use it
-# STR: in the training set
-# STS: in the test set
-S0, STR, STS = 0, 1, -1
+# object masks are kept cropped to the MBR of the object; with MASK_RLE the
+# crops are also run-length encoded, and decoded on each access
+MASK_RLE = False
 
-# One object selected by the user
-class XObject:
-    def __init__(self, mask=None, region=None, x1=0, y1=0, id = 0, w = 0, h = 0, view = V0, label = LPOS, mid = 0 ):
-        self.mask = mask
-        self.region = region
-        self.view = view        # default view label, no label
-        self.label = label      # default object label: positive
-        self.x1, self.y1, self.w, self.h = x1, y1, w, h
-        if region:
-            self.w, self.h = region.width(), region.height()
-        self.id = id            # ID of the object in the image (to differentiate multiple objects in the same image)
-        self.mid = mid            # object model ID (global ID of the object class across all images)
-        
-        self.saveMask = False
-        print x1, y1, w, h, 'mid:', mid
+# One object selected by the user, with its mask and region images
+class XObject(AnnotationCore.XObject):
+    __slots__ = ()
+    
+    # the cropped mask, reloaded from the annotation directory if it has been evicted
+    def getCroppedMask(self):
+        if not self.hasMask():
+            if self.maskSource is not None: self.loadMaskFrom(*self.maskSource)
+            elif self.maskFile: self.loadObjectMask(self.maskFile)
+        if not self.hasMask(): return None
+        memoryManager.touch(self, 'mask')
+        if self.cmaskImage is not None: return self.cmaskImage
+        values, lengths = self.maskRLE
+        return numpyToMask(decodeRLE(values, lengths, self.w, self.h))
+    def setCroppedMask(self, cmask):
+        self.cmaskImage, self.maskRLE = None, None
+        if cmask is None:
+            memoryManager.release(self, 'mask')
+        elif MASK_RLE:
+            self.maskRLE = encodeRLE(qimageToNumpy(cmask))
+            memoryManager.track(self, 'mask', self.maskRLE[0].nbytes + self.maskRLE[1].nbytes)
+        else:
+            self.cmaskImage = cmask
+            memoryManager.track(self, 'mask', cmask)
+    cmask = property(getCroppedMask, setCroppedMask)
+    # the full-frame mask, created on demand; a full-frame mask can be set,
+    # it is cropped to the object MBR (computed if not known yet)
+    def getMask(self):
+        cmask = self.cmask
+        if cmask is None: return None
+        fw, fh = self.frameSize or (self.x1 + self.w, self.y1 + self.h)
+        return expandMask(cmask, self.x1, self.y1, fw, fh)
+    def setMask(self, mask):
+        if mask is None: self.cmask = None; return
+        mask = toMask8(mask)
+        if self.w > 0 and self.h > 0 and mask.width() == self.w and mask.height() == self.h:
+            self.cmask = mask
+            return
+        self.frameSize = (mask.width(), mask.height())
+        if self.w <= 0 or self.h <= 0:
+            self.x1, self.y1, self.w, self.h = getMBR_numpy(mask)
+            if self.x1 < 0: self.x1, self.y1, self.w, self.h = 0, 0, 0, 0; self.cmask = None; return
+        self.cmask = mask.copy(self.x1, self.y1, self.w, self.h)
+    mask = property(getMask, setMask)
+    def getRegion(self):
+        if self.regionImage is None and self.brushColor is not None and self.cmask is not None:
+            self.region = self.getObjectRegion(self.brushColor)
+        if self.regionImage is not None: memoryManager.touch(self, 'region')
+        return self.regionImage
+    def setRegion(self, region):
+        self.regionImage = region
+        memoryManager.track(self, 'region', region)
+    region = property(getRegion, setRegion)
+    
+    # memory manager interface: only images that can be reloaded are dropped
+    def canEvict(self, kind):
+        reloadable = self.maskSource is not None or self.maskFile is not None
+        if kind == 'mask': return self.hasMask() and reloadable
+        if kind == 'region': return self.regionImage is not None and self.brushColor is not None and (self.hasMask() or reloadable)
+        return False
+    def evict(self, kind):
+        if kind == 'mask': self.setCroppedMask(None)
+        elif kind == 'region': self.setRegion(None)
         
     def deleteMask(self):
-        if not self.mask: return
-        m = self.mask
-        self.mask = None
-        del m
+        if not self.hasMask(): return
+        self.cmask = None
+    # set a mask as read from a mask store: full-frame (offset None) or cropped at offset
+    def setLoadedMask(self, mask, offset, frameSize):
+        if offset is None: self.mask = mask; return
+        x, y = offset
+        if self.w <= 0 or self.h <= 0:
+            self.x1, self.y1, self.w, self.h = x, y, mask.width(), mask.height()
+        if frameSize is not None: self.frameSize = frameSize
+        if (x, y, mask.width(), mask.height()) == (self.x1, self.y1, self.w, self.h):
+            self.cmask = mask
+        else:
+            # the MBR in the list differs from the stored crop
+            fw, fh = self.frameSize or (max(x + mask.width(), self.x1 + self.w), max(y + mask.height(), self.y1 + self.h))
+            self.mask = expandMask(mask, x, y, fw, fh)
+    # load the mask of object i of the image from a mask store (see MaskStore)
+    def loadMaskFrom(self, store, imgName, i, forceLoad=False):
+        if self.hasMask() and not forceLoad: return
+        mask, offset, frameSize = store.read(imgName, i)
+        if mask is None:
+            self.mask = None
+            print 'Error! Could not read mask', i, 'of', imgName
+            return
+        self.setLoadedMask(mask, offset, frameSize)
+        self.maskSource = (store, imgName, i)
+    def loadObjectImageFrom(self, store, imgName, i, brushColor, forceLoad=False):
+        if self.regionImage and not forceLoad: return
+        if not self.hasMask(): self.loadMaskFrom(store, imgName, i)
+        if self.hasMask():
+            self.brushColor = QColor(brushColor)
+            self.region = self.getObjectRegion(brushColor)
+        else: self.region = None
+    # reads both cropped and legacy full-frame mask files
     def loadObjectMask(self, fname, forceLoad=False):
-        if self.mask and not forceLoad: return
+        if self.hasMask() and not forceLoad: return
         if os.path.exists(fname):
-            self.mask = QImage(fname)
+            mask, offset, frameSize = readMaskFile(fname)
+            self.setLoadedMask(mask, offset, frameSize)
+            self.maskFile = fname
             self.saveMask = True
         else:
             self.mask = None
             print 'Error! Object mask file does not exist: ', fname         
     def loadObjectImage(self, fname, brushColor, forceLoad=False):
-        if self.region and not forceLoad: return
-        if not self.mask: self.loadObjectMask(fname)
-        if self.mask: self.region = self.getObjectRegion(brushColor)
+        if self.regionImage and not forceLoad: return
+        if not self.hasMask(): self.loadObjectMask(fname)
+        if self.hasMask():
+            self.brushColor = QColor(brushColor)
+            self.region = self.getObjectRegion(brushColor)
         else:
             self.region = None
             print 'Could not load object image from mask file ', fname        
     # the image region to be shown on the object list scene
     def getObjectRegion(self, brushColor):
-        cmask = self.mask.copy(self.x1, self.y1, self.w, self.h)
+        cmask = self.cmask
         rqimg = QImage(self.w, self.h, QImage.Format_ARGB32_Premultiplied)
         rqimg.fill(brushColor.rgba())
         painter = QPainter(rqimg) 
@@ -79,229 +145,69 @@ class XObject:
         painter.end()
         return rqimg    
     def save(self, fname):
-        if self.mask and self.saveMask:
-            if not self.mask.save(fname):
+        if self.saveMask and self.cmask is not None:
+            if not writeMaskFile(fname, self.cmask, self.x1, self.y1, self.frameSize):
                 print 'Error saving object mask ', self.id, ' to ', fname                
             print 'Object mask saved to ', fname
+            self.maskFile = fname
             self.saveMask = False
 
 # One image, containing the selected objects
-class XImage:
-    def __init__(self, fname=None, label = LSKIP, set = S0, level = L0):
-        self.label = label      # image label: positive/negative/skip
-        self.set = set           # training/test/skip set, default S0 (skip--tbd)
-        self.level = level         # difficulty level, default L0 (skip--tbd)
-        self.fname = fname
-        self.objects = []
+class XImage(AnnotationCore.XImage):
+    __slots__ = ()
+    objectClass = XObject
     
-    def numObjects(self):
-        return len(self.objects)
     def mask(self, index):
         if index < len(self.objects): return self.objects[index].mask
-    def addObject (self, mask, region, x1, y1, id):
-        obj = XObject(mask, region, x1, y1, id)
-        self.objects.append(obj)
-    def deleteObject(self, id):
-        for obj in self.objects:
-            if id == obj.id:
-                self.objects.remove(obj)
     def deleteObjectMasks(self):
         for obj in self.objects:
             obj.deleteMask()
-    def deleteAllObjects(self):
-        del self.objects[:]    
+    # masks are saved one file per object or as one label map per image, see MaskStore
     def saveObjectMasks(self, annotationDir):
-        for i in range(self.numObjects()):
-            imgName = os.path.splitext(self.fname)[0]            
-            fname = annotationDir + imgName + '.' + str(i) + '.png'
-            self.objects[i].save(fname)
-        # delete unused masks from the disk
-        i = self.numObjects()
-        while True:
-            imgName = os.path.splitext(self.fname)[0]            
-            fname = annotationDir + imgName + '.' + str(i) + '.png'
-            if not os.path.exists(fname): return
-            else: os.remove(fname)
+        maskStore(annotationDir).saveImageMasks(self)
             
     def loadObjectMasks(self, annotationDir, forceLoad=False):
+        store = maskStore(annotationDir)
         imgName = os.path.splitext(self.fname)[0]            
         for i in range(self.numObjects()):
-            fname = annotationDir + imgName + '.' + str(i) + '.png'
-            if os.path.exists(fname):
-                self.objects[i].loadObjectMask(fname, forceLoad)
+            if store.exists(imgName, i):
+                self.objects[i].loadMaskFrom(store, imgName, i, forceLoad)
     def loadObjectImages(self, annotationDir, brushColor, forceLoad=False):
+        store = maskStore(annotationDir)
         imgName = os.path.splitext(self.fname)[0]
         delList = []
         for i in range(self.numObjects()):
-            fname = annotationDir + imgName + '.' + str(i) + '.png'
-            if os.path.exists(fname):
-                self.objects[i].loadObjectImage(fname, brushColor, forceLoad)
-            else: delList.append(self.objects[i].id)                
+            if store.exists(imgName, i):
+                self.objects[i].loadObjectImageFrom(store, imgName, i, brushColor, forceLoad)
+            # dropped only if no store has its mask
+            elif not maskExists(annotationDir, imgName, i): delList.append(self.objects[i].id)
         for id in delList:
                 self.deleteObject(id)
-                
-    def toString(self):
-        lineStr = str(self.set) + ' ' + str(self.level) + ' ' + str(self.label) + ' ' + str(self.numObjects()) + ' ' + self.fname
-        for obj in self.objects:
-            lineStr += ' ' + str(obj.view) + ' ' + str(obj.label) + ' ' + str(obj.x1) + ' ' + str(obj.y1) + ' ' + str(obj.w) + ' ' + str(obj.h)
-        return lineStr
-    # with object model IDs (obj.mid)
-    def toString2(self):
-        lineStr = str(self.set) + ' ' + str(self.level) + ' ' + str(self.label) + ' ' + str(self.numObjects()) + ' ' + self.fname
-        for obj in self.objects:
-            lineStr += ' ' + str(obj.view) + ' ' + str(obj.label) + ' ' + str(obj.mid) + ' ' + str(obj.x1) + ' ' + str(obj.y1) + ' ' + str(obj.w) + ' ' + str(obj.h)
-        return lineStr
-    # with object model IDs (obj.mid) in flat format (no directories at the top of the file)
-    def toStringFlat(self, folder):
-        imgName = os.path.splitext(self.fname)[0]        
-        lineStr = folder + ' ' + imgName + ' ' + str(self.set) + ' ' + str(self.level) + ' ' + str(self.label) + ' ' + str(self.numObjects())
-        for obj in self.objects:
-            lineStr += ' ' + str(obj.mid) + ' ' + str(obj.view) + ' ' + str(obj.label) + ' ' + str(obj.x1) + ' ' + str(obj.y1) + ' ' + str(obj.w) + ' ' + str(obj.h)
-        return lineStr
-        
+
 # all annotations, list of images + objects + object MBRs        
-class Annotation:
-    def __init__(self, fname=None, ftype=1):
-        
-        self.images = []
-        self.index = 0      # index of the current image
-        self.className =  "none"
-        self.subclassName =  "none"
-        self.folder = "none"
-        self.dirPath = "./"
-        self.annotationDir = self.dirPath + "annotation/"
-        self.annfilename = fname        
-        if fname:
-            self.loadAnnotation(fname, ftype)
-    
-    def prev(self):
-        ind = self.index - 1
-        if ind < 0: ind = 0
-        return ind
-    def next(self):
-        ind = self.index + 1
-        if ind >= self.numImages(): ind = self.numImages() - 1
-        return ind
-    def goto(self, index):
-        if index >= 0 and index < self.numImages(): self.index = index
-        return self.index
-    def numImages(self):
-        return len(self.images)
-        
-    def image(self, index):
-        if index < self.numImages(): return self.images[index]
-        else: return None
-    def curImage(self):
-        return self.image(self.index)
-    def imageName(self, index):
-        if index < self.numImages(): return self.images[index].fname
-        else: return ""
-    def curImagePath(self):
-        return self.imagePath(self.index)
-    def imagePath(self, index):
-        if index < self.numImages(): return self.dirPath + self.images[index].fname
-        else: return ""
-    def numObjects(self, index):
-        if index < self.numImages(): return self.images[index].numObjects()
-        else: return 0
-    
-    def setClassName(self, className, subclassName):
-        self.className = str(className)
-        self.subclassName = str(subclassName)        
-        annDir = str(self.rootPath + 'annotation/')
-        if self.subclassName != "none": annDir += self.subclassName
-        elif self.className != "none": annDir += self.className
-        self.setAnnotationDir(annDir)
-        
-    def setAnnotationDir(self, dir):
-        if not os.path.isdir(dir):            
-            os.makedirs(dir)
-            print dir, ' did not exist! Created..'
-        self.annotationDir = dir + "/"
-        print 'Annotation directory changed to : ', self.annotationDir
+class Annotation(AnnotationCore.Annotation):
+    imageClass = XImage
     
-    def setLabel(self, label):
-        if label in (-1, 0, 1):
-            self.curImage().label = label
-        elif label in (-2, 10, 2):
-            for i in range(self.numImages()):
-                if label == -2: label = -1
-                elif label == 10: label = 0
-                elif label == 2: label = 1
-                self.image(i).label = label
-    
-    def setLevel(self, level):
-        if level in (0,1,2,3,4,5):
-            self.curImage().level = level
-    
-    def setLevelAll(self, level):
-        if level in (0,1,2,3,4,5):
-            for img in self.images:
-                img.level = level
-    
-    def setObjectViewLabel(self, id, viewLabel):
-        if viewLabel in (V0, V1, V2, V3) and self.curImage().numObjects() > 0:
-            for obj in self.curImage().objects:
-                if obj.id == id:
-                    obj.view = viewLabel
-    # set object model ID
-    def setObjectMID(self, id, moid):
-        if self.curImage().numObjects() > 0:
-            for obj in self.curImage().objects:
-                if obj.id == id:
-                    obj.mid = moid
-        
-    # add object to image @index location   
-    def addObjectTo(self, index, mask, region, x1, y1, id):
-        if index < self.numImages():
-            self.images[index].addObject (mask, region, x1, y1, id)
-    # add object to current image
-    def addObject (self, mask, region, x1, y1, id):
-        self.addObjectTo(self.index, mask, region, x1, y1, id)
-    
-    def deleteAllObjects(self):
-        self.deleteAllObjectsAt(self.index)
-    def deleteAllObjectsAt(self, index):
-        if index < self.numImages(): self.images[index].deleteAllObjects()
+    # write the masks of all dirty images on numThreads threads (default:
+    # MASK_FLUSH_THREADS); progress(images done, images, masks saved) is called
+    # from the workers. Images that failed stay dirty. Returns the MaskFlush
+    def flushDirtyMasks(self, numThreads=None, progress=None):
+        indices = [i for i in self.takeDirtyMasks() if i < self.numImages()]
+        images = [self.images[i] for i in indices]
+        try:
+            flush = saveMasksParallel(self.annotationDir, images, numThreads, progress)
+        except:
+            # nothing is known to be saved, the images stay dirty
+            for index in indices: self.markMasksDirty(index)
+            raise
+        for ximg in flush.failed: self.markMasksDirty(indices[images.index(ximg)])
+        return flush
     
     def deleteObjectMasks(self):
         self.deleteObjectMasksAt(self.index)
     def deleteObjectMasksAt(self, index):
         if index < self.numImages(): self.images[index].deleteObjectMasks()
-        
-    def deleteObjects(self, ids):
-        self.deleteObjectsAt(self.index, ids)
-    def deleteObjectsAt(self, index, ids):
-        if index > self.numImages() or len(ids) == 0: return
-        self.images[index].loadObjectMasks(self.annotationDir)
-        for id in ids:
-            self.images[index].deleteObject(id)
-        
-    def loadDir(self, dirPath, folderName, fileExt):
-        print 'Directory: ', dirPath
-        print 'Folder: ', folderName
-        print 'File extension: ', fileExt
-        self.rootPath = dirPath + '/'
-        self.annotationDir = dirPath + '/annotation/'
-        self.dirPath = str(dirPath) + '/color/'
-        self.folder = str(folderName)
-        self.fex = str(fileExt)
-        chain = str(dirPath) + '/color/' + str(fileExt)
-        #print chain
-        # get all the files with the given extension (full path)
-        imageFiles = glob.glob(chain)
-        imageList = []
-        # extract only the file names
-        for f in imageFiles:
-            imageList.append(os.path.basename(f))        
-        # soft the file names
-        imageList.sort(cmp=lambda x, y: cmp(x.lower(), y.lower()))        
-        # add to the list of images
-        for f in imageList:
-            self.images.append(XImage(f))        
-        print 'Number of images loaded: ', len(self.images)
-        #print 'loadDir:', self.annotationDir
-        
+    
     # save the selected object masks of the current image as png images
     # in the directory /path/to/data/annotation/
     def saveCurrentObjectMasks(self):
@@ -314,6 +220,7 @@ class Annotation:
             print self.annotationDir, ' does not exist! create it..'
             os.makedirs(self.annotationDir)        
         self.image(index).saveObjectMasks(self.annotationDir)
+        self.dirtyMasks.pop(index, None)
         print 'Saved object masks (selections)'
         
     # load the already saved object masks from the disk
@@ -322,125 +229,33 @@ class Annotation:
         self.images[index].loadObjectMasks(self.annotationDir, forceLoad)
     def loadObjectImages(self, index, brushColor, forceLoad=False):
         if self.numImages() == 0 or index >= self.numImages() : return
+        ids = [obj.id for obj in self.images[index].objects]
         self.images[index].loadObjectImages(self.annotationDir, brushColor, forceLoad)
-    
-    def getAnnotationListFile(self):
-        filename = self.folder
-        if len(self.className) > 0 and self.className != 'none': filename += '.' + self.className
-        if len(self.subclassName) > 0 and self.subclassName != 'none': filename += '.' + self.subclassName
-        filename += '.mid.txt'
-        return filename
-        
-    def saveAnnotationList(self, ftype=1):        
-        if self.annfilename is None:
-            self.annfilename = self.annotationDir + self.getAnnotationListFile()
-        self.saveAnnotationListAs(self.annfilename, ftype)
-    
-    # ftype=1: original format, ftype=2: with object IDs
-    def saveAnnotationListAs(self, fname, ftype=1):
-        if self.numImages() == 0: print 'Nothing to save yet!'; return    
-        ofs = open(fname, 'w')
-        if not ofs: print 'Could not open file to save!'; return    
-        ofs.write( self.className + ' ' + self.subclassName )
-        ofs.write('\n')
-        ofs.write( self.dirPath + ' ' + self.folder )
-        ofs.write('\n')
-        ofs.write( self.annotationDir + ' ' + self.subclassName )
-        ofs.write('\n')
-        ofs.write(str(self.numImages()))        
-        for image in self.images:
-            ofs.write('\n')
-            if ftype==1: ofs.write(image.toString())
-            elif ftype==2: ofs.write(image.toString2())
-        ofs.close()
-        self.annfilename = fname
-        print 'Annotation list saved to: ', fname
-        print 'File format (1/2):', ftype
-    
-    def saveAnnotationListFlat(self, fname, smode='a', labels=[LPOS, LNEG, LSKIP], levels=[L0, L1, L2, L3, L4, L5], sets=[S0, STR, STS]):
-        print 'Save annotation list to file, mode:', smode
-        if self.numImages() == 0: print 'Nothing to save yet!'; return    
-        ofs = open(fname, smode)
-        if not ofs: print 'Could not open file to save!'; return
-        count = 0
-        for image in self.images:
-            if ( image.label in labels) and (image.level in levels) and (image.set in sets):
-                ofs.write(image.toStringFlat(self.folder))
-                ofs.write('\n')
-                count += 1
-        ofs.close()
-        print 'Number of images:', count
-        print 'Annotation list saved to: ', fname
-    
-    # ftype=1: original format, ftype=2: with object IDs
-    def loadAnnotation(self, fname, ftype=1):
-        ifs = open(fname)
-        if not ifs:
-            print 'Could not load ', fname
-            return
-        self.annfilename = fname
-        
-        line = ifs.readline()
-        self.className, self.subclassName = line.split()
-        line = ifs.readline()
-        self.dirPath, self.folder = line.split()
-        self.rootDir = self.dirPath      # this is not correct
-        line = ifs.readline()
-        self.annotationDir = line.split()[0]
-        ifs.readline()
-        # read images and objects
-        for line in ifs:
-            if ftype==1: self.images.append(self.parseLine(line))
-            elif ftype==2: self.images.append(self.parseLine2(line))    # with model IDs
-            
-        print 'Loaded ', fname
-        print 'Number of images in the annotation list: ', self.numImages()
-        ifs.close()
-    
-    # initial version
-    def parseLine0(self, line):
-        tokens = line.split()
-        # XImage(self, fname=None, label = LSKIP, set = S0, level = L0)
-        ximg = XImage(tokens[2], int(tokens[0]))        
-        # objects
-        for i in range(int(tokens[1])):
-            # XObject(self, mask=None, region=None, x1=0, y1=0, id = 0, w = 0, h = 0, view = V0, label = LPOS )
-            xobj = XObject(None, None, int(tokens[4*i+3]), int(tokens[4*i+4]), i, int(tokens[4*i+5]), int(tokens[4*i+6]) )
-            ximg.objects.append(xobj)
-        return ximg
-    # updated version (22 October 2011)
-    def parseLine(self, line):
-        tokens = line.split()
-        # XImage(self, fname=None, label = LSKIP, set = S0, level = L0)
-        ximg = XImage(tokens[4], int(tokens[2]), int(tokens[0]), int(tokens[1]))        
-        # objects
-        NO = int(tokens[3])
-        for i in range(NO):
-            # XObject(self, mask=None, region=None, x1=0, y1=0, id = 0, w = 0, h = 0, view = V0, label = LPOS, mid = 0)
-            xobj = XObject(None, None, int(tokens[6*i+7]), int(tokens[6*i+8]), i, int(tokens[6*i+9]), int(tokens[6*i+10]), int(tokens[6*i+5]), int(tokens[6*i+6]) )            
-            ximg.objects.append(xobj)
-        return ximg
-    
-    # to read files with object model IDs
-    def parseLine2(self, line):        
-        tokens = line.split()
-        # XImage(self, fname=None, label = LSKIP, set = S0, level = L0)
-        ximg = XImage(tokens[4], int(tokens[2]), int(tokens[0]), int(tokens[1]))        
-        # objects
-        NO = int(tokens[3])
-        for i in range(NO):
-            # XObject(self, mask=None, region=None, x1=0, y1=0, id = 0, w = 0, h = 0, view = V0, label = LPOS, mid = 0 )
-            xobj = XObject(None, None, int(tokens[7*i+8]), int(tokens[7*i+9]), i, int(tokens[7*i+10]), int(tokens[7*i+11]), int(tokens[7*i+5]), int(tokens[7*i+6]), int(tokens[7*i+7]) )            
-            ximg.objects.append(xobj)
-        return ximg
-        
-        
-def getMBR_numpy(qimage):
-    x1, y1, x2, y2 = -1, -1, -1, -1
-    if qimage:
-        qimage.save("tmp.png")
-        nimg = scipy.misc.imread('tmp.png')
-        r,c = numpy.where(nimg > 0)
-        if len(r) > 0:      # check if there is any FG pixel
-            x1, y1, x2, y2 = c.min(), r.min(), c.max(), r.max() 
-    return x1, y1, x2-x1+1, y2-y1+1
\ No newline at end of file
+        # objects without a mask are dropped
+        if len(ids) != self.images[index].numObjects():
+            kept = set(obj.id for obj in self.images[index].objects)
+            self.markMasksDirty(index)
+            dropped = 0
+            for position, id in enumerate(ids):
+                if id in kept: continue
+                # the position when the earlier ones are already deleted
+                self.notifyEdit('delete', index, id, position - dropped)
+                dropped += 1
+
+# the columnar store (ColumnarAnnotation) with Qt objects: its views have the
+# masks and regions of XObject and XImage
+class XObjectView(columnar.XObjectView, XObject):
+    __slots__ = ()
+
+class XImageView(columnar.XImageView, XImage):
+    __slots__ = ()
+    objectClass = XObjectView
+
+    def adoptObject(self, xobj):
+        obj = columnar.XImageView.adoptObject(self, xobj)
+        if obj.hasMask(): memoryManager.track(obj, 'mask', obj.cmaskImage if obj.cmaskImage is not None else obj.maskRLE[0].nbytes + obj.maskRLE[1].nbytes)
+        if obj.regionImage is not None: memoryManager.track(obj, 'region', obj.regionImage)
+        return obj
+
+class ColumnarAnnotation(columnar.ColumnarAnnotationBase, Annotation):
+    imageClass = XImageView
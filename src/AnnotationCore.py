@@ -0,0 +1,695 @@
+# Annotation data model, list parsing and serialization, without Qt: headless
+# tools (conversion, statistics, export) use this module directly. Object masks
+# and regions are images, they are handled by the Qt adapter, Annotation23,
+# whose XObject, XImage and Annotation extend the classes here.
+
+import os
+import glob
+from Startup import lazyImport
+numpy = lazyImport('numpy')
+from ListParser import *
+from BinaryList import FT_BINARY, BinaryList, isBinaryList, writeBinaryList
+from AnnotationIndex import AnnotationIndex
+
+# whole image annotation labels
+LPOS, LNEG, LSKIP = 1, -1, 0
+
+# difficulty level: 
+# skip: no label (default)
+# simple L1: one object on clean background
+# simple L2: multiple objects on clean background
+# medium L3: single/multiple objects, but not cluttered
+# difficult L4: cluttered
+# very difficult L5: very hard or impossible to identify the contents
+L0, L1, L2, L3, L4, L5 = 0, 1, 2, 3, 4, 5
+
+# view type:
+# skip V0: no label
+# good view V1: a typical, easy to recognize view @ zero angle
+# moderate V2: at some angle, but clearly visible
+# side view V3: side, hard to recognize view
+V0, V1, V2, V3 = 0, 1, 2, 3
+
+# set
+# S0: skip this image, do not use it
+# STR: in the training set
+# STS: in the test set
+S0, STR, STS = 0, 1, -1
+
+# mask and region state of an object, allocated when it is first set:
+# objects read from a list file without masks carry only their fields
+class MaskState(object):
+    __slots__ = ('cmaskImage', 'maskRLE', 'regionImage', 'frameSize', 'maskSource', 'maskFile', 'brushColor', 'saveMask')
+    def __init__(self):
+        # mask cropped to (x1, y1, w, h), as an 8-bit image or run-length encoded (values, lengths);
+        # the images are accounted for by the memory manager (see the mask and region
+        # properties of Annotation23.XObject)
+        self.cmaskImage, self.maskRLE, self.regionImage = None, None, None
+        self.frameSize = None       # (width, height) of the image, for the full-frame mask
+        self.maskSource = None      # (mask store, image name, object index) the mask was loaded from/saved to
+        self.maskFile = None        # or the file, to reload the mask after eviction
+        self.brushColor = None      # color of the region image, to recreate it after eviction
+        self.saveMask = False
+
+# an attribute of the object kept in its MaskState; setting the default
+# value does not allocate the state
+def maskStateField(name, default=None):
+    def get(self):
+        if self.maskState is None: return default
+        return getattr(self.maskState, name)
+    def set(self, value):
+        if self.maskState is None:
+            if value is None or value is default: return
+            self.maskState = MaskState()
+        setattr(self.maskState, name, value)
+    return property(get, set)
+
+# One object selected by the user; the mask and region arguments need the
+# mask and region properties of Annotation23.XObject
+class XObject(object):
+    __slots__ = ('view', 'label', 'x1', 'y1', 'w', 'h', 'id', 'mid', 'maskState', '__weakref__')
+    def __init__(self, mask=None, region=None, x1=0, y1=0, id = 0, w = 0, h = 0, view = V0, label = LPOS, mid = 0, frameSize = None ):
+        self.view = view        # default view label, no label
+        self.label = label      # default object label: positive
+        self.x1, self.y1, self.w, self.h = x1, y1, w, h
+        if region:
+            self.w, self.h = region.width(), region.height()
+        self.id = id            # ID of the object in the image (to differentiate multiple objects in the same image)
+        self.mid = mid            # object model ID (global ID of the object class across all images)
+        
+        self.maskState = None
+        self.frameSize = frameSize
+        if mask is not None: self.mask = mask
+        if region is not None: self.region = region
+    
+    cmaskImage = maskStateField('cmaskImage')
+    maskRLE = maskStateField('maskRLE')
+    regionImage = maskStateField('regionImage')
+    frameSize = maskStateField('frameSize')
+    maskSource = maskStateField('maskSource')
+    maskFile = maskStateField('maskFile')
+    brushColor = maskStateField('brushColor')
+    saveMask = maskStateField('saveMask', False)
+    
+    def hasMask(self):
+        return self.cmaskImage is not None or self.maskRLE is not None
+
+# One image, containing the selected objects
+class XImage(object):
+    __slots__ = ('label', 'set', 'level', 'fname', 'objects', 'folder')
+    objectClass = XObject
+    def __init__(self, fname=None, label = LSKIP, set = S0, level = L0):
+        self.label = label      # image label: positive/negative/skip
+        self.set = set           # training/test/skip set, default S0 (skip--tbd)
+        self.level = level         # difficulty level, default L0 (skip--tbd)
+        self.fname = fname
+        self.objects = []
+    
+    def numObjects(self):
+        return len(self.objects)
+    def addObject (self, mask, region, x1, y1, id, frameSize=None):
+        obj = self.objectClass(mask, region, x1, y1, id, frameSize=frameSize)
+        obj.saveMask = mask is not None     # a new mask, to be written
+        self.objects.append(obj)
+    def deleteObject(self, id):
+        for obj in self.objects:
+            if id == obj.id:
+                self.objects.remove(obj)
+    def deleteObjectAt(self, position):
+        del self.objects[position]
+    def deleteAllObjects(self):
+        del self.objects[:]    
+                
+    def toString(self):
+        lineStr = str(self.set) + ' ' + str(self.level) + ' ' + str(self.label) + ' ' + str(self.numObjects()) + ' ' + self.fname
+        for obj in self.objects:
+            lineStr += ' ' + str(obj.view) + ' ' + str(obj.label) + ' ' + str(obj.x1) + ' ' + str(obj.y1) + ' ' + str(obj.w) + ' ' + str(obj.h)
+        return lineStr
+    # with object model IDs (obj.mid)
+    def toString2(self):
+        lineStr = str(self.set) + ' ' + str(self.level) + ' ' + str(self.label) + ' ' + str(self.numObjects()) + ' ' + self.fname
+        for obj in self.objects:
+            lineStr += ' ' + str(obj.view) + ' ' + str(obj.label) + ' ' + str(obj.mid) + ' ' + str(obj.x1) + ' ' + str(obj.y1) + ' ' + str(obj.w) + ' ' + str(obj.h)
+        return lineStr
+    # with object model IDs (obj.mid) in flat format (no directories at the top of the file)
+    def toStringFlat(self, folder):
+        imgName = os.path.splitext(self.fname)[0]        
+        lineStr = folder + ' ' + imgName + ' ' + str(self.set) + ' ' + str(self.level) + ' ' + str(self.label) + ' ' + str(self.numObjects())
+        for obj in self.objects:
+            lineStr += ' ' + str(obj.mid) + ' ' + str(obj.view) + ' ' + str(obj.label) + ' ' + str(obj.x1) + ' ' + str(obj.y1) + ' ' + str(obj.w) + ' ' + str(obj.h)
+        return lineStr
+        
+# all annotations, list of images + objects + object MBRs        
+class Annotation:
+    imageClass = XImage
+    def __init__(self, fname=None, ftype=1):
+        
+        self.images = []
+        self.index = 0      # index of the current image
+        self.className =  "none"
+        self.subclassName =  "none"
+        self.folder = "none"
+        self.dirPath = "./"
+        self.annotationDir = self.dirPath + "annotation/"
+        self.annfilename = fname        
+        self.editListeners = []
+        # masks to write, dataset-wide: image index -> ids of the objects with new
+        # masks (an empty set: objects were deleted, the masks are renumbered)
+        self.dirtyMasks = {}
+        self.queryIndex = None      # AnnotationIndex, built by the first query
+        if fname:
+            self.loadAnnotation(fname, ftype)
+    
+    # edit listeners are called as listener(operation, arguments) after each edit
+    # of the images and objects (see Journal for the operations)
+    def addEditListener(self, listener):
+        self.editListeners.append(listener)
+    def removeEditListener(self, listener):
+        if listener in self.editListeners: self.editListeners.remove(listener)
+    def notifyEdit(self, op, *args):
+        # the index first: listeners may query
+        if self.queryIndex is not None: self.queryIndex.onAnnotationEdit(op, args)
+        for listener in self.editListeners: listener(op, args)
+
+    # array of the indices of the images with the given labels, levels and sets
+    # (a value or a list, None: any) that have an object with the given model
+    # IDs and views, if given; e.g. ann.query(mids=17), ann.query(levels=[L1, L2])
+    def query(self, labels=None, levels=None, sets=None, mids=None, views=None):
+        return self.getQueryIndex().query(sets, levels, labels, mids, views)
+    # the objects with the given model IDs and views in the images with the given
+    # labels, levels and sets: arrays of image indices and object positions, the
+    # objects are ann.image(images[i]).objects[positions[i]]
+    def queryObjects(self, labels=None, levels=None, sets=None, mids=None, views=None):
+        return self.getQueryIndex().queryObjects(sets, levels, labels, mids, views)
+    # the index is rebuilt when images were loaded or many images were edited
+    def getQueryIndex(self):
+        if self.queryIndex is None or not self.queryIndex.current():
+            self.queryIndex = AnnotationIndex(self)
+        return self.queryIndex
+
+    # the masks of image index need writing (of object id, if given)
+    def markMasksDirty(self, index, id=None):
+        ids = self.dirtyMasks.setdefault(index, set())
+        if id is not None: ids.add(id)
+    def numDirtyMasks(self):
+        return sum(len(ids) for ids in self.dirtyMasks.values())
+    def numDirtyImages(self):
+        return len(self.dirtyMasks)
+    # the dirty images (indices, in order) and a clean state
+    def takeDirtyMasks(self):
+        indices, self.dirtyMasks = sorted(self.dirtyMasks), {}
+        return indices
+    
+    def prev(self):
+        ind = self.index - 1
+        if ind < 0: ind = 0
+        return ind
+    def next(self):
+        ind = self.index + 1
+        if ind >= self.numImages(): ind = self.numImages() - 1
+        return ind
+    def goto(self, index):
+        if index >= 0 and index < self.numImages(): self.index = index
+        return self.index
+    def numImages(self):
+        return len(self.images)
+        
+    def image(self, index):
+        if index < self.numImages(): return self.images[index]
+        else: return None
+    def curImage(self):
+        return self.image(self.index)
+    def imageName(self, index):
+        if index < self.numImages(): return self.images[index].fname
+        else: return ""
+    def curImagePath(self):
+        return self.imagePath(self.index)
+    def imagePath(self, index):
+        if index < self.numImages(): return self.dirPath + self.images[index].fname
+        else: return ""
+    def numObjects(self, index):
+        if index < self.numImages(): return self.images[index].numObjects()
+        else: return 0
+    
+    def setClassName(self, className, subclassName):
+        self.className = str(className)
+        self.subclassName = str(subclassName)        
+        annDir = str(self.rootPath + 'annotation/')
+        if self.subclassName != "none": annDir += self.subclassName
+        elif self.className != "none": annDir += self.className
+        self.setAnnotationDir(annDir)
+        
+    def setAnnotationDir(self, dir):
+        if not os.path.isdir(dir):            
+            os.makedirs(dir)
+            print dir, ' did not exist! Created..'
+        self.annotationDir = dir + "/"
+        print 'Annotation directory changed to : ', self.annotationDir
+    
+    def setLabel(self, label):
+        if label in (-1, 0, 1):
+            self.curImage().label = label
+            self.notifyEdit('label', self.index, label)
+        elif label in (-2, 10, 2):
+            if label == -2: label = -1
+            elif label == 10: label = 0
+            elif label == 2: label = 1
+            for i in range(self.numImages()):
+                self.image(i).label = label
+            self.notifyEdit('labelall', label)
+    
+    def setLevel(self, level):
+        if level in (0,1,2,3,4,5):
+            self.curImage().level = level
+            self.notifyEdit('level', self.index, level)
+    
+    def setLevelAll(self, level):
+        if level in (0,1,2,3,4,5):
+            for img in self.images:
+                img.level = level
+            self.notifyEdit('levelall', level)
+    
+    # position of an object in the object list of an image, -1 if not found;
+    # ids are renumbered when the list is reloaded, positions are not
+    def objectPosition(self, index, id):
+        for k, obj in enumerate(self.images[index].objects):
+            if obj.id == id: return k
+        return -1
+    
+    def setObjectViewLabel(self, id, viewLabel):
+        if viewLabel in (V0, V1, V2, V3) and self.curImage().numObjects() > 0:
+            for obj in self.curImage().objects:
+                if obj.id == id:
+                    obj.view = viewLabel
+            self.notifyEdit('view', self.index, id, viewLabel, self.objectPosition(self.index, id))
+    # set object model ID
+    def setObjectMID(self, id, moid):
+        if self.curImage().numObjects() > 0:
+            for obj in self.curImage().objects:
+                if obj.id == id:
+                    obj.mid = moid
+            self.notifyEdit('mid', self.index, id, moid, self.objectPosition(self.index, id))
+        
+    # add object to image @index location   
+    # mask: full-frame or cropped to the region, frameSize: (width, height) of the image
+    def addObjectTo(self, index, mask, region, x1, y1, id, frameSize=None):
+        if index < self.numImages():
+            self.images[index].addObject (mask, region, x1, y1, id, frameSize)
+            obj = self.images[index].objects[-1]
+            if obj.saveMask: self.markMasksDirty(index, obj.id)
+            self.notifyEdit('add', index, obj.id, obj.view, obj.label, obj.mid, obj.x1, obj.y1, obj.w, obj.h)
+    # add object to current image
+    def addObject (self, mask, region, x1, y1, id, frameSize=None):
+        self.addObjectTo(self.index, mask, region, x1, y1, id, frameSize)
+    
+    def deleteAllObjects(self):
+        self.deleteAllObjectsAt(self.index)
+    def deleteAllObjectsAt(self, index):
+        if index < self.numImages():
+            self.images[index].deleteAllObjects()
+            self.markMasksDirty(index)
+            self.notifyEdit('deleteall', index)
+    
+    def deleteObjects(self, ids):
+        self.deleteObjectsAt(self.index, ids)
+    def deleteObjectsAt(self, index, ids):
+        if index > self.numImages() or len(ids) == 0: return
+        # the masks are renumbered when saved, the stored ones are needed
+        self.loadObjectMasks(index)
+        self.markMasksDirty(index)
+        for id in ids:
+            position = self.objectPosition(index, id)
+            self.images[index].deleteObject(id)
+            self.dirtyMasks[index].discard(id)
+            self.notifyEdit('delete', index, id, position)
+        
+    def loadDir(self, dirPath, folderName, fileExt):
+        print 'Directory: ', dirPath
+        print 'Folder: ', folderName
+        print 'File extension: ', fileExt
+        self.rootPath = dirPath + '/'
+        self.annotationDir = dirPath + '/annotation/'
+        self.dirPath = str(dirPath) + '/color/'
+        self.folder = str(folderName)
+        self.fex = str(fileExt)
+        chain = str(dirPath) + '/color/' + str(fileExt)
+        #print chain
+        # get all the files with the given extension (full path)
+        imageFiles = glob.glob(chain)
+        imageList = []
+        # extract only the file names
+        for f in imageFiles:
+            imageList.append(os.path.basename(f))        
+        # soft the file names
+        imageList.sort(cmp=lambda x, y: cmp(x.lower(), y.lower()))        
+        # add to the list of images
+        for f in imageList:
+            self.images.append(self.imageClass(f))        
+        print 'Number of images loaded: ', len(self.images)
+        #print 'loadDir:', self.annotationDir
+        
+    # masks are not loaded without Qt, see Annotation23
+    def loadObjectMasks(self, index, forceLoad=False):
+        pass
+    
+    def getAnnotationListFile(self):
+        filename = self.folder
+        if len(self.className) > 0 and self.className != 'none': filename += '.' + self.className
+        if len(self.subclassName) > 0 and self.subclassName != 'none': filename += '.' + self.subclassName
+        filename += '.mid.txt'
+        return filename
+        
+    def saveAnnotationList(self, ftype=1):        
+        if self.annfilename is None:
+            self.annfilename = self.annotationDir + self.getAnnotationListFile()
+        self.saveAnnotationListAs(self.annfilename, ftype)
+    
+    # ftype=1: original format, ftype=2: with object IDs, FT_BINARY: binary list
+    def saveAnnotationListAs(self, fname, ftype=1):
+        if self.numImages() == 0: print 'Nothing to save yet!'; return    
+        if ftype == FT_BINARY:
+            self.saveAnnotationListBinary(fname)
+            return
+        ofs = open(fname, 'w')
+        if not ofs: print 'Could not open file to save!'; return    
+        ofs.write( self.className + ' ' + self.subclassName )
+        ofs.write('\n')
+        ofs.write( self.dirPath + ' ' + self.folder )
+        ofs.write('\n')
+        ofs.write( self.annotationDir + ' ' + self.subclassName )
+        ofs.write('\n')
+        ofs.write(str(self.numImages()))        
+        for image in self.images:
+            ofs.write('\n')
+            if ftype==1: ofs.write(image.toString())
+            elif ftype==2: ofs.write(image.toString2())
+        ofs.close()
+        self.annfilename = fname
+        print 'Annotation list saved to: ', fname
+        print 'File format (1/2):', ftype
+    
+    # the images and objects as arrays (ListParser.ParsedList), with the header
+    def toParsedList(self):
+        if hasattr(self.images, 'toParsedList'): parsed = self.images.toParsedList()
+        else: parsed = parsedListOf(self.images)
+        parsed.className, parsed.subclassName = self.className, self.subclassName
+        parsed.dirPath, parsed.folder, parsed.annotationDir = self.dirPath, self.folder, self.annotationDir
+        return parsed
+    
+    def saveAnnotationListBinary(self, fname):
+        writeBinaryList(fname, self.toParsedList())
+        self.annfilename = fname
+        print 'Annotation list saved to: ', fname
+        print 'File format: binary'
+    
+    def saveAnnotationListFlat(self, fname, smode='a', labels=[LPOS, LNEG, LSKIP], levels=[L0, L1, L2, L3, L4, L5], sets=[S0, STR, STS]):
+        print 'Save annotation list to file, mode:', smode
+        if self.numImages() == 0: print 'Nothing to save yet!'; return    
+        ofs = open(fname, smode)
+        if not ofs: print 'Could not open file to save!'; return
+        selected = self.query(labels, levels, sets)
+        for i in selected.tolist():
+            ofs.write(self.images[i].toStringFlat(self.folder))
+            ofs.write('\n')
+        ofs.close()
+        print 'Number of images:', len(selected)
+        print 'Annotation list saved to: ', fname
+    
+    # ftype=1: original format, ftype=2: with object IDs
+    def loadAnnotation(self, fname, ftype=1):
+        if not os.path.exists(fname):
+            print 'Could not load ', fname
+            return
+        self.annfilename = fname
+        if ftype == FT_AUTO and isBinaryList(fname): ftype = FT_BINARY
+        if ftype == FT_BINARY:
+            self.loadAnnotationBinary(fname)
+            return
+        if ftype == FT_AUTO:
+            self.loadAnnotationBulk(fname)
+            return
+        
+        reader = AnnotationReader(fname, ftype, self.imageClass)
+        self.className, self.subclassName = reader.className, reader.subclassName
+        self.dirPath, self.folder = reader.dirPath, reader.folder
+        self.rootDir = self.dirPath      # this is not correct
+        self.annotationDir = reader.annotationDir
+        # read images and objects
+        self.images.extend(reader)
+            
+        print 'Loaded ', fname
+        print 'Number of images in the annotation list: ', self.numImages()
+    
+    # binary list: the file is mapped, images are decoded when accessed
+    def loadAnnotationBinary(self, fname):
+        blist = BinaryList(fname)
+        self.annfilename = fname
+        self.className, self.subclassName = blist.className, blist.subclassName
+        self.dirPath, self.folder = blist.dirPath, blist.folder
+        self.rootDir = self.dirPath      # this is not correct
+        self.annotationDir = blist.annotationDir
+        if len(self.images) == 0: self.images = BinaryImages(blist, self.imageClass)
+        else: self.images.extend(BinaryImages(blist, self.imageClass))
+        print 'Loaded ', fname, '(binary)'
+        print 'Number of images in the annotation list: ', self.numImages()
+    
+    # load a list file of any format with the bulk parser (ListParser): the format
+    # is detected, the numbers of the whole file are converted at once
+    def loadAnnotationBulk(self, fname, ftype=None):
+        parsed = parseListFile(fname, ftype)
+        self.annfilename = fname
+        self.className, self.subclassName = parsed.className, parsed.subclassName
+        self.dirPath, self.folder = parsed.dirPath, parsed.folder
+        self.rootDir = self.dirPath      # this is not correct
+        self.annotationDir = parsed.annotationDir
+        self.images.extend(buildImages(parsed, self.imageClass))
+        print 'Loaded ', fname, '(format %d)' % parsed.ftype
+        print 'Number of images in the annotation list: ', self.numImages()
+    
+    # initial version
+    def parseLine0(self, line):
+        return parseLine0(line, self.imageClass)
+    # updated version (22 October 2011)
+    def parseLine(self, line):
+        return parseLine1(line, self.imageClass)
+    # to read files with object model IDs
+    def parseLine2(self, line):        
+        return parseLine2(line, self.imageClass)
+    # flat format (saveAnnotationListFlat)
+    def parseLineFlat(self, line):
+        return parseLineFlat(line, self.imageClass)
+
+# annotation list file types (see ListParser): 1: original format, 2: with object
+# model IDs (Annotation.saveAnnotationListAs), FT_FLAT: flat format
+# (Annotation.saveAnnotationListFlat), FT_AUTO: detect the format when loading
+FT_AUTO = -1
+
+# the line parsers create imageClass instances, with imageClass.objectClass objects
+# initial version
+def parseLine0(line, imageClass=XImage):
+    tokens = line.split()
+    XObject = imageClass.objectClass
+    # XImage(self, fname=None, label = LSKIP, set = S0, level = L0)
+    ximg = imageClass(tokens[2], int(tokens[0]))        
+    # objects
+    for i in range(int(tokens[1])):
+        # XObject(self, mask=None, region=None, x1=0, y1=0, id = 0, w = 0, h = 0, view = V0, label = LPOS )
+        xobj = XObject(None, None, int(tokens[4*i+3]), int(tokens[4*i+4]), i, int(tokens[4*i+5]), int(tokens[4*i+6]) )
+        ximg.objects.append(xobj)
+    return ximg
+# updated version (22 October 2011), ftype 1
+def parseLine1(line, imageClass=XImage):
+    tokens = line.split()
+    XObject = imageClass.objectClass
+    # XImage(self, fname=None, label = LSKIP, set = S0, level = L0)
+    ximg = imageClass(tokens[4], int(tokens[2]), int(tokens[0]), int(tokens[1]))        
+    # objects
+    NO = int(tokens[3])
+    for i in range(NO):
+        # XObject(self, mask=None, region=None, x1=0, y1=0, id = 0, w = 0, h = 0, view = V0, label = LPOS, mid = 0)
+        xobj = XObject(None, None, int(tokens[6*i+7]), int(tokens[6*i+8]), i, int(tokens[6*i+9]), int(tokens[6*i+10]), int(tokens[6*i+5]), int(tokens[6*i+6]) )            
+        ximg.objects.append(xobj)
+    return ximg
+# with object model IDs, ftype 2
+def parseLine2(line, imageClass=XImage):
+    tokens = line.split()
+    XObject = imageClass.objectClass
+    # XImage(self, fname=None, label = LSKIP, set = S0, level = L0)
+    ximg = imageClass(tokens[4], int(tokens[2]), int(tokens[0]), int(tokens[1]))        
+    # objects
+    NO = int(tokens[3])
+    for i in range(NO):
+        # XObject(self, mask=None, region=None, x1=0, y1=0, id = 0, w = 0, h = 0, view = V0, label = LPOS, mid = 0 )
+        xobj = XObject(None, None, int(tokens[7*i+8]), int(tokens[7*i+9]), i, int(tokens[7*i+10]), int(tokens[7*i+11]), int(tokens[7*i+5]), int(tokens[7*i+6]), int(tokens[7*i+7]) )            
+        ximg.objects.append(xobj)
+    return ximg
+# flat format, FT_FLAT: folder, image name without extension, then as ftype 2 but
+# with the model ID first; the folder is kept in ximg.folder
+def parseLineFlat(line, imageClass=XImage):
+    tokens = line.split()
+    XObject = imageClass.objectClass
+    ximg = imageClass(tokens[1], int(tokens[4]), int(tokens[2]), int(tokens[3]))
+    ximg.folder = tokens[0]
+    NO = int(tokens[5])
+    for i in range(NO):
+        xobj = XObject(None, None, int(tokens[7*i+9]), int(tokens[7*i+10]), i, int(tokens[7*i+11]), int(tokens[7*i+12]), int(tokens[7*i+7]), int(tokens[7*i+8]), int(tokens[7*i+6]) )
+        ximg.objects.append(xobj)
+    return ximg
+
+LINE_PARSERS = {FT_V0: parseLine0, FT_V1: parseLine1, FT_V2: parseLine2, FT_FLAT: parseLineFlat}
+
+# imageClass instances (XImage by default) of a parsed list (ListParser.ParsedList)
+def buildImages(parsed, imageClass=XImage):
+    XObject = imageClass.objectClass
+    objects = parsed.objects.tolist()
+    folders = parsed.folders
+    images = []
+    k = 0
+    for i, (set, level, label, count) in enumerate(parsed.images.tolist()):
+        ximg = imageClass(parsed.names[i], label, set, level)
+        if folders is not None: ximg.folder = folders[i]
+        for j in range(count):
+            mid, view, olabel, x1, y1, w, h = objects[k+j]
+            ximg.objects.append(XObject(None, None, x1, y1, j, w, h, view, olabel, mid))
+        k += count
+        images.append(ximg)
+    return images
+
+# the fields of a sequence of XImage as arrays (ListParser.ParsedList)
+def parsedListOf(images, ftype=FT_BINARY):
+    parsed = ParsedList(ftype)
+    heads, objects, folders = [], [], []
+    for ximg in images:
+        parsed.names.append(ximg.fname)
+        folders.append(getattr(ximg, 'folder', None))
+        heads.append((ximg.set, ximg.level, ximg.label, len(ximg.objects)))
+        for obj in ximg.objects:
+            objects.append((obj.mid, obj.view, obj.label, obj.x1, obj.y1, obj.w, obj.h))
+    # images of a flat list keep their folders
+    if any(folder is not None for folder in folders):
+        parsed.folders = [folder if folder is not None else 'none' for folder in folders]
+    parsed.images = numpy.array(heads, numpy.int32).reshape(-1, 4)
+    parsed.objects = numpy.array(objects, numpy.int32).reshape(-1, 7)
+    parsed.offsets = numpy.zeros(len(heads) + 1, numpy.int64)
+    numpy.cumsum(parsed.images[:, IC_COUNT], out=parsed.offsets[1:])
+    return parsed
+
+# the images of a binary list file (BinaryList) as Annotation.images: an image
+# is decoded into an XImage (imageClass) when it is first accessed, and kept, as it may be edited
+class BinaryImages:
+    def __init__(self, blist, imageClass=XImage):
+        self.blist = blist
+        self.imageClass = imageClass
+        self.decoded = {}
+        self.appended = []
+
+    def __len__(self):
+        return self.blist.numImages() + len(self.appended)
+    def __getitem__(self, index):
+        n = self.blist.numImages()
+        if index < 0: index += len(self)
+        if index < 0: raise IndexError(index)
+        if index >= n: return self.appended[index - n]
+        ximg = self.decoded.get(index)
+        if ximg is None:
+            set, level, label = self.blist.imageFields(index)
+            ximg = self.imageClass(self.blist.name(index), label, set, level)
+            if self.blist.folders is not None: ximg.folder = self.blist.folders[index]
+            for j, (mid, view, olabel, x1, y1, w, h) in enumerate(self.blist.imageObjects(index).tolist()):
+                ximg.objects.append(self.imageClass.objectClass(None, None, x1, y1, j, w, h, view, olabel, mid))
+            self.decoded[index] = ximg
+        return ximg
+    def __iter__(self):
+        for i in range(len(self)): yield self[i]
+    def append(self, ximg):
+        self.appended.append(ximg)
+    def extend(self, ximgs):
+        for ximg in ximgs: self.append(ximg)
+
+    # images not decoded yet are copied from the file
+    def toParsedList(self):
+        n = self.blist.numImages()
+        if not self.decoded and not self.appended: return self.blist.toParsedList()
+        parsed = ParsedList(FT_BINARY)
+        heads, objects = numpy.zeros((len(self), 4), numpy.int32), []
+        for i in range(n):
+            ximg = self.decoded.get(i)
+            if ximg is None:
+                parsed.names.append(self.blist.name(i))
+                heads[i, :3] = self.blist.imageFields(i)
+                rows = self.blist.imageObjects(i)
+            else:
+                parsed.names.append(ximg.fname)
+                heads[i, :3] = ximg.set, ximg.level, ximg.label
+                rows = parsedListOf([ximg]).objects
+            heads[i, IC_COUNT] = len(rows)
+            objects.append(rows)
+        if self.appended:
+            more = parsedListOf(self.appended)
+            parsed.names.extend(more.names)
+            heads[n:] = more.images
+            objects.append(more.objects)
+        if self.blist.folders is not None:
+            parsed.folders = [getattr(self[i], 'folder', 'none') if i in self.decoded or i >= n else self.blist.folders[i] for i in range(len(self))]
+        parsed.images = heads
+        parsed.objects = numpy.concatenate(objects).astype(numpy.int32) if objects else numpy.zeros((0, 7), numpy.int32)
+        parsed.offsets = numpy.zeros(len(heads) + 1, numpy.int64)
+        numpy.cumsum(heads[:, IC_COUNT], out=parsed.offsets[1:])
+        return parsed
+
+# streaming reader of annotation list files: the header is read when the reader
+# is created, the images are parsed one at a time while iterating, e.g.
+#   reader = AnnotationReader(fname, 2)
+#   for ximg in reader: ...
+# so that arbitrarily large lists can be processed in constant memory
+class AnnotationReader:
+    def __init__(self, fname, ftype=1, imageClass=XImage):
+        self.fname = fname
+        self.ftype = ftype
+        self.imageClass = imageClass
+        self.className, self.subclassName = "none", "none"
+        self.dirPath, self.folder = "./", "none"
+        self.annotationDir = self.dirPath + "annotation/"
+        self.numImages = -1         # unknown for the flat format
+        self.headerLines = 0
+        if ftype != FT_FLAT:
+            ifs = open(fname)
+            try:
+                (self.className, self.subclassName, self.dirPath, self.folder,
+                 self.annotationDir, self.numImages) = readListHeader(ifs)
+            finally:
+                ifs.close()
+            self.headerLines = HEADER_LINES
+    
+    def __iter__(self):
+        parse = LINE_PARSERS[self.ftype]
+        ifs = open(self.fname)
+        try:
+            for i in range(self.headerLines): ifs.readline()
+            for line in ifs:
+                if line.strip(): yield parse(line, self.imageClass)
+        finally:
+            ifs.close()
+
+# iterate over the images (XImage) of an annotation list file
+def iterAnnotation(fname, ftype=1, imageClass=XImage):
+    return iter(AnnotationReader(fname, ftype, imageClass))
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) < 2:
+        print 'usage: python AnnotationCore.py <list file> [<list file> ...]'
+        print '       prints the numbers of images and objects by label, level, set and view'
+        sys.exit(1)
+    for fname in sys.argv[1:]:
+        ann = Annotation(fname, FT_AUTO)
+        counts = {}
+        for ximg in ann.images:
+            for key in (('label', ximg.label), ('level', ximg.level), ('set', ximg.set)):
+                counts[key] = counts.get(key, 0) + 1
+            for obj in ximg.objects:
+                counts[('view', obj.view)] = counts.get(('view', obj.view), 0) + 1
+                counts[('objects', None)] = counts.get(('objects', None), 0) + 1
+        print fname + ':', ann.numImages(), 'images,', counts.pop(('objects', None), 0), 'objects'
+        for (field, value), count in sorted(counts.items()):
+            print '  %-5s %3d: %d' % (field, value, count)
@@ -0,0 +1,135 @@
+# Secondary indexes of an annotation, for Annotation.query and queryObjects.
+# The images have a bitmap (a boolean array over the images) per value of set,
+# level and label; a query ANDs the bitmaps of the requested fields, each the OR
+# of the bitmaps of the requested values. The objects have inverted indexes
+# from mid and from view: the object rows of the list sorted by the field, a
+# value is a slice found by binary search.
+#
+# The indexes are built from the arrays of the whole list (toParsedList) and
+# kept up to date by the edits of the annotation (Annotation.notifyEdit): image
+# fields are set in the bitmaps, an image whose objects are edited leaves the
+# object indexes and its objects are kept aside (delta) until the indexes are
+# rebuilt. Objects are identified by image index and position in the object
+# list of the image (ann.image(i).objects[k]); ids are renumbered by the GUI.
+
+from Startup import lazyImport
+from ListParser import IC_SET, IC_LEVEL, IC_LABEL, OC_MID, OC_VIEW
+numpy = lazyImport('numpy')
+
+# the object indexes are rebuilt when more images than this (or a 20th of
+# the images) have their objects in the delta
+MAX_DELTA_IMAGES = 1000
+
+FIELD_COLUMNS = {'sets': IC_SET, 'levels': IC_LEVEL, 'labels': IC_LABEL}
+
+# accepted values as a list (None: any value)
+def valueList(values):
+    if values is None: return None
+    if isinstance(values, (int, long)): return [values]
+    return list(values)
+
+class AnnotationIndex:
+    def __init__(self, ann):
+        self.ann = ann
+        self.images = ann.images            # the indexed image sequence
+        parsed = ann.toParsedList()
+        self.numImages = n = len(parsed.names)
+        self.fields = parsed.images[:, :3].copy()           # set, level, label
+        self.bitmaps = {}           # (column, value) -> bool array over the images
+        for column in (IC_SET, IC_LEVEL, IC_LABEL):
+            for value in numpy.unique(self.fields[:, column]).tolist():
+                self.bitmaps[(column, value)] = self.fields[:, column] == value
+        # object table: image, position in the image, mid, view
+        counts = numpy.diff(parsed.offsets)
+        self.objectImages = numpy.repeat(numpy.arange(n, dtype=numpy.int32), counts)
+        self.objectPositions = (numpy.arange(len(parsed.objects)) - numpy.repeat(parsed.offsets[:-1], counts)).astype(numpy.int32)
+        self.objectFields = {OC_MID: parsed.objects[:, OC_MID].copy(), OC_VIEW: parsed.objects[:, OC_VIEW].copy()}
+        # inverted indexes: rows sorted by the field, and the sorted field values
+        self.postings = {}
+        for column, values in self.objectFields.items():
+            order = numpy.argsort(values, kind='mergesort')
+            self.postings[column] = (order, values[order])
+        self.stale = numpy.zeros(n, bool)       # images whose objects are in the delta
+        self.delta = {}             # image index -> [(position, mid, view)]
+
+    # whether the index is of the current images of the annotation
+    def current(self):
+        if self.ann.images is not self.images or len(self.images) != self.numImages: return False
+        return len(self.delta) <= max(MAX_DELTA_IMAGES, self.numImages / 20)
+
+    # Annotation edit (see Annotation.notifyEdit)
+    def onAnnotationEdit(self, op, args):
+        if op == 'label': self.setField(IC_LABEL, args[0], args[1])
+        elif op == 'level': self.setField(IC_LEVEL, args[0], args[1])
+        elif op in ('labelall', 'levelall'):
+            column = IC_LABEL if op == 'labelall' else IC_LEVEL
+            for key in [key for key in self.bitmaps if key[0] == column]: del self.bitmaps[key]
+            self.fields[:, column] = args[0]
+            self.bitmaps[(column, args[0])] = numpy.ones(self.numImages, bool)
+        elif op in ('view', 'mid', 'add', 'delete', 'deleteall'): self.objectsChanged(args[0])
+    def setField(self, column, index, value):
+        if index >= self.numImages: return
+        self.bitmaps[(column, int(self.fields[index, column]))][index] = False
+        if (column, value) not in self.bitmaps: self.bitmaps[(column, value)] = numpy.zeros(self.numImages, bool)
+        self.bitmaps[(column, value)][index] = True
+        self.fields[index, column] = value
+    def objectsChanged(self, index):
+        if index >= self.numImages: return
+        self.stale[index] = True
+        self.delta[index] = [(k, obj.mid, obj.view) for k, obj in enumerate(self.ann.image(index).objects)]
+
+    # bool array over the images: the images with the given field values
+    def imageMask(self, sets=None, levels=None, labels=None):
+        mask = numpy.ones(self.numImages, bool)
+        for name, values in (('sets', sets), ('levels', levels), ('labels', labels)):
+            values = valueList(values)
+            if values is None: continue
+            column = FIELD_COLUMNS[name]
+            accepted = numpy.zeros(self.numImages, bool)
+            for value in values:
+                bitmap = self.bitmaps.get((column, value))
+                if bitmap is not None: accepted |= bitmap
+            mask &= accepted
+        return mask
+
+    # object rows of the indexes with the given mid and view values
+    def objectRows(self, mids=None, views=None):
+        rows = None
+        for column, values in ((OC_MID, mids), (OC_VIEW, views)):
+            if values is None: continue
+            if rows is not None:
+                rows = rows[numpy.in1d(self.objectFields[column][rows], values)]
+                continue
+            order, keys = self.postings[column]
+            slices = [order[numpy.searchsorted(keys, value):numpy.searchsorted(keys, value, 'right')] for value in values]
+            rows = numpy.concatenate(slices) if slices else numpy.zeros(0, numpy.int64)
+        if rows is None: rows = numpy.arange(len(self.objectImages))
+        return rows
+
+    # array of the indices of the images with the given field values, with an
+    # object with the given mid and view values if any are given
+    def query(self, sets=None, levels=None, labels=None, mids=None, views=None):
+        mask = self.imageMask(sets, levels, labels)
+        if mids is None and views is None: return numpy.nonzero(mask)[0]
+        images, positions = self.queryObjects(sets, levels, labels, mids, views, mask)
+        return numpy.unique(images)
+
+    # the objects with the given mid and view values in the images with the
+    # given field values: arrays of image indices and positions, in list order
+    def queryObjects(self, sets=None, levels=None, labels=None, mids=None, views=None, mask=None):
+        if mask is None: mask = self.imageMask(sets, levels, labels)
+        mids, views = valueList(mids), valueList(views)
+        rows = self.objectRows(mids, views)
+        images = self.objectImages[rows]
+        keep = mask[images] & ~self.stale[images]
+        images, positions = [images[keep]], [self.objectPositions[rows[keep]]]
+        found = [(index, k) for index, objects in self.delta.items() if mask[index]
+                 for k, mid, view in objects
+                 if (mids is None or mid in mids) and (views is None or view in views)]
+        if found:
+            found = numpy.array(found, numpy.int32)
+            images.append(found[:, 0])
+            positions.append(found[:, 1])
+        images, positions = numpy.concatenate(images), numpy.concatenate(positions)
+        order = numpy.lexsort((positions, images))
+        return images[order], positions[order]
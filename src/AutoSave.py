@@ -0,0 +1,184 @@
+# Background saving of the annotations.
+# Save requests are coalesced: a save runs AUTOSAVE_DELAY_MS after the first
+# request, whatever the number of requests in between. The dirty state is
+# snapshot on the GUI thread (the object masks are implicitly shared QImages,
+# copying them is cheap) and written by a worker thread: the masks of the
+# dirty images of the whole dataset (Annotation.dirtyMasks), on a pool of
+# threads (see saveMasksParallel), and the list file unless it is journaled
+# (see Journal).
+
+import os
+import time
+import threading
+import Queue
+from PyQt4.QtCore import *
+from Annotation23 import *
+from BinaryList import writeTextList
+
+# delay between the first save request and the save
+AUTOSAVE_DELAY_MS = 3000
+
+# a detached copy of an object, with its mask state but no region
+def copyObject(obj):
+    copy = XObject(None, None, obj.x1, obj.y1, obj.id, obj.w, obj.h, obj.view, obj.label, obj.mid)
+    copy.cmaskImage, copy.maskRLE = obj.cmaskImage, obj.maskRLE
+    copy.frameSize, copy.maskSource, copy.maskFile = obj.frameSize, obj.maskSource, obj.maskFile
+    copy.saveMask = obj.saveMask
+    return copy
+
+class AutoSaver(QObject):
+    def __init__(self, parent=None, delay=AUTOSAVE_DELAY_MS):
+        super(AutoSaver, self).__init__(parent)
+        self.ann = None
+        self.journal = None
+        self.ftype = FT_V2
+        self.listDirty = False
+        self.lastSave = None
+        self.saving = 0                 # snapshots queued or being written
+        self.progress = None            # (images done, images, masks saved) of the running mask flush
+        self.lastRate = None            # masks/s of the last mask flush
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(delay)
+        self.connect(self.timer, SIGNAL('timeout()'), self.flush)
+        self.connect(self, SIGNAL('saved(PyQt_PyObject)'), self.onSaved)
+        self.connect(self, SIGNAL('flushProgress(PyQt_PyObject)'), self.onProgress)
+        self.jobs = Queue.Queue()
+        self.worker = threading.Thread(target=self.run, name='autosave')
+        self.worker.setDaemon(True)
+        self.worker.start()
+
+    # the annotations to save, and their journal (None: the list is written here)
+    def setAnnotation(self, ann, journal=None):
+        if self.ann is not None: self.ann.removeEditListener(self.onAnnotationEdit)
+        self.ann, self.journal = ann, journal
+        self.listDirty = False
+        if ann is not None: ann.addEditListener(self.onAnnotationEdit)
+
+    # Annotation edit listener; the annotations keep the dirty masks
+    def onAnnotationEdit(self, op, args):
+        self.listDirty = True
+        self.request()
+
+    # save soon, requests within the delay are merged
+    def request(self):
+        if not self.timer.isActive(): self.timer.start()
+        self.emit(SIGNAL('statusChanged()'))
+
+    # snapshot the dirty state and queue it for the worker
+    def flush(self, ftype=None):
+        self.timer.stop()
+        if ftype is not None: self.ftype = ftype
+        if self.ann is None: return
+        images = []
+        for index in self.ann.takeDirtyMasks():
+            ximg = self.ann.image(index)
+            if ximg is None: continue
+            copy = XImage(ximg.fname, ximg.label, ximg.set, ximg.level)
+            copy.objects = [copyObject(obj) for obj in ximg.objects]
+            images.append((index, ximg, list(ximg.objects), copy))
+        listJob = None
+        if self.journal is not None:
+            # the edits are in the journal, the list is rewritten when saved explicitly
+            if ftype is not None: self.journal.compact(ftype)
+        elif self.listDirty or ftype is not None:
+            if self.ann.annfilename is None:
+                self.ann.annfilename = self.ann.annotationDir + self.ann.getAnnotationListFile()
+            parsed = parsedListOf(self.ann.images, self.ftype)
+            parsed.className, parsed.subclassName = self.ann.className, self.ann.subclassName
+            parsed.dirPath, parsed.folder, parsed.annotationDir = self.ann.dirPath, self.ann.folder, self.ann.annotationDir
+            listJob = (str(self.ann.annfilename), parsed, self.ftype)
+        self.listDirty = False
+        if not images and listJob is None:
+            self.emit(SIGNAL('statusChanged()'))
+            return
+        self.saving += 1
+        self.jobs.put((self.ann.annotationDir, images, listJob))
+        self.emit(SIGNAL('statusChanged()'))
+
+    # worker thread
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None: return
+            annotationDir, images, listJob = job
+            errors, rate = 0, None
+            # until the flush returns, all the images have failed (they are
+            # marked dirty again if saveMasksParallel raises)
+            failed = [copy for index, ximg, objects, copy in images]
+            try:
+                if images:
+                    progress = lambda done, total, saved: self.emit(SIGNAL('flushProgress(PyQt_PyObject)'), (done, total, saved))
+                    flush = saveMasksParallel(annotationDir, failed, progress=progress)
+                    failed, rate = flush.failed, flush.rate()
+                if listJob is not None:
+                    fname, parsed, ftype = listJob
+                    if ftype == FT_BINARY: writeBinaryList(fname, parsed)
+                    else:
+                        writeTextList(fname + '.tmp', parsed, ftype)
+                        os.rename(fname + '.tmp', fname)
+            except Exception, e:
+                print 'Autosave failed:', e
+                errors += 1
+            self.emit(SIGNAL('saved(PyQt_PyObject)'), (images, errors, failed, rate))
+            self.jobs.task_done()
+
+    # GUI thread
+    def onProgress(self, progress):
+        self.progress = progress
+        self.emit(SIGNAL('statusChanged()'))
+
+    # GUI thread: mark the saved masks as saved, unless they changed in the meantime
+    def onSaved(self, result):
+        images, errors, failed, rate = result
+        for index, ximg, objects, copy in images:
+            if copy in failed:
+                if self.ann is not None and self.ann.image(index) is ximg: self.ann.markMasksDirty(index)
+                continue
+            # objects added or deleted since the snapshot: the image is dirty again
+            if ximg.objects != objects: continue
+            for obj, saved in zip(objects, copy.objects):
+                if obj.cmaskImage is saved.cmaskImage and obj.maskRLE is saved.maskRLE:
+                    obj.maskSource, obj.maskFile, obj.saveMask = saved.maskSource, saved.maskFile, saved.saveMask
+        self.saving -= 1
+        self.progress = None
+        if rate is not None: self.lastRate = rate
+        if not errors and not failed: self.lastSave = time.time()
+        self.emit(SIGNAL('statusChanged()'))
+
+    def pendingItems(self):
+        dirty = self.ann.numDirtyImages() if self.ann is not None else 0
+        return dirty + (1 if self.listDirty else 0) + self.saving + (self.journal.pendingEdits() if self.journal else 0)
+    def status(self):
+        last = time.strftime('%H:%M:%S', time.localtime(self.lastSave)) if self.lastSave else 'never'
+        if self.progress is not None:
+            done, total, saved = self.progress
+            return 'autosave: saving masks, %d/%d images (%d masks)' % (done, total, saved)
+        state = 'saving' if self.saving else ('pending' if self.timer.isActive() else 'idle')
+        rate = ', %d masks/s' % self.lastRate if self.lastRate else ''
+        return 'autosave: %s, last %s%s, %d pending' % (state, last, rate, self.pendingItems())
+
+    # save what is dirty and wait until it is written
+    def wait(self):
+        self.flush()
+        self.jobs.join()
+        QCoreApplication.processEvents()
+    # drop the unsaved state and detach from the annotations, which are no
+    # longer ours to write (a lost shard lease); a job being written finishes
+    def discard(self):
+        self.timer.stop()
+        if self.ann is not None: self.ann.takeDirtyMasks()
+        while True:
+            try: self.jobs.get_nowait()
+            except Queue.Empty: break
+            self.saving -= 1
+            self.jobs.task_done()
+        self.setAnnotation(None)
+        self.emit(SIGNAL('statusChanged()'))
+
+    # save what is dirty and wait for the worker
+    def close(self):
+        self.flush()
+        self.jobs.put(None)
+        self.worker.join()
+        QCoreApplication.processEvents()
@@ -0,0 +1,247 @@
+# Binary annotation list files (FT_BINARY).
+#
+# layout (little endian), version 1:
+#   header: magic 'XRAL', version, flags, number of images, number of objects,
+#           offsets of the image records, the object records and the string table
+#   header strings: className, subclassName, dirPath, folder, annotationDir,
+#           each as a 16-bit length followed by the bytes
+#   flags & FLAG_FOLDERS (lists of the flat format): the 64-bit offset of the
+#           folder table, after the header strings
+#   image records (IMAGE_FIELDS): set, level, label, number of objects, index of
+#           the first object record, offset and length of the file name in the
+#           string table
+#   object records: mid, view, label, x1, y1, w, h (32-bit, the ListParser OC_* columns)
+#   string table: the file names
+#   folder table: number of distinct folders (32-bit), the folders as the header
+#           strings, then per image the index of its folder (32-bit, 4-aligned)
+# The file is read through mmap, the records are numpy views over the mapping:
+# nothing is decoded until an image is accessed.
+#
+# usage: python BinaryList.py <list file> <output file> [ftype]
+#        converts a text list (ftype 1/2/3, detected) to a binary list, or a binary
+#        list to a text list of the given ftype (default 2, 3 for a list with
+#        per image folders)
+
+import os
+import sys
+import mmap
+import struct
+from Startup import lazyImport
+numpy = lazyImport('numpy')
+from ListParser import *
+
+FT_BINARY = 4
+
+LIST_MAGIC = 'XRAL'
+LIST_VERSION = 1
+# magic, version, flags, number of images, number of objects,
+# offsets of the image records, object records and string table
+HEADER = struct.Struct('<4sHHIQQQQ')
+STRING_LENGTH = struct.Struct('<H')
+# per image folders (ParsedList.folders); readers that do not know the flag
+# read the rest of the file as before
+FLAG_FOLDERS = 1
+FOLDERS_OFFSET = struct.Struct('<Q')
+FOLDER_COUNT = struct.Struct('<I')
+IMAGE_FIELDS = [('set', '<i4'), ('level', '<i4'), ('label', '<i4'), ('count', '<u4'),
+                ('first', '<u8'), ('name', '<u8'), ('length', '<u4')]
+# numpy dtype of the image records (numpy is imported on first use)
+def imageDtype():
+    return numpy.dtype(IMAGE_FIELDS)
+OBJECT_FIELDS = 7
+
+def isBinaryList(fname):
+    f = open(fname, 'rb')
+    try: return f.read(len(LIST_MAGIC)) == LIST_MAGIC
+    finally: f.close()
+
+# an open binary list file
+class BinaryList:
+    def __init__(self, fname):
+        self.fname = fname
+        f = open(fname, 'rb')
+        try:
+            if os.path.getsize(fname) < HEADER.size: raise ValueError('Not a binary annotation list: ' + fname)
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        (magic, version, flags, self.nimages, self.nobjects,
+         imagesOffset, objectsOffset, stringsOffset) = HEADER.unpack(self.data[:HEADER.size])
+        if magic != LIST_MAGIC: raise ValueError('Not a binary annotation list: ' + fname)
+        if version > LIST_VERSION:
+            raise ValueError('%s: binary list version %d, this tool reads up to version %d' % (fname, version, LIST_VERSION))
+        pos = HEADER.size
+        strings = []
+        for i in range(5):
+            n, = STRING_LENGTH.unpack(self.data[pos:pos+STRING_LENGTH.size])
+            pos += STRING_LENGTH.size
+            strings.append(self.data[pos:pos+n])
+            pos += n
+        self.className, self.subclassName, self.dirPath, self.folder, self.annotationDir = strings
+        self.folders = None     # per image folder, flat format lists only
+        if flags & FLAG_FOLDERS:
+            foldersOffset, = FOLDERS_OFFSET.unpack(self.data[pos:pos+FOLDERS_OFFSET.size])
+            self.folders = self.readFolders(foldersOffset)
+        self.images = numpy.frombuffer(self.data, imageDtype(), self.nimages, imagesOffset)
+        self.objects = numpy.frombuffer(self.data, '<i4', self.nobjects * OBJECT_FIELDS, objectsOffset).reshape(-1, OBJECT_FIELDS)
+        self.stringsOffset = stringsOffset
+
+    def readFolders(self, pos):
+        count, = FOLDER_COUNT.unpack(self.data[pos:pos+FOLDER_COUNT.size])
+        pos += FOLDER_COUNT.size
+        distinct = []
+        for i in range(count):
+            n, = STRING_LENGTH.unpack(self.data[pos:pos+STRING_LENGTH.size])
+            pos += STRING_LENGTH.size
+            distinct.append(self.data[pos:pos+n])
+            pos += n
+        pos += -pos % 4
+        indices = numpy.frombuffer(self.data, '<i4', self.nimages, pos)
+        return [distinct[i] for i in indices.tolist()]
+
+    def numImages(self):
+        return self.nimages
+    def numObjects(self):
+        return self.nobjects
+    def name(self, i):
+        start = self.stringsOffset + int(self.images['name'][i])
+        return self.data[start:start + int(self.images['length'][i])]
+    # (set, level, label) of image i
+    def imageFields(self, i):
+        record = self.images[i]
+        return int(record['set']), int(record['level']), int(record['label'])
+    # object records of image i, rows of OC_* columns
+    def imageObjects(self, i):
+        first = int(self.images['first'][i])
+        return self.objects[first:first + int(self.images['count'][i])]
+
+    # the whole list as arrays (copies, they can be modified)
+    def toParsedList(self):
+        parsed = ParsedList(FT_BINARY)
+        parsed.className, parsed.subclassName = self.className, self.subclassName
+        parsed.dirPath, parsed.folder, parsed.annotationDir = self.dirPath, self.folder, self.annotationDir
+        parsed.names = [self.name(i) for i in range(self.nimages)]
+        if self.folders is not None: parsed.folders = list(self.folders)
+        images = numpy.empty((self.nimages, 4), numpy.int32)
+        images[:, IC_SET], images[:, IC_LEVEL] = self.images['set'], self.images['level']
+        images[:, IC_LABEL], images[:, IC_COUNT] = self.images['label'], self.images['count']
+        parsed.images = images
+        counts = images[:, IC_COUNT].astype(numpy.int64)
+        parsed.offsets = numpy.zeros(self.nimages + 1, numpy.int64)
+        numpy.cumsum(counts, out=parsed.offsets[1:])
+        if numpy.array_equal(self.images['first'], parsed.offsets[:-1]):
+            parsed.objects = numpy.array(self.objects, numpy.int32)
+        else:
+            rows = numpy.repeat(self.images['first'].astype(numpy.int64) - parsed.offsets[:-1], counts) + numpy.arange(parsed.offsets[-1])
+            parsed.objects = self.objects[rows].astype(numpy.int32)
+        return parsed
+
+    def close(self):
+        self.images, self.objects = None, None
+        self.data.close()
+
+# write a list (ParsedList: header attributes, names, images, objects, offsets)
+# to a binary list file; written next to it and renamed, an open BinaryList of
+# the same file keeps reading the previous version
+def writeBinaryList(fname, parsed):
+    nimages, nobjects = len(parsed.names), len(parsed.objects)
+    header = ''
+    for s in (parsed.className, parsed.subclassName, parsed.dirPath, parsed.folder, parsed.annotationDir):
+        s = str(s)
+        header += STRING_LENGTH.pack(len(s)) + s
+    images = numpy.zeros(nimages, imageDtype())
+    images['set'], images['level'] = parsed.images[:, IC_SET], parsed.images[:, IC_LEVEL]
+    images['label'], images['count'] = parsed.images[:, IC_LABEL], parsed.images[:, IC_COUNT]
+    images['first'] = parsed.offsets[:-1]
+    names = [str(name) for name in parsed.names]
+    lengths = numpy.array([len(name) for name in names], numpy.int64)
+    images['length'] = lengths
+    images['name'][1:] = numpy.cumsum(lengths)[:-1]
+    flags = FLAG_FOLDERS if parsed.folders is not None else 0
+    if flags & FLAG_FOLDERS: header += FOLDERS_OFFSET.pack(0)       # written below
+    imagesOffset = HEADER.size + len(header)
+    imagesOffset += -imagesOffset % 8
+    objectsOffset = imagesOffset + images.nbytes
+    objectsOffset += -objectsOffset % 8
+    stringsOffset = objectsOffset + nobjects * OBJECT_FIELDS * 4
+    tmpName = fname + '.tmp'
+    f = open(tmpName, 'wb')
+    try:
+        f.write(HEADER.pack(LIST_MAGIC, LIST_VERSION, flags, nimages, nobjects, imagesOffset, objectsOffset, stringsOffset))
+        f.write(header)
+        f.write('\0' * (imagesOffset - f.tell()))
+        f.write(images.tostring())
+        f.write('\0' * (objectsOffset - f.tell()))
+        f.write(numpy.asarray(parsed.objects, '<i4').tostring())
+        f.write(''.join(names))
+        if flags & FLAG_FOLDERS:
+            foldersOffset = f.tell()
+            writeFolders(f, parsed.folders)
+            f.seek(HEADER.size + len(header) - FOLDERS_OFFSET.size)
+            f.write(FOLDERS_OFFSET.pack(foldersOffset))
+    finally:
+        f.close()
+    os.rename(tmpName, fname)
+
+# the folder table of writeBinaryList
+def writeFolders(f, folders):
+    distinct = sorted(set(str(folder) for folder in folders))
+    number = dict((folder, i) for i, folder in enumerate(distinct))
+    table = FOLDER_COUNT.pack(len(distinct))
+    for folder in distinct: table += STRING_LENGTH.pack(len(folder)) + folder
+    f.write(table)
+    f.write('\0' * (-f.tell() % 4))
+    f.write(numpy.array([number[str(folder)] for folder in folders], '<i4').tostring())
+
+# write a list (ParsedList) as a text list file of type ftype (1 or 2), as
+# Annotation.saveAnnotationListAs does, or FT_FLAT (with the per image folders)
+def writeTextList(fname, parsed, ftype=FT_V2):
+    if ftype == FT_FLAT:
+        writeFlatList(fname, parsed)
+        return
+    if ftype == FT_V1: cols = [OC_VIEW, OC_LABEL, OC_X1, OC_Y1, OC_W, OC_H]
+    else: cols = [OC_VIEW, OC_LABEL, OC_MID, OC_X1, OC_Y1, OC_W, OC_H]
+    objects = parsed.objects[:, cols].tolist()
+    ofs = open(fname, 'w')
+    ofs.write(parsed.className + ' ' + parsed.subclassName + '\n')
+    ofs.write(parsed.dirPath + ' ' + parsed.folder + '\n')
+    ofs.write(parsed.annotationDir + ' ' + parsed.subclassName + '\n')
+    ofs.write(str(len(parsed.names)))
+    offsets = parsed.offsets.tolist()
+    for i, (set, level, label, count) in enumerate(parsed.images.tolist()):
+        fields = ['%d %d %d %d %s' % (set, level, label, count, parsed.names[i])]
+        for values in objects[offsets[i]:offsets[i+1]]:
+            fields.append(' '.join(map(str, values)))
+        ofs.write('\n' + ' '.join(fields))
+    ofs.close()
+
+# flat format: no header, folder and name first; the folder of the list if
+# the images have none
+def writeFlatList(fname, parsed):
+    objects = parsed.objects.tolist()
+    folders = parsed.folders if parsed.folders is not None else [parsed.folder] * len(parsed.names)
+    ofs = open(fname, 'w')
+    offsets = parsed.offsets.tolist()
+    for i, (set, level, label, count) in enumerate(parsed.images.tolist()):
+        fields = ['%s %s %d %d %d %d' % (folders[i], parsed.names[i], set, level, label, count)]
+        for values in objects[offsets[i]:offsets[i+1]]:
+            fields.append(' '.join(map(str, values)))
+        ofs.write(' '.join(fields) + '\n')
+    ofs.close()
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print 'usage: python BinaryList.py <list file> <output file> [ftype]'
+        sys.exit(1)
+    src, dst = sys.argv[1], sys.argv[2]
+    if isBinaryList(src):
+        blist = BinaryList(src)
+        # a list converted from the flat format goes back to it, with its folders
+        ftype = int(sys.argv[3]) if len(sys.argv) > 3 else (FT_FLAT if blist.folders is not None else FT_V2)
+        writeTextList(dst, blist.toParsedList(), ftype)
+        blist.close()
+    else:
+        parsed = parseListFile(src)
+        writeBinaryList(dst, parsed)
+        ftype = FT_BINARY
+    print src, '->', dst, '(format %d)' % ftype
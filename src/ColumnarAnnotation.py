@@ -0,0 +1,298 @@
+# Columnar annotation store.
+# The image fields (set, level, label, number of objects) and the object fields
+# (mid, view, label, x1, y1, w, h) of the whole list are kept in numpy arrays;
+# XImageView and XObjectView give the XImage/XObject interface over one row, so
+# that the GUI works on a ColumnarAnnotation as on an Annotation. Bulk edits and
+# filters are array operations. Masks and regions stay with the object views,
+# which are created when the objects of an image are first accessed; the views
+# of the images whose objects were added or deleted are kept, the others only
+# while they are in use or among the RECENT_VIEWS last ones (unless they have
+# unsaved masks).
+#
+# The module does not need Qt: the views are AnnotationCore objects, the GUI
+# uses the ColumnarAnnotation of Annotation23, whose views are also Qt objects.
+
+import os
+import weakref
+from collections import OrderedDict
+from Startup import lazyImport
+from AnnotationCore import *
+numpy = lazyImport('numpy')
+
+# initial number of rows of the growable tables
+MIN_ROWS = 64
+# image views with object lists kept without edits, the last ones created
+RECENT_VIEWS = 256
+
+def grow(table, rows):
+    if rows <= len(table): return table
+    bigger = numpy.zeros((max(rows, 2*len(table), MIN_ROWS),) + table.shape[1:], table.dtype)
+    bigger[:len(table)] = table
+    return bigger
+
+# a column of the object table as an attribute of the object view
+def objectField(col):
+    def get(self): return int(self.store.objects[self.row, col])
+    def set(self, value): self.store.objects[self.row, col] = value
+    return property(get, set)
+
+# a column of the image table as an attribute of the image view
+def imageField(col):
+    def get(self): return int(self.store.images[self.index, col])
+    def set(self, value): self.store.images[self.index, col] = value
+    return property(get, set)
+
+# one object of the store, the mask state is kept as in XObject
+class XObjectView(XObject):
+    __slots__ = ('store', 'row')
+    def __init__(self, store, row, id):
+        self.store, self.row = store, row
+        self.id = id
+        self.maskState = None
+    mid = objectField(OC_MID)
+    view = objectField(OC_VIEW)
+    label = objectField(OC_LABEL)
+    x1 = objectField(OC_X1)
+    y1 = objectField(OC_Y1)
+    w = objectField(OC_W)
+    h = objectField(OC_H)
+
+# one image of the store; its object list is created on first access
+class XImageView(XImage):
+    __slots__ = ('store', 'index', 'objectList', '__weakref__')
+    objectClass = XObjectView
+    def __init__(self, store, index):
+        self.store, self.index = store, index
+        self.objectList = None
+    set = imageField(IC_SET)
+    level = imageField(IC_LEVEL)
+    label = imageField(IC_LABEL)
+    def getName(self): return self.store.names[self.index]
+    def setName(self, fname): self.store.names[self.index] = fname
+    fname = property(getName, setName)
+
+    def getObjects(self):
+        if self.objectList is None:
+            rows = self.store.objectRows(self.index)
+            self.objectList = [self.objectClass(self.store, row, j) for j, row in enumerate(rows)]
+            self.store.keepRecent(self)
+        return self.objectList
+    objects = property(getObjects)
+    def numObjects(self):
+        return int(self.store.images[self.index, IC_COUNT])
+
+    def addObject(self, mask, region, x1, y1, id, frameSize=None):
+        obj = self.store.newObject(self.index, id)
+        obj.x1, obj.y1 = x1, y1
+        if region: obj.w, obj.h = region.width(), region.height()
+        obj.frameSize = frameSize
+        if mask is not None: obj.mask = mask
+        if region is not None: obj.region = region
+        obj.saveMask = mask is not None
+        self.objects.append(obj)
+        self.store.images[self.index, IC_COUNT] += 1
+        self.store.keep(self)
+        return obj
+    # take over an XObject, with its mask
+    def adoptObject(self, xobj):
+        obj = self.store.newObject(self.index, xobj.id)
+        for name in ('mid', 'view', 'label', 'x1', 'y1', 'w', 'h'):
+            setattr(obj, name, getattr(xobj, name))
+        for name in ('cmaskImage', 'maskRLE', 'regionImage', 'frameSize', 'maskSource', 'maskFile', 'brushColor', 'saveMask'):
+            setattr(obj, name, getattr(xobj, name))
+        self.objects.append(obj)
+        self.store.images[self.index, IC_COUNT] += 1
+        self.store.keep(self)
+        return obj
+    def deleteObject(self, id):
+        for obj in [o for o in self.objects if o.id == id]:
+            self.objects.remove(obj)
+            self.store.owners[obj.row] = -1
+            self.store.images[self.index, IC_COUNT] -= 1
+        self.store.keep(self)
+    def deleteObjectAt(self, position):
+        obj = self.objects.pop(position)
+        self.store.owners[obj.row] = -1
+        self.store.images[self.index, IC_COUNT] -= 1
+        self.store.keep(self)
+    def deleteAllObjects(self):
+        for obj in self.objects: self.store.owners[obj.row] = -1
+        del self.objects[:]
+        self.store.images[self.index, IC_COUNT] = 0
+        self.store.keep(self)
+
+    # list lines from the tables, without creating the object views
+    def formatLine(self, head, cols):
+        rows = self.store.objectRows(self.index) if self.objectList is None else [o.row for o in self.objectList]
+        fields = [head]
+        for values in self.store.objects[rows][:, cols].tolist():
+            fields.append(' '.join(map(str, values)))
+        return ' '.join(fields)
+    def headString(self):
+        return '%d %d %d %d' % tuple(self.store.images[self.index].tolist())
+    def toString(self):
+        return self.formatLine(self.headString() + ' ' + self.fname, [OC_VIEW, OC_LABEL, OC_X1, OC_Y1, OC_W, OC_H])
+    def toString2(self):
+        return self.formatLine(self.headString() + ' ' + self.fname, [OC_VIEW, OC_LABEL, OC_MID, OC_X1, OC_Y1, OC_W, OC_H])
+    def toStringFlat(self, folder):
+        head = folder + ' ' + os.path.splitext(self.fname)[0] + ' ' + self.headString()
+        return self.formatLine(head, [OC_MID, OC_VIEW, OC_LABEL, OC_X1, OC_Y1, OC_W, OC_H])
+
+# the image and object tables, a sequence of XImageView (imageClass) as
+# Annotation.images
+class ImageColumns:
+    def __init__(self, parsed=None, imageClass=XImageView):
+        self.imageClass = imageClass
+        self.names = []
+        self.folders = None
+        # the tables grow by doubling, rows beyond len(names) and numObjectRows are unused
+        self.images = numpy.zeros((0, 4), numpy.int32)       # IC_* columns
+        self.objects = numpy.zeros((0, 7), numpy.int32)      # OC_* columns
+        self.owners = numpy.zeros(0, numpy.int32)            # image of each object, -1: deleted
+        self.offsets = numpy.zeros(1, numpy.int64)           # objects of the list file: offsets[i]:offsets[i+1]
+        self.numObjectRows = 0
+        self.views = weakref.WeakValueDictionary()
+        self.materialized = {}      # images whose objects were added or deleted: their views
+        self.recent = OrderedDict()     # other views with object lists, oldest first
+        if parsed is not None:
+            self.names = list(parsed.names)
+            self.folders = parsed.folders
+            self.images = parsed.images
+            self.objects = parsed.objects
+            self.offsets = parsed.offsets
+            self.numObjectRows = len(parsed.objects)
+            self.owners = numpy.repeat(numpy.arange(len(self.names), dtype=numpy.int32), numpy.diff(self.offsets))
+
+    def __len__(self):
+        return len(self.names)
+    def __getitem__(self, index):
+        if index < 0: index += len(self.names)
+        if index < 0 or index >= len(self.names): raise IndexError(index)
+        view = self.materialized.get(index) or self.views.get(index)
+        if view is None:
+            view = self.imageClass(self, index)
+            self.views[index] = view
+        return view
+    def __iter__(self):
+        for i in range(len(self.names)): yield self[i]
+
+    def append(self, ximg):
+        index = len(self.names)
+        self.images = grow(self.images, index + 1)
+        self.images[index] = (ximg.set, ximg.level, ximg.label, 0)
+        self.names.append(ximg.fname)
+        if self.folders is not None: self.folders.append(getattr(ximg, 'folder', 'none'))
+        view = self[index]
+        for obj in ximg.objects: view.adoptObject(obj)
+    def extend(self, ximgs):
+        for ximg in ximgs: self.append(ximg)
+
+    # an image view whose object list was just created; the oldest of the
+    # recent views are dropped unless they have unsaved masks
+    def keepRecent(self, view):
+        self.recent[view.index] = view
+        while len(self.recent) > RECENT_VIEWS:
+            index, old = self.recent.popitem(last=False)
+            if any(obj.saveMask for obj in old.objectList): self.materialized[index] = old
+    # the object list of the view no longer matches the rows of the list file
+    def keep(self, view):
+        self.recent.pop(view.index, None)
+        self.materialized[view.index] = view
+
+    # rows of the objects of an image whose object list has not been created
+    def objectRows(self, index):
+        if index + 1 >= len(self.offsets): return []     # appended after loading
+        rows = numpy.arange(self.offsets[index], self.offsets[index+1])
+        return rows[self.owners[rows] == index].tolist()
+    def newObject(self, index, id):
+        row = self.numObjectRows
+        self.numObjectRows += 1
+        self.objects = grow(self.objects, self.numObjectRows)
+        self.owners = grow(self.owners, self.numObjectRows)
+        self.objects[row] = OBJECT_DEFAULTS
+        self.owners[row] = index
+        return self.imageClass.objectClass(self, row, id)
+
+    # the tables without unused and deleted rows, objects in image order
+    def toParsedList(self):
+        parsed = ParsedList(FT_BINARY)
+        n = len(self.names)
+        parsed.names = list(self.names)
+        if self.folders is not None: parsed.folders = list(self.folders)
+        parsed.images = self.images[:n].copy()
+        rows = []
+        for i in range(n):
+            view = self.materialized.get(i)
+            rows.extend(self.objectRows(i) if view is None else [o.row for o in view.objectList])
+        parsed.objects = self.objects[numpy.array(rows, numpy.int64)]
+        parsed.offsets = numpy.zeros(n + 1, numpy.int64)
+        numpy.cumsum(parsed.images[:, IC_COUNT], out=parsed.offsets[1:])
+        return parsed
+
+    # array of the indices of the images with the given labels, levels and sets
+    def select(self, labels=None, levels=None, sets=None):
+        images = self.images[:len(self.names)]
+        keep = numpy.ones(len(images), bool)
+        if labels is not None: keep &= numpy.in1d(images[:, IC_LABEL], labels)
+        if levels is not None: keep &= numpy.in1d(images[:, IC_LEVEL], levels)
+        if sets is not None: keep &= numpy.in1d(images[:, IC_SET], sets)
+        return numpy.nonzero(keep)[0]
+    # object table rows (of existing objects) with the given field values
+    def selectObjects(self, **values):
+        keep = self.owners[:self.numObjectRows] >= 0
+        cols = {'mid': OC_MID, 'view': OC_VIEW, 'label': OC_LABEL}
+        for name, accepted in values.items():
+            keep &= numpy.in1d(self.objects[:self.numObjectRows, cols[name]], accepted)
+        return numpy.nonzero(keep)[0]
+
+# Annotation over an ImageColumns store of imageClass views; list files of
+# any format are loaded with the bulk parser. A mixin, first in the bases of
+# the Annotation classes (ColumnarAnnotation, Annotation23.ColumnarAnnotation)
+class ColumnarAnnotationBase:
+    def __init__(self, fname=None, ftype=FT_AUTO):
+        Annotation.__init__(self)
+        self.images = ImageColumns(None, self.imageClass)
+        self.annfilename = fname
+        if fname:
+            self.loadAnnotation(fname, ftype)
+
+    def loadAnnotation(self, fname, ftype=FT_AUTO):
+        if not os.path.exists(fname):
+            print 'Could not load ', fname
+            return
+        if ftype == FT_AUTO and isBinaryList(fname): ftype = FT_BINARY
+        if ftype == FT_BINARY: self.loadAnnotationBinary(fname)
+        else: self.loadAnnotationBulk(fname, None if ftype == FT_AUTO else ftype)
+    def loadAnnotationBinary(self, fname):
+        blist = BinaryList(fname)
+        self.setParsedList(fname, blist.toParsedList())
+        blist.close()
+    def loadAnnotationBulk(self, fname, ftype=None):
+        self.setParsedList(fname, parseListFile(fname, ftype))
+    def setParsedList(self, fname, parsed):
+        self.annfilename = fname
+        self.className, self.subclassName = parsed.className, parsed.subclassName
+        self.dirPath, self.folder = parsed.dirPath, parsed.folder
+        self.rootDir = self.dirPath      # this is not correct
+        self.annotationDir = parsed.annotationDir
+        if len(self.images) == 0: self.images = ImageColumns(parsed, self.imageClass)
+        else: self.images.extend(buildImages(parsed))
+        print 'Loaded ', fname, '(format %d)' % parsed.ftype
+        print 'Number of images in the annotation list: ', self.numImages()
+
+    def setLabel(self, label):
+        if label in (-1, 0, 1):
+            self.curImage().label = label
+            self.notifyEdit('label', self.index, label)
+        elif label in (-2, 10, 2):
+            label = {-2: -1, 10: 0, 2: 1}[label]
+            self.images.images[:len(self.images), IC_LABEL] = label
+            self.notifyEdit('labelall', label)
+
+    def setLevelAll(self, level):
+        if level in (0,1,2,3,4,5):
+            self.images.images[:len(self.images), IC_LEVEL] = level
+            self.notifyEdit('levelall', level)
+
+class ColumnarAnnotation(ColumnarAnnotationBase, Annotation):
+    imageClass = XImageView
@@ -0,0 +1,129 @@
+# Cache of decoded images for image navigation.
+# Images are kept in LRU order within a byte budget; the images the user is
+# likely to open next are decoded ahead of time by background workers.
+
+import os
+import threading
+from collections import OrderedDict
+from PyQt4.QtCore import *
+from PyQt4.QtGui import *
+
+# decode one image file in a worker thread (QImage, unlike QPixmap, can be
+# created outside the GUI thread)
+class ImageLoader(QRunnable):
+    def __init__(self, cache, fname):
+        super(ImageLoader, self).__init__()
+        self.cache = cache
+        self.fname = fname
+    def run(self):
+        # skip requests that became stale while waiting in the queue
+        if not self.cache.isWanted(self.fname):
+            self.cache.loaded(self.fname, None)
+            return
+        self.cache.loaded(self.fname, QImage(self.fname))
+
+class ImageCache:
+    def __init__(self, maxBytes=512*1024*1024, numThreads=2):
+        self.maxBytes = maxBytes
+        self.images = OrderedDict()     # file name -> QImage, least recently used first
+        self.nbytes = 0
+        self.pending = set()            # files queued or being decoded
+        self.wanted = set()             # files of the last prefetch request
+        self.cond = threading.Condition()
+        self.pool = QThreadPool()
+        self.pool.setMaxThreadCount(numThreads)
+        # counters, to tune the prefetch depth and the budget
+        self.hits = 0           # found in the cache
+        self.waits = 0          # still being prefetched, waited for it
+        self.misses = 0         # decoded on request
+        self.evictions = 0
+
+    def numImages(self):
+        return len(self.images)
+
+    # return the decoded image, from the cache if possible
+    def get(self, fname):
+        self.cond.acquire()
+        try:
+            image = self.lookup(fname)
+            if image is not None:
+                self.hits += 1
+                return image
+            if fname in self.pending:
+                self.waits += 1
+                while fname in self.pending: self.cond.wait()
+                image = self.lookup(fname)
+                if image is not None: return image
+            self.misses += 1
+        finally:
+            self.cond.release()
+        # decode without holding the lock, so that workers can go on
+        if not os.path.exists(fname): return None
+        image = QImage(fname)
+        if image.isNull(): return None
+        self.cond.acquire()
+        try: self.insert(fname, image)
+        finally: self.cond.release()
+        return image
+
+    # decode the given files in the background, in the given order;
+    # files of earlier requests that are not queued yet are dropped
+    def prefetch(self, fnames):
+        self.cond.acquire()
+        try:
+            self.wanted = set(fnames)
+            for fname in fnames:
+                if fname in self.images:
+                    # keep what we are going to need soon
+                    self.images[fname] = self.images.pop(fname)
+                elif fname not in self.pending and os.path.exists(fname):
+                    self.pending.add(fname)
+                    self.pool.start(ImageLoader(self, fname))
+        finally:
+            self.cond.release()
+
+    def isWanted(self, fname):
+        self.cond.acquire()
+        try: return fname in self.wanted
+        finally: self.cond.release()
+
+    # called by the workers
+    def loaded(self, fname, image):
+        self.cond.acquire()
+        try:
+            self.pending.discard(fname)
+            if image is not None and not image.isNull():
+                self.insert(fname, image)
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def clear(self):
+        self.cond.acquire()
+        try:
+            self.images.clear()
+            self.wanted = set()
+            self.nbytes = 0
+        finally:
+            self.cond.release()
+
+    # the following must be called with the lock held
+    def lookup(self, fname):
+        image = self.images.pop(fname, None)
+        if image is not None: self.images[fname] = image
+        return image
+    def insert(self, fname, image):
+        old = self.images.pop(fname, None)
+        if old is not None: self.nbytes -= old.byteCount()
+        self.images[fname] = image
+        self.nbytes += image.byteCount()
+        # evict the least recently used images, but always keep the newest one
+        while self.nbytes > self.maxBytes and len(self.images) > 1:
+            f, img = self.images.popitem(last=False)
+            self.nbytes -= img.byteCount()
+            self.evictions += 1
+
+    def stats(self):
+        return 'cache: %d images, %d/%d MB | hits %d, waits %d, misses %d, evictions %d' % (
+            len(self.images), self.nbytes / 1048576, self.maxBytes / 1048576,
+            self.hits, self.waits, self.misses, self.evictions)
@@ -0,0 +1,216 @@
+# Table model of the images of an annotation (file name, number of objects,
+# label, level), read from the annotation when the view asks for a cell: the
+# view only requests the visible rows, nothing is built per image. The model
+# listens to the edits of the annotation and signals the changed rows.
+#
+# Rows can be filtered by level, label and object model ID (Annotation.query)
+# and sorted by any column. The sort keys are kept in arrays (ImageKeys), rows
+# are an array of image indices in view order; an edit moves, inserts or removes the row of the edited image,
+# the rows are not rebuilt. File names are searched by substring in one
+# lowercase string of all the names.
+
+from PyQt4.QtCore import *
+from PyQt4.QtGui import *
+from Startup import lazyImport
+from ListParser import IC_LEVEL, IC_LABEL, IC_COUNT
+numpy = lazyImport('numpy')
+
+COLUMN_NAMES = ["image filename", "objects", "label", "level"]
+COL_NAME, COL_OBJECTS, COL_LABEL, COL_LEVEL = 0, 1, 2, 3
+
+# sort keys of the images, and the file name index
+class ImageKeys:
+    def __init__(self, ann):
+        parsed = ann.toParsedList()
+        n = len(parsed.names)
+        names = [name.lower() for name in parsed.names]
+        self.keys = numpy.zeros((4, n), numpy.int64)      # COL_* rows
+        # file names sort by rank
+        self.keys[COL_NAME, sorted(xrange(n), key=names.__getitem__)] = numpy.arange(n)
+        self.keys[COL_OBJECTS] = parsed.images[:, IC_COUNT]
+        self.keys[COL_LABEL] = parsed.images[:, IC_LABEL]
+        self.keys[COL_LEVEL] = parsed.images[:, IC_LEVEL]
+        # all the names, one per line; the line of a match is found from its offset
+        self.text = '\n'.join(names)
+        lengths = numpy.array([len(name) + 1 for name in names], numpy.int64)
+        self.starts = numpy.zeros(n, numpy.int64)
+        if n > 1: numpy.cumsum(lengths[:-1], out=self.starts[1:])
+
+    def __len__(self):
+        return self.keys.shape[1]
+    def update(self, ann, index):
+        self.keys[COL_OBJECTS, index] = ann.numObjects(index)
+        ximg = ann.image(index)
+        self.keys[COL_LABEL, index], self.keys[COL_LEVEL, index] = ximg.label, ximg.level
+    # keys that sort as the column, ties in image order
+    def sortKeys(self, column):
+        return self.keys[column] * len(self) + numpy.arange(len(self))
+    # array of the indices of the images whose names contain text (any case)
+    def find(self, text):
+        text = text.lower()
+        if not text or '\n' in text: return numpy.zeros(0, numpy.int64)
+        found = []
+        pos = self.text.find(text)
+        while pos >= 0:
+            found.append(pos)
+            pos = self.text.find(text, pos + 1)
+        return numpy.unique(numpy.searchsorted(self.starts, numpy.array(found, numpy.int64), 'right') - 1)
+
+class ImageTableModel(QAbstractTableModel):
+    def __init__(self, parent=None):
+        super(ImageTableModel, self).__init__(parent)
+        self.ann = None
+        self.imageKeys = None
+        self.rows = numpy.zeros(0, numpy.int64)       # image index of each row
+        self.rowOf = numpy.zeros(0, numpy.int64)      # row of each image, -1: filtered out
+        self.levels, self.labels, self.mids = None, None, None     # accepted values, None: all
+        self.sortColumn, self.sortOrder = -1, Qt.AscendingOrder
+        self.colors = {}        # (image index, column) -> background color
+
+    def setAnnotation(self, ann):
+        self.beginResetModel()
+        if self.ann is not None: self.ann.removeEditListener(self.onAnnotationEdit)
+        self.ann = ann
+        self.colors = {}
+        self.imageKeys = ImageKeys(ann) if ann is not None else None
+        self.buildRows()
+        if ann is not None: ann.addEditListener(self.onAnnotationEdit)
+        self.endResetModel()
+
+    # rows of the images accepted by the filter, in sort order
+    def buildRows(self):
+        if self.imageKeys is None:
+            self.rows, self.rowOf = numpy.zeros(0, numpy.int64), numpy.zeros(0, numpy.int64)
+            return
+        if self.filtered(): self.rows = self.ann.query(labels=self.labels, levels=self.levels, mids=self.mids)
+        else: self.rows = numpy.arange(len(self.imageKeys))
+        if self.sortColumn >= 0:
+            self.rows = self.rows[numpy.argsort(self.imageKeys.sortKeys(self.sortColumn)[self.rows])]
+            if self.sortOrder == Qt.DescendingOrder: self.rows = self.rows[::-1].copy()
+        self.rowOf = numpy.empty(len(self.imageKeys), numpy.int64)
+        self.rowOf.fill(-1)
+        self.rowOf[self.rows] = numpy.arange(len(self.rows))
+    def filtered(self):
+        return self.levels is not None or self.labels is not None or self.mids is not None
+    # whether the filter accepts an image
+    def accepts(self, index):
+        if self.levels is not None and self.imageKeys.keys[COL_LEVEL, index] not in self.levels: return False
+        if self.labels is not None and self.imageKeys.keys[COL_LABEL, index] not in self.labels: return False
+        if self.mids is not None: return any(obj.mid in self.mids for obj in self.ann.image(index).objects)
+        return True
+    def rebuild(self):
+        self.emit(SIGNAL('layoutAboutToBeChanged()'))
+        self.buildRows()
+        self.emit(SIGNAL('layoutChanged()'))
+
+    # show only the images with the given levels and labels, and with objects
+    # of the given model IDs (None: all)
+    def setFilter(self, levels=None, labels=None, mids=None):
+        self.levels, self.labels, self.mids = levels, labels, mids
+        if self.imageKeys is not None: self.rebuild()
+    # QAbstractItemModel.sort, called by the view when a column header is
+    # clicked; column -1: the order of the list
+    def sort(self, column, order=Qt.AscendingOrder):
+        self.sortColumn, self.sortOrder = column, order
+        if self.imageKeys is not None: self.rebuild()
+
+    # image index of a row, and row of an image (-1: not shown)
+    def imageAt(self, row):
+        if row < 0 or row >= len(self.rows): return -1
+        return int(self.rows[row])
+    def rowOfImage(self, index):
+        if index < 0 or index >= len(self.rowOf): return -1
+        return int(self.rowOf[index])
+    # row of the first image after row (wrapping) whose name contains text, -1: none
+    def findRow(self, text, row=-1):
+        if self.imageKeys is None: return -1
+        rows = self.rowOf[self.imageKeys.find(str(text))]
+        rows = numpy.sort(rows[rows >= 0])
+        if len(rows) == 0: return -1
+        after = rows[rows > row]
+        return int(after[0] if len(after) else rows[0])
+
+    # Annotation edit listener
+    def onAnnotationEdit(self, op, args):
+        if self.imageKeys is None: return
+        if op in ('labelall', 'levelall'):
+            column = COL_LABEL if op == 'labelall' else COL_LEVEL
+            self.imageKeys.keys[column] = args[0]
+            filtered = self.labels if column == COL_LABEL else self.levels
+            if filtered is not None or self.sortColumn == column: self.rebuild()
+            else: self.allRowsChanged()
+            return
+        index = args[0]
+        if index >= len(self.imageKeys): return
+        before = self.imageKeys.keys[:, index].copy()
+        self.imageKeys.update(self.ann, index)
+        row = self.rowOfImage(index)
+        show = self.accepts(index)
+        moved = self.sortColumn >= 0 and before[self.sortColumn] != self.imageKeys.keys[self.sortColumn, index]
+        if row >= 0 and (not show or moved): self.removeImageRow(row)
+        if show and (row < 0 or moved): self.insertImageRow(index)
+        elif row >= 0 and show: self.rowChanged(index)
+
+    def removeImageRow(self, row):
+        self.beginRemoveRows(QModelIndex(), row, row)
+        index = self.rows[row]
+        self.rows = numpy.delete(self.rows, row)
+        self.rowOf[index] = -1
+        self.rowOf[self.rows[row:]] -= 1
+        self.endRemoveRows()
+    # insert the row of an image at its place in the sort order
+    def insertImageRow(self, index):
+        if self.sortColumn < 0: row = int(numpy.searchsorted(self.rows, index))
+        else:
+            keys = self.imageKeys.sortKeys(self.sortColumn)
+            if self.sortOrder == Qt.AscendingOrder: row = int(numpy.searchsorted(keys[self.rows], keys[index]))
+            else: row = len(self.rows) - int(numpy.searchsorted(keys[self.rows[::-1]], keys[index]))
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.rows = numpy.insert(self.rows, row, index)
+        self.rowOf[self.rows[row+1:]] += 1
+        self.rowOf[index] = row
+        self.endInsertRows()
+
+    # the cells of an image changed
+    def rowChanged(self, index):
+        row = self.rowOfImage(index)
+        if row < 0: return
+        self.emit(SIGNAL('dataChanged(QModelIndex,QModelIndex)'), self.index(row, 0), self.index(row, len(COLUMN_NAMES) - 1))
+    # the view repaints the visible rows only
+    def allRowsChanged(self):
+        if self.rowCount() == 0: return
+        self.emit(SIGNAL('dataChanged(QModelIndex,QModelIndex)'), self.index(0, 0), self.index(self.rowCount() - 1, len(COLUMN_NAMES) - 1))
+
+    def setBackground(self, index, column, color):
+        self.colors[(index, column)] = color
+        row = self.rowOfImage(index)
+        if row >= 0: self.emit(SIGNAL('dataChanged(QModelIndex,QModelIndex)'), self.index(row, column), self.index(row, column))
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid(): return 0
+        return len(self.rows)
+    def columnCount(self, parent=QModelIndex()):
+        if parent.isValid(): return 0
+        return len(COLUMN_NAMES)
+
+    def cellValue(self, index, column):
+        if column == COL_NAME: return self.ann.imageName(index)
+        if column == COL_OBJECTS: return self.ann.numObjects(index)
+        ximg = self.ann.image(index)
+        if column == COL_LABEL: return ximg.label
+        return ximg.level
+
+    def data(self, index, role=Qt.DisplayRole):
+        image = self.imageAt(index.row()) if index.isValid() else -1
+        if image < 0: return QVariant()
+        if role == Qt.DisplayRole: return QVariant(str(self.cellValue(image, index.column())))
+        if role == Qt.BackgroundRole:
+            color = self.colors.get((image, index.column()))
+            if color is not None: return QVariant(QBrush(color))
+        return QVariant()
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole: return QVariant()
+        if orientation == Qt.Horizontal: return QVariant(COLUMN_NAMES[section])
+        # the image number, in list order
+        return QVariant(str(self.imageAt(section) + 1))
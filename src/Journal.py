@@ -0,0 +1,278 @@
+# Write-ahead journal of the edits of an annotation list.
+#
+# Edits are appended to <list file>.journal as they happen (one line per edit,
+# see applyEdit) instead of rewriting the whole list. The journal is compacted
+# into the list in a background thread: the journal is renamed to
+# <list file>.journal.old, a new journal is started, the list is loaded, the
+# old journal is replayed on it and the list is written next to the original
+# and renamed over it. When a list is opened, the journals are replayed on it.
+#
+# Each journal starts with the fingerprint (size, modification time) of the
+# list it applies to, or PENDING while the list it applies to is being
+# written; this tells whether the edits of a journal are already in the list
+# after a crash during a compaction.
+
+import os
+import time
+import threading
+from AnnotationCore import *
+from BinaryList import writeTextList
+
+JOURNAL_SUFFIX = '.journal'
+OLD_SUFFIX = '.old'
+JOURNAL_MAGIC = '#XRanT-journal'
+PENDING = 'pending'
+# compact when the journal has this many edits, or its first edit is this old
+JOURNAL_COMPACT_RECORDS = 5000
+JOURNAL_COMPACT_SECONDS = 600
+# fsync the journal after each edit (safe against power loss, but slower)
+JOURNAL_FSYNC = False
+
+def listFingerprint(fname):
+    st = os.stat(fname)
+    return '%d:%d' % (st.st_size, int(st.st_mtime * 1000))
+
+# object at a position of an image, None if there is none
+def objectAt(ximg, position):
+    if 0 <= position < len(ximg.objects): return ximg.objects[position]
+    return None
+
+# apply one journal record to the annotations; the objects are identified by
+# their position in the image (viewat, midat, deleteat): the ids are
+# renumbered when the list is reloaded, e.g. by a compaction. The records
+# by id (view, mid, delete) are of older journals.
+def applyEdit(ann, op, args):
+    if op == 'labelall': ann.setLabel({-1: -2, 0: 10, 1: 2}[args[0]]); return
+    if op == 'levelall': ann.setLevelAll(args[0]); return
+    ximg = ann.image(args[0])
+    if ximg is None: return
+    if op == 'label': ximg.label = args[1]
+    elif op == 'level': ximg.level = args[1]
+    elif op in ('viewat', 'midat'):
+        obj = objectAt(ximg, args[1])
+        if obj is not None: setattr(obj, op[:-2], args[2])
+    elif op in ('view', 'mid'):
+        for obj in ximg.objects:
+            if obj.id == args[1]: setattr(obj, op, args[2])
+    elif op == 'add':
+        id, view, label, mid, x1, y1, w, h = args[1:]
+        ximg.addObject(None, None, x1, y1, id)
+        obj = ximg.objects[-1]
+        obj.view, obj.label, obj.mid, obj.w, obj.h = view, label, mid, w, h
+    elif op == 'deleteat':
+        if objectAt(ximg, args[1]) is not None: ximg.deleteObjectAt(args[1])
+    elif op == 'delete': ximg.deleteObject(args[1])
+    elif op == 'deleteall': ximg.deleteAllObjects()
+
+# the base fingerprint and the records of a journal file; a torn last line
+# (crash while writing) is ignored
+def readJournal(fname):
+    ifs = open(fname)
+    lines = ifs.read().split('\n')
+    ifs.close()
+    header = lines[0].split()
+    if len(header) != 2 or header[0] != JOURNAL_MAGIC: return None, []
+    records = []
+    for line in lines[1:-1]:
+        tokens = line.split()
+        if not tokens: continue
+        try: records.append((tokens[0], tuple(int(t) for t in tokens[1:])))
+        except ValueError: break
+    return header[1], records
+
+def replayJournal(ann, fname):
+    base, records = readJournal(fname)
+    for op, args in records: applyEdit(ann, op, args)
+    return len(records)
+
+# the annotations of a list with the edits of its journals, read only: for a
+# list that another instance may be editing (see Sharding.mergeShards)
+def loadJournaledList(fname):
+    ann = Annotation()
+    ann.loadAnnotation(fname, FT_AUTO)
+    fp = listFingerprint(fname)
+    journalFile = fname + JOURNAL_SUFFIX
+    oldFile = journalFile + OLD_SUFFIX
+    if os.path.exists(oldFile) and readJournal(oldFile)[0] == fp: replayJournal(ann, oldFile)
+    if os.path.exists(journalFile):
+        base, records = readJournal(journalFile)
+        if base == fp or base == PENDING:
+            for op, args in records: applyEdit(ann, op, args)
+    return ann
+
+class Journal:
+    def __init__(self, ann, listFile=None):
+        self.ann = ann
+        self.listFile = str(listFile or ann.annfilename)
+        self.journalFile = self.listFile + JOURNAL_SUFFIX
+        self.oldFile = self.journalFile + OLD_SUFFIX
+        self.lock = threading.RLock()
+        self.ofs = None
+        self.numRecords = 0
+        self.firstRecordTime = None
+        self.thread = None
+        self.requested = False      # a compaction was requested while one was running
+        self.ftype = None
+        self.replay()
+        ann.addEditListener(self.onAnnotationEdit)
+
+    # replay the journals left by a previous session on the (just loaded) annotations
+    def replay(self):
+        fp = listFingerprint(self.listFile)
+        compactOld = False
+        if os.path.exists(self.oldFile):
+            base, records = readJournal(self.oldFile)
+            if base == fp:
+                # a compaction did not finish
+                for op, args in records: applyEdit(self.ann, op, args)
+                print 'Replayed', len(records), 'edits from', self.oldFile
+                compactOld = True
+            else:
+                os.remove(self.oldFile)
+        pending = False
+        if os.path.exists(self.journalFile):
+            base, records = readJournal(self.journalFile)
+            if base == fp or base == PENDING:
+                for op, args in records: applyEdit(self.ann, op, args)
+                if records: print 'Replayed', len(records), 'edits from', self.journalFile
+                self.numRecords = len(records)
+                if records: self.firstRecordTime = time.time()
+                pending = base == PENDING
+            else:
+                print 'Journal', self.journalFile, 'is older than the list, ignored'
+                self.newJournal(fp)
+        else:
+            self.newJournal(PENDING if compactOld else fp)
+        self.ofs = open(self.journalFile, 'a')
+        if compactOld: self.startCompaction()
+        elif pending: self.setBase(fp)
+
+    def newJournal(self, base):
+        tmpName = self.journalFile + '.tmp'
+        f = open(tmpName, 'w')
+        f.write('%s %s\n' % (JOURNAL_MAGIC, base))
+        f.close()
+        os.rename(tmpName, self.journalFile)
+
+    # rewrite the header of the journal, once the list it applies to is written
+    def setBase(self, base):
+        self.lock.acquire()
+        try:
+            if self.ofs: self.ofs.close()
+            ifs = open(self.journalFile)
+            ifs.readline()
+            body = ifs.read()
+            ifs.close()
+            tmpName = self.journalFile + '.tmp'
+            f = open(tmpName, 'w')
+            f.write('%s %s\n' % (JOURNAL_MAGIC, base))
+            f.write(body)
+            f.close()
+            os.rename(tmpName, self.journalFile)
+            self.ofs = open(self.journalFile, 'a')
+        finally:
+            self.lock.release()
+
+    # Annotation edit listener
+    def onAnnotationEdit(self, op, args):
+        if op in ('view', 'mid', 'delete'):
+            # by position: (index, id, [value,] position) -> (index, position, [value])
+            if args[-1] < 0: return
+            op, args = op + 'at', (args[0], args[-1]) + tuple(args[2:-1])
+        self.lock.acquire()
+        try:
+            if self.ofs is None: return
+            self.ofs.write(op + ' ' + ' '.join(str(int(a)) for a in args) + '\n')
+            self.ofs.flush()
+            if JOURNAL_FSYNC: os.fsync(self.ofs.fileno())
+            self.numRecords += 1
+            if self.firstRecordTime is None: self.firstRecordTime = time.time()
+            due = (self.numRecords >= JOURNAL_COMPACT_RECORDS or
+                   time.time() - self.firstRecordTime >= JOURNAL_COMPACT_SECONDS)
+        finally:
+            self.lock.release()
+        if due: self.compact()
+
+    # write the journaled edits into the list in the background; ftype: format
+    # of the list to write (default: the format of the list file)
+    def compact(self, ftype=None):
+        self.lock.acquire()
+        try:
+            if ftype is not None: self.ftype = ftype
+            if self.ofs is None: return
+            if self.thread is not None and self.thread.isAlive():
+                self.requested = True
+                return
+            if os.path.exists(self.oldFile):
+                # the last compaction failed, retry it first
+                self.startCompaction()
+                self.requested = True
+                return
+            if self.numRecords == 0 and ftype is None: return
+            # rotate: the current journal becomes the old one
+            self.ofs.close()
+            os.rename(self.journalFile, self.oldFile)
+            self.newJournal(PENDING)
+            self.ofs = open(self.journalFile, 'a')
+            self.numRecords, self.firstRecordTime = 0, None
+            self.startCompaction()
+        finally:
+            self.lock.release()
+
+    def startCompaction(self):
+        self.requested = False
+        self.thread = threading.Thread(target=self.compactionThread, name='journal compaction')
+        self.thread.start()
+
+    def compactionThread(self):
+        try:
+            self.compactOld()
+        except Exception, e:
+            print 'Journal compaction failed:', e
+            return
+        self.lock.acquire()
+        try:
+            again, self.requested = self.requested, False
+        finally:
+            self.lock.release()
+        if again: self.compact(self.ftype)
+
+    # the list with the edits of the old journal, written over the list
+    def compactOld(self):
+        t = time.time()
+        if isBinaryList(self.listFile): ftype = FT_BINARY
+        else: ftype = detectListFormat(self.listFile)[0]
+        ann = Annotation()
+        ann.loadAnnotation(self.listFile, FT_AUTO)
+        count = replayJournal(ann, self.oldFile)
+        if self.ftype is not None: ftype = self.ftype
+        elif ftype == FT_V1 and any(obj.mid for ximg in ann.images for obj in ximg.objects):
+            # do not drop the model IDs
+            ftype = FT_V2
+        tmpName = self.listFile + '.tmp'
+        # the images of a flat list keep their folders and names
+        if ftype == FT_FLAT: writeTextList(tmpName, ann.toParsedList(), FT_FLAT)
+        else: ann.saveAnnotationListAs(tmpName, ftype)
+        os.rename(tmpName, self.listFile)
+        os.remove(self.oldFile)
+        self.setBase(listFingerprint(self.listFile))
+        print 'Journal compacted into', self.listFile, '(%d edits, %.1f s)' % (count, time.time() - t)
+
+    def isCompacting(self):
+        return self.thread is not None and self.thread.isAlive()
+    def pendingEdits(self):
+        return self.numRecords
+
+    # stop journaling; waits for a running compaction, the journal is kept and
+    # replayed when the list is opened again
+    def close(self):
+        self.ann.removeEditListener(self.onAnnotationEdit)
+        # a compaction may start another one when it ends
+        while self.thread is not None and self.thread.isAlive():
+            self.thread.join()
+        self.lock.acquire()
+        try:
+            if self.ofs: self.ofs.close()
+            self.ofs = None
+        finally:
+            self.lock.release()
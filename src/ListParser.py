@@ -0,0 +1,173 @@
+# Bulk parser of annotation list files.
+# The format (ftype) is detected from the header and from the number of tokens
+# per line, the integer fields of the whole file are converted by numpy in one
+# pass. The result is column arrays, Annotation.loadAnnotationBulk turns them
+# into XImage/XObject instances.
+
+import re
+import itertools
+from Startup import lazyImport
+numpy = lazyImport('numpy')
+
+# list file types, as the ftype argument of Annotation.loadAnnotation
+FT_V0 = 0           # initial version: label N fname [x1 y1 w h]*
+FT_V1 = 1           # set level label N fname [view label x1 y1 w h]*
+FT_V2 = 2           # set level label N fname [view label mid x1 y1 w h]*
+FT_FLAT = 3         # folder name set level label N [mid view label x1 y1 w h]*, no header
+
+# image columns of ParsedList.images
+IC_SET, IC_LEVEL, IC_LABEL, IC_COUNT = range(4)
+# object columns of ParsedList.objects
+OC_MID, OC_VIEW, OC_LABEL, OC_X1, OC_Y1, OC_W, OC_H = range(7)
+
+# per format: line pattern (string fields, integer image fields, integer object
+# fields), the image columns of the integer image fields and the object columns
+# of the object fields
+FORMATS = {
+    FT_V0: (re.compile(r'^[ \t]*(\S+[ \t]+\S+)[ \t]+(\S+)(.*)$', re.M),
+            [IC_LABEL, IC_COUNT], [OC_X1, OC_Y1, OC_W, OC_H]),
+    FT_V1: (re.compile(r'^[ \t]*(\S+[ \t]+\S+[ \t]+\S+[ \t]+\S+)[ \t]+(\S+)(.*)$', re.M),
+            [IC_SET, IC_LEVEL, IC_LABEL, IC_COUNT], [OC_VIEW, OC_LABEL, OC_X1, OC_Y1, OC_W, OC_H]),
+    FT_V2: (re.compile(r'^[ \t]*(\S+[ \t]+\S+[ \t]+\S+[ \t]+\S+)[ \t]+(\S+)(.*)$', re.M),
+            [IC_SET, IC_LEVEL, IC_LABEL, IC_COUNT], [OC_VIEW, OC_LABEL, OC_MID, OC_X1, OC_Y1, OC_W, OC_H]),
+    FT_FLAT: (re.compile(r'^[ \t]*(\S+)[ \t]+(\S+)[ \t]+(\S+[ \t]+\S+[ \t]+\S+[ \t]+\S+)(.*)$', re.M),
+            [IC_SET, IC_LEVEL, IC_LABEL, IC_COUNT], [OC_MID, OC_VIEW, OC_LABEL, OC_X1, OC_Y1, OC_W, OC_H]),
+}
+# defaults of the columns missing in a format, as in XImage and XObject:
+# set S0, level L0, label LSKIP; mid 0, view V0, label LPOS
+IMAGE_DEFAULTS = (0, 0, 0, 0)
+OBJECT_DEFAULTS = (0, 0, 1, 0, 0, 0, 0)
+
+# lines looked at to detect the format
+DETECT_LINES = 1000
+
+# number of header lines of an annotation list file
+HEADER_LINES = 4
+
+# read the header (className subclassName / dirPath folder / annotationDir / number of images)
+def readListHeader(ifs):
+    className, subclassName = ifs.readline().split()
+    dirPath, folder = ifs.readline().split()
+    annotationDir = ifs.readline().split()[0]
+    numImages = int(ifs.readline())
+    return className, subclassName, dirPath, folder, annotationDir, numImages
+
+def isInt(token):
+    try: int(token)
+    except ValueError: return False
+    return True
+
+# formats a line of tokens can be in, from the number of tokens and the object count
+def lineFormats(tokens, header):
+    if not header:
+        if len(tokens) >= 6 and isInt(tokens[5]) and len(tokens) == 6 + 7*int(tokens[5]): return set([FT_FLAT])
+        return set()
+    ftypes = set()
+    if len(tokens) >= 3 and isInt(tokens[1]) and len(tokens) == 3 + 4*int(tokens[1]): ftypes.add(FT_V0)
+    if len(tokens) >= 5 and isInt(tokens[3]):
+        count = int(tokens[3])
+        if len(tokens) == 5 + 6*count: ftypes.add(FT_V1)
+        if len(tokens) == 5 + 7*count: ftypes.add(FT_V2)
+    return ftypes
+
+def hasHeader(lines):
+    if len(lines) < HEADER_LINES: return False
+    tokens = [line.split() for line in lines[:HEADER_LINES]]
+    return (len(tokens[0]) == 2 and len(tokens[1]) == 2 and len(tokens[2]) >= 1
+            and len(tokens[3]) == 1 and isInt(tokens[3][0]))
+
+# detect the format of a list file: returns (ftype, number of header lines).
+# Lines without objects fit both FT_V1 and FT_V2: the lines are read beyond
+# DETECT_LINES until one tells them apart, FT_V1 if none does
+def detectListFormat(fname):
+    ifs = open(fname)
+    try:
+        lines = []
+        for line in ifs:
+            lines.append(line)
+            if len(lines) >= HEADER_LINES: break
+        header = hasHeader(lines)
+        skip = HEADER_LINES if header else 0
+        candidates = set([FT_V0, FT_V1, FT_V2]) if header else set([FT_FLAT])
+        undecided = True
+        scanned = 0
+        for line in itertools.chain(lines[skip:], ifs):
+            tokens = line.split()
+            if not tokens: continue
+            candidates &= lineFormats(tokens, header)
+            undecided = False
+            scanned += 1
+            if not candidates: break
+            if scanned >= DETECT_LINES and not (FT_V1 in candidates and FT_V2 in candidates): break
+    finally:
+        ifs.close()
+    if not candidates:
+        raise ValueError('%s: unknown annotation list format' % fname)
+    if undecided or (FT_V1 in candidates and FT_V2 in candidates): return (FT_V1 if header else FT_FLAT), skip
+    return max(candidates), skip
+
+# the contents of a list file as arrays
+class ParsedList:
+    def __init__(self, ftype):
+        self.ftype = ftype
+        self.className, self.subclassName = "none", "none"
+        self.dirPath, self.folder = "./", "none"
+        self.annotationDir = self.dirPath + "annotation/"
+        self.folders = None     # per image, flat format only
+        self.names = []         # per image file name
+        self.images = numpy.zeros((0, 4), numpy.int32)     # per image: IC_* columns
+        self.objects = numpy.zeros((0, 7), numpy.int32)    # per object: OC_* columns, in image order
+        self.offsets = numpy.zeros(1, numpy.int64)         # objects of image i: offsets[i]:offsets[i+1]
+
+    def numImages(self):
+        return len(self.names)
+    def numObjects(self):
+        return len(self.objects)
+
+# integer fields of a list of strings, in one pass
+def toInts(strings, ncols):
+    values = numpy.fromstring(' '.join(strings), dtype=numpy.int32, sep=' ')
+    if len(values) % ncols: raise ValueError('malformed annotation list')
+    return values.reshape(-1, ncols)
+
+# parse a whole list file; ftype None: detect the format
+def parseListFile(fname, ftype=None):
+    if ftype is None: ftype, skip = detectListFormat(fname)
+    else: skip = 0 if ftype == FT_FLAT else HEADER_LINES
+    result = ParsedList(ftype)
+    ifs = open(fname)
+    try:
+        if skip:
+            (result.className, result.subclassName, result.dirPath, result.folder,
+             result.annotationDir, numImages) = readListHeader(ifs)
+        data = ifs.read()
+    finally:
+        ifs.close()
+    pattern, icols, ocols = FORMATS[ftype]
+    rows = pattern.findall(data)
+    del data
+    if ftype == FT_FLAT:
+        result.folders = [r[0] for r in rows]
+        result.names = [r[1] for r in rows]
+        heads, tails = [r[2] for r in rows], [r[3] for r in rows]
+    else:
+        result.names = [r[1] for r in rows]
+        heads, tails = [r[0] for r in rows], [r[2] for r in rows]
+    del rows
+    nimg = len(result.names)
+    images = numpy.empty((nimg, 4), numpy.int32)
+    images[:] = IMAGE_DEFAULTS
+    images[:, icols] = toInts(heads, len(icols)) if nimg else numpy.zeros((0, len(icols)))
+    del heads
+    values = toInts(tails, len(ocols))
+    del tails
+    counts = images[:, IC_COUNT]
+    if counts.sum() != len(values):
+        raise ValueError('%s: object counts do not match the number of objects' % fname)
+    objects = numpy.empty((len(values), 7), numpy.int32)
+    objects[:] = OBJECT_DEFAULTS
+    objects[:, ocols] = values
+    result.images, result.objects = images, objects
+    result.offsets = numpy.zeros(nimg + 1, numpy.int64)
+    numpy.cumsum(counts, out=result.offsets[1:])
+    return result
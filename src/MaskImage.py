@@ -0,0 +1,74 @@
+# Object mask images: 8-bit (alpha channel) QImages, numpy views over them,
+# MBR computation and run-length encoding.
+
+from Startup import lazyImport
+numpy = lazyImport('numpy')
+from PyQt4.QtGui import *
+
+# color table of the 8-bit (alpha channel) object masks
+GRAY_TABLE = [qRgb(i, i, i) for i in range(256)]
+
+# convert a QImage to a numpy array without copying the pixel data;
+# the array is a (read-only) view over the image buffer, so it is only valid
+# as long as the QImage is alive and not modified.
+# 8-bit images give an (h, w) uint8 array, 32-bit images an (h, w) uint32 array
+# with writable=True the array can be used to modify the image in place
+def qimageToNumpy(qimage, writable=False):
+    w, h, bpl = qimage.width(), qimage.height(), qimage.bytesPerLine()
+    depth = qimage.depth()
+    if depth == 8: dtype = numpy.uint8
+    elif depth == 32: dtype = numpy.uint32
+    else: raise ValueError('Unsupported image depth: %d' % depth)
+    if writable:
+        ptr = qimage.bits()
+        ptr.setwriteable(True)
+    else: ptr = qimage.constBits()
+    ptr.setsize(bpl * h)
+    # rows are padded to 32-bit boundaries, drop the padding
+    return numpy.frombuffer(ptr, dtype).reshape(h, bpl * 8 // depth)[:, :w]
+
+# place a cropped 8-bit mask (as returned by QImage.alphaChannel()) at (x1, y1)
+# of an empty w x h mask
+def expandMask(cmask, x1, y1, w, h):
+    mask = QImage(w, h, QImage.Format_Indexed8)
+    mask.setColorTable(GRAY_TABLE)
+    mask.fill(0)
+    cw, ch = cmask.width(), cmask.height()
+    qimageToNumpy(mask, True)[y1:y1+ch, x1:x1+cw] = qimageToNumpy(cmask)
+    return mask
+
+# 8-bit mask image from a 2D uint8 array
+def numpyToMask(arr):
+    h, w = arr.shape
+    mask = QImage(w, h, QImage.Format_Indexed8)
+    mask.setColorTable(GRAY_TABLE)
+    qimageToNumpy(mask, True)[:, :] = arr
+    return mask
+
+# 8-bit mask of a mask image loaded from file
+def toMask8(image):
+    if image.depth() == 8: return image
+    if image.hasAlphaChannel(): return image.alphaChannel()
+    return image.convertToFormat(QImage.Format_Indexed8, GRAY_TABLE)
+
+# run-length encoding of a 2D uint8 array, row by row: (values, run lengths)
+def encodeRLE(arr):
+    flat = numpy.ascontiguousarray(arr).ravel()
+    if flat.size == 0: return numpy.zeros(0, numpy.uint8), numpy.zeros(0, numpy.uint32)
+    starts = numpy.concatenate(([0], numpy.flatnonzero(flat[1:] != flat[:-1]) + 1))
+    lengths = numpy.diff(numpy.append(starts, flat.size)).astype(numpy.uint32)
+    return flat[starts].copy(), lengths
+def decodeRLE(values, lengths, w, h):
+    return numpy.repeat(values, lengths).reshape(h, w)
+
+# minimum bounding rectangle (x1, y1, w, h) of the nonzero elements of a 2D array
+def getMBR_array(arr):
+    rows = numpy.flatnonzero(arr.any(axis=1))
+    if len(rows) == 0: return -1, -1, 1, 1
+    cols = numpy.flatnonzero(arr[rows[0]:rows[-1]+1].any(axis=0))
+    x1, y1, x2, y2 = int(cols[0]), int(rows[0]), int(cols[-1]), int(rows[-1])
+    return x1, y1, x2-x1+1, y2-y1+1
+
+def getMBR_numpy(qimage):
+    if not qimage: return -1, -1, 1, 1
+    return getMBR_array(qimageToNumpy(qimage))
@@ -0,0 +1,847 @@
+# Object masks in the annotation directory.
+#
+# Masks are stored either
+#  - one file per object, <image name>.<object index>.png, which is
+#     - legacy: a full-frame 8-bit mask of the size of the image, or
+#     - cropped: only the MBR of the object, with the offset of the crop and the
+#       size of the image stored as png text entries;
+#  - or one instance label map per image, <image name>.labels.png, in which
+#    each pixel holds the object index + 1 (0: background); the MBR and the
+#    mask value of each object are stored as png text entries;
+#  - or in a mask archive of the whole annotation directory: an append-only
+#    data file (masks.xra) of cropped mask pngs and an index (masks.xri) from
+#    (image name, object index) to the location of the png in the data file.
+# MASK_STORAGE selects what is written (STORE_FILES, STORE_LABELS, STORE_ARCHIVE)
+# in a directory without a mask archive; a directory with one is read and
+# written through it, and the archive store also reads the per-object files
+# and label maps, so that every mask is found. Per-object files are written cropped unless
+# MASK_FILE_CROPPED is False (older tools, XRanT/XRanT2, can only read
+# full-frame masks). A label map only represents masks exactly if they do not
+# overlap and each has a single mask value; other images are stored one file
+# per object.
+#
+# usage: python MaskStore.py migrate <annotation dir> [<annotation dir> ...]
+#        converts all full-frame mask files under the directories to cropped files
+#        python MaskStore.py files|labels|archive <annotation dir> [<annotation dir> ...]
+#        converts the masks to per-object files, label maps or the mask archive
+#        python MaskStore.py compact <annotation dir> [<annotation dir> ...]
+#        reclaims the space of superseded masks in the mask archive
+
+import os
+import re
+import sys
+import mmap
+import struct
+import time
+import threading
+import zlib
+from Startup import lazyImport
+numpy = lazyImport('numpy')
+from collections import OrderedDict
+from PyQt4.QtCore import *
+from PyQt4.QtGui import *
+from MaskImage import *
+
+# mask storage
+STORE_FILES, STORE_LABELS, STORE_ARCHIVE = 'files', 'labels', 'archive'
+MASK_STORAGE = STORE_FILES
+MASK_FILE_CROPPED = True
+
+# png text keys
+OFFSET_KEY = 'XRanT-offset'     # "x1 y1"
+FRAME_KEY = 'XRanT-frame'       # "width height"
+BOXES_KEY = 'XRanT-boxes'       # label maps: "x1 y1 w h value;..." per object, "-" for none
+
+# <image name>.<object index>.png
+MASK_FILE_RE = re.compile(r'^(.+)\.(\d+)\.png$')
+LABEL_MAP_SUFFIX = '.labels.png'
+
+# read a mask file: (8-bit mask, (x1, y1) or None, (width, height) or None);
+# offset and frame size are None for legacy full-frame files
+def readMaskFile(fname):
+    return decodeMaskImage(QImage(fname))
+
+def decodeMaskImage(image):
+    if image.isNull(): return None, None, None
+    offset = str(image.text(OFFSET_KEY)).split()
+    if len(offset) != 2:
+        return toMask8(image), None, None
+    return toMask8(image), (int(offset[0]), int(offset[1])), readFrameSize(image)
+
+def readFrameSize(image):
+    frame = str(image.text(FRAME_KEY)).split()
+    if len(frame) == 2: return (int(frame[0]), int(frame[1]))
+    return None
+
+# write a cropped mask located at (x1, y1) of a frameSize image; always PNG,
+# whatever the suffix of fname (migrateMaskFile writes a .tmp file)
+def writeMaskFile(fname, cmask, x1, y1, frameSize, cropped=None):
+    if cropped is None: cropped = MASK_FILE_CROPPED
+    if not cropped and frameSize is not None:
+        return expandMask(cmask, x1, y1, frameSize[0], frameSize[1]).save(fname, 'PNG')
+    data = croppedMaskPNG(cmask, x1, y1, frameSize)
+    if data is None: return croppedMaskImage(cmask, x1, y1, frameSize).save(fname, 'PNG')
+    try:
+        f = open(fname, 'wb')
+        try: f.write(data)
+        finally: f.close()
+    except IOError, e:
+        print 'Could not write', fname, ':', e
+        return False
+    return True
+
+# the cropped mask with its offset and the image size as text entries
+def croppedMaskImage(cmask, x1, y1, frameSize):
+    image = QImage(cmask)
+    image.setText(OFFSET_KEY, '%d %d' % (x1, y1))
+    if frameSize is not None:
+        image.setText(FRAME_KEY, '%d %d' % frameSize)
+    return image
+
+# zlib compression level of the mask pngs
+PNG_COMPRESSION = 6
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+
+def pngChunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+# 8-bit grayscale png of a 2D uint8 array, with (key, value) text entries.
+# Most of the time goes to zlib, which releases the GIL: masks are encoded in
+# parallel by the flush workers (see saveMasksParallel)
+def grayPNG(arr, texts=()):
+    h, w = arr.shape
+    rows = numpy.zeros((h, w + 1), numpy.uint8)     # each row starts with filter type 0 (none)
+    rows[:, 1:] = arr
+    data = PNG_SIGNATURE + pngChunk('IHDR', struct.pack('>IIBBBBB', w, h, 8, 0, 0, 0, 0))
+    for key, value in texts: data += pngChunk('tEXt', key + '\0' + value)
+    data += pngChunk('IDAT', zlib.compress(rows.tostring(), PNG_COMPRESSION))
+    return data + pngChunk('IEND', '')
+
+# png data of a cropped mask with its offset and the image size as text
+# entries, as croppedMaskImage; None if the mask is not an 8-bit gray image
+def croppedMaskPNG(cmask, x1, y1, frameSize):
+    if cmask.depth() != 8 or cmask.colorTable() != GRAY_TABLE: return None
+    texts = [(OFFSET_KEY, '%d %d' % (x1, y1))]
+    if frameSize is not None: texts.append((FRAME_KEY, '%d %d' % frameSize))
+    return grayPNG(qimageToNumpy(cmask), texts)
+
+# png data of a cropped mask, as written to the mask archive
+def encodeMaskPNG(cmask, x1, y1, frameSize):
+    data = croppedMaskPNG(cmask, x1, y1, frameSize)
+    if data is not None: return data
+    data = QByteArray()
+    buf = QBuffer(data)
+    buf.open(QIODevice.WriteOnly)
+    ok = croppedMaskImage(cmask, x1, y1, frameSize).save(buf, 'PNG')
+    buf.close()
+    if not ok: return None
+    return str(data)
+
+# decoded instance label map of one image
+class LabelMap:
+    def __init__(self, labels, offset, frameSize, boxes):
+        self.labels = labels            # 2D uint8 array, object index + 1
+        self.offset = offset            # (x, y) of the labels array in the image
+        self.frameSize = frameSize
+        self.boxes = boxes              # per object (x1, y1, w, h, value) or None
+    def numObjects(self):
+        return len(self.boxes)
+    def has(self, i):
+        return i < len(self.boxes) and self.boxes[i] is not None
+    # the cropped mask of object i, as it was saved
+    def mask(self, i):
+        x, y, w, h, v = self.boxes[i]
+        ox, oy = self.offset
+        sub = self.labels[y-oy:y-oy+h, x-ox:x-ox+w]
+        return numpyToMask(numpy.where(sub == i+1, v, 0).astype(numpy.uint8))
+
+# label map of the objects with a mask to be stored (the others are left out),
+# None if the masks cannot be represented exactly
+def buildLabelMap(objects):
+    if len(objects) > 255: return None
+    boxes, masks = [], []
+    for obj in objects:
+        cmask = None
+        if obj.saveMask or obj.maskSource is not None: cmask = obj.cmask
+        if cmask is None:
+            boxes.append(None); masks.append(None)
+            continue
+        arr = qimageToNumpy(cmask)
+        values = numpy.unique(arr[arr != 0])
+        if len(values) > 1: return None         # soft edges / several mask values
+        value = int(values[0]) if len(values) == 1 else 255
+        boxes.append((obj.x1, obj.y1, obj.w, obj.h, value))
+        masks.append(arr)
+    used = [b for b in boxes if b is not None]
+    if len(used) == 0: return LabelMap(numpy.zeros((0, 0), numpy.uint8), (0, 0), None, boxes)
+    x0, y0 = min(b[0] for b in used), min(b[1] for b in used)
+    x2, y2 = max(b[0]+b[2] for b in used), max(b[1]+b[3] for b in used)
+    labels = numpy.zeros((y2-y0, x2-x0), numpy.uint8)
+    for i in range(len(boxes)):
+        if boxes[i] is None: continue
+        x, y, w, h, v = boxes[i]
+        sub = labels[y-y0:y-y0+h, x-x0:x-x0+w]
+        fg = masks[i] != 0
+        if (sub[fg] != 0).any(): return None    # overlapping objects
+        sub[fg] = i+1
+    frameSize = None
+    for obj in objects:
+        if obj.frameSize is not None: frameSize = obj.frameSize; break
+    return LabelMap(labels, (x0, y0), frameSize, boxes)
+
+def writeLabelMap(fname, lmap):
+    image = numpyToMask(lmap.labels)
+    image.setText(OFFSET_KEY, '%d %d' % lmap.offset)
+    if lmap.frameSize is not None:
+        image.setText(FRAME_KEY, '%d %d' % lmap.frameSize)
+    boxes = []
+    for b in lmap.boxes:
+        if b is None: boxes.append('-')
+        else: boxes.append('%d %d %d %d %d' % b)
+    image.setText(BOXES_KEY, ';'.join(boxes))
+    return image.save(fname, 'PNG')
+
+def readLabelMap(fname):
+    image = QImage(fname)
+    if image.isNull(): return None
+    labels = numpy.array(qimageToNumpy(toMask8(image)))
+    offset = [int(t) for t in str(image.text(OFFSET_KEY)).split()]
+    boxes = []
+    for b in str(image.text(BOXES_KEY)).split(';'):
+        if b == '-' or len(b) == 0: boxes.append(None)
+        else: boxes.append(tuple(int(t) for t in b.split()))
+    return LabelMap(labels, tuple(offset), readFrameSize(image), boxes)
+
+# the directory modification time is checked at most this often (seconds)
+MANIFEST_CHECK_INTERVAL = 1.0
+
+# the file names in a directory, from one directory scan; the scan is repeated
+# when the directory modification time changes (files added or removed).
+# Changes made through add()/remove() are applied without a new scan.
+class DirManifest:
+    def __init__(self, dirPath):
+        self.dirPath = dirPath
+        self.names = set()
+        self.mtime = None
+        self.checked = 0
+        self.scans = 0          # incremented on every scan, to invalidate derived caches
+        self.lock = threading.RLock()
+
+    def dirMTime(self):
+        try: return os.stat(self.dirPath).st_mtime
+        except OSError: return None
+
+    def refresh(self, force=False):
+        self.lock.acquire()
+        try:
+            now = time.time()
+            if not force and self.mtime is not None and now - self.checked < MANIFEST_CHECK_INTERVAL: return
+            self.checked = now
+            mtime = self.dirMTime()
+            if not force and mtime == self.mtime and mtime is not None: return
+            try: self.names = set(os.listdir(self.dirPath))
+            except OSError: self.names = set()
+            self.mtime = mtime
+            self.scans += 1
+        finally:
+            self.lock.release()
+
+    def has(self, name):
+        self.refresh()
+        return name in self.names
+
+    # record files created/removed by us, and take the new directory time as known
+    def add(self, name):
+        self.lock.acquire()
+        try:
+            self.refresh()
+            self.names.add(name)
+            self.mtime = self.dirMTime()
+        finally:
+            self.lock.release()
+    def remove(self, name):
+        self.lock.acquire()
+        try:
+            self.refresh()
+            self.names.discard(name)
+            self.mtime = self.dirMTime()
+        finally:
+            self.lock.release()
+
+# manifests by directory
+manifests = {}
+def dirManifest(dirPath):
+    if dirPath not in manifests: manifests[dirPath] = DirManifest(dirPath)
+    return manifests[dirPath]
+
+# the masks of one annotation directory; reads per-object files and label maps,
+# writes label maps if labelMaps is True (where exact), otherwise per-object files.
+# Existence checks use the directory manifest, not one stat per file.
+class MaskFileStore:
+    def __init__(self, annotationDir, labelMaps=False, cacheSize=4):
+        self.annotationDir = annotationDir
+        self.labelMaps = labelMaps
+        self.cacheSize = cacheSize
+        self.labelCache = OrderedDict()     # image name -> LabelMap or None (no label map)
+        self.manifest = dirManifest(annotationDir)
+        self.manifestScans = None
+        self.lock = threading.RLock()       # images are saved in parallel, see saveMasksParallel
+
+    def maskName(self, imgName, i):
+        return imgName + '.' + str(i) + '.png'
+    def maskFile(self, imgName, i):
+        return self.annotationDir + self.maskName(imgName, i)
+    def labelFile(self, imgName):
+        return self.annotationDir + imgName + LABEL_MAP_SUFFIX
+
+    # decoded label map of the image (one decode for all its objects), None if there is none
+    def labelMap(self, imgName):
+        self.manifest.refresh()
+        self.lock.acquire()
+        try:
+            if self.manifestScans != self.manifest.scans:
+                # the directory changed
+                self.labelCache.clear()
+                self.manifestScans = self.manifest.scans
+            if imgName in self.labelCache: return self.cacheLabelMap(imgName, self.labelCache[imgName])
+        finally:
+            self.lock.release()
+        lmap = None
+        if self.manifest.has(imgName + LABEL_MAP_SUFFIX): lmap = readLabelMap(self.labelFile(imgName))
+        return self.cacheLabelMap(imgName, lmap)
+    def cacheLabelMap(self, imgName, lmap):
+        self.lock.acquire()
+        try:
+            self.labelCache.pop(imgName, None)
+            self.labelCache[imgName] = lmap
+            while len(self.labelCache) > self.cacheSize:
+                self.labelCache.popitem(last=False)
+        finally:
+            self.lock.release()
+        return lmap
+
+    def exists(self, imgName, i):
+        lmap = self.labelMap(imgName)
+        if lmap is not None: return lmap.has(i)
+        return self.manifest.has(self.maskName(imgName, i))
+    # (8-bit mask, (x1, y1) or None, (width, height) or None), see readMaskFile
+    def read(self, imgName, i):
+        lmap = self.labelMap(imgName)
+        if lmap is None: return readMaskFile(self.maskFile(imgName, i))
+        if not lmap.has(i): return None, None, None
+        b = lmap.boxes[i]
+        return lmap.mask(i), (b[0], b[1]), lmap.frameSize
+
+    # remove the per-object mask files from object index i on
+    def removeFrom(self, imgName, i):
+        while self.manifest.has(self.maskName(imgName, i)):
+            self.removeFile(self.maskName(imgName, i))
+            i += 1
+    def removeLabelMap(self, imgName):
+        name = imgName + LABEL_MAP_SUFFIX
+        if self.manifest.has(name): self.removeFile(name)
+        self.cacheLabelMap(imgName, None)
+    def removeFile(self, name):
+        try: os.remove(self.annotationDir + name)
+        except OSError, e: print 'Could not remove', self.annotationDir + name, ':', e
+        self.manifest.remove(name)
+
+    # save the masks of the image that changed, and remove the unused ones
+    def saveImageMasks(self, ximage):
+        imgName = os.path.splitext(ximage.fname)[0]
+        objects = ximage.objects
+        lmap = self.labelMap(imgName)
+        # switching between label map and per-object files rewrites all masks
+        rewrite = (lmap is not None) != self.labelMaps
+        # reload evicted masks first, objects may be saved over each other's masks
+        for i in range(len(objects)):
+            obj = objects[i]
+            if obj.maskSource is None and not obj.saveMask and (self.labelMaps or lmap is not None) and self.exists(imgName, i):
+                # never loaded: its stored mask is replaced with the others
+                obj.loadMaskFrom(self, imgName, i)
+            if obj.maskSource is not None and (rewrite or obj.maskSource != (self, imgName, i)):
+                # stored elsewhere, or the object index changed (objects before it were deleted)
+                obj.cmask
+                obj.saveMask = True
+            elif obj.saveMask: obj.cmask
+        if self.labelMaps:
+            if lmap is not None and lmap.numObjects() == len(objects) and not any(obj.saveMask for obj in objects):
+                return
+            if self.saveLabelMap(imgName, objects): return
+            print 'Masks of', imgName, 'overlap or have soft edges, saved one file per object'
+            for obj in objects:
+                if obj.maskSource is not None: obj.saveMask = True
+        for i in range(len(objects)):
+            obj = objects[i]
+            if not obj.saveMask or obj.cmask is None: continue
+            fname = self.maskFile(imgName, i)
+            if writeMaskFile(fname, obj.cmask, obj.x1, obj.y1, obj.frameSize):
+                self.manifest.add(self.maskName(imgName, i))
+                print 'Object mask saved to ', fname
+                obj.maskSource = (self, imgName, i)
+                obj.saveMask = False
+            else: print 'Error saving object mask ', obj.id, ' to ', fname
+        self.removeFrom(imgName, len(objects))
+        if lmap is not None: self.removeLabelMap(imgName)
+
+    def saveLabelMap(self, imgName, objects):
+        lmap = buildLabelMap(objects)
+        if lmap is None: return False
+        if len([b for b in lmap.boxes if b is not None]) == 0:
+            self.removeLabelMap(imgName)
+        else:
+            fname = self.labelFile(imgName)
+            if not writeLabelMap(fname, lmap):
+                print 'Error saving label map to ', fname
+                return False
+            self.manifest.add(imgName + LABEL_MAP_SUFFIX)
+            print 'Label map saved to ', fname
+            self.cacheLabelMap(imgName, lmap)
+        for i in range(len(objects)):
+            if lmap.boxes[i] is not None:
+                objects[i].maskSource = (self, imgName, i)
+                objects[i].saveMask = False
+        self.removeFrom(imgName, 0)
+        return True
+
+# archive files
+ARCHIVE_DATA, ARCHIVE_INDEX = 'masks.xra', 'masks.xri'
+ARCHIVE_VERSION = 1
+# file header: magic, version, token (the index belongs to the data file with the same token)
+HEADER = struct.Struct('<4sI16s')
+DATA_MAGIC, INDEX_MAGIC = 'XRMD', 'XRMI'
+# data record: magic, name length, object index, png length; followed by name and png
+# (a removed mask: png length DELETED and no png, so that rebuilding the index
+# from the data does not bring it back)
+RECORD = struct.Struct('<4sHII')
+RECORD_MAGIC = 'XRMR'
+# index record: png offset, png length (DELETED: removed, the offset is the end
+# of the removal record), object index, name length; followed by name
+ENTRY = struct.Struct('<QIIH')
+DELETED = 0xFFFFFFFF
+
+# the masks of one annotation directory in a single append-only data file,
+# read through mmap; masks not in the archive are read from the loose files
+class MaskArchiveStore:
+    def __init__(self, annotationDir):
+        self.annotationDir = annotationDir
+        self.dataFile = annotationDir + ARCHIVE_DATA
+        self.indexFile = annotationDir + ARCHIVE_INDEX
+        self.files = MaskFileStore(annotationDir)
+        self.lock = threading.RLock()
+        self.entries = {}       # (image name, object index) -> (offset, length) of the png data
+        self.counts = {}        # image name -> number of object slots used
+        self.data = None        # mmap of the data file
+        self.dataFileObj = None
+        self.token = None
+        self.open()
+
+    def open(self):
+        self.entries, self.counts = {}, {}
+        if not os.path.exists(self.dataFile): return
+        f = open(self.dataFile, 'rb')
+        magic, version, self.token = HEADER.unpack(f.read(HEADER.size))
+        f.close()
+        if magic != DATA_MAGIC: raise IOError('Not a mask archive: ' + self.dataFile)
+        end = None
+        if os.path.exists(self.indexFile):
+            end = self.readIndex()
+        if end is None:
+            print 'Mask archive index missing or does not match the data, rebuilding', self.indexFile
+            self.entries, self.counts = {}, {}
+            f = open(self.indexFile, 'wb')
+            f.write(HEADER.pack(INDEX_MAGIC, ARCHIVE_VERSION, self.token))
+            f.close()
+            self.rebuildIndex(HEADER.size)
+        else:
+            # masks appended to the data after the last index write
+            self.rebuildIndex(end)
+
+    # read the index, returns the end of the indexed data (None if the index does not match the data)
+    def readIndex(self):
+        f = open(self.indexFile, 'rb')
+        try:
+            if os.path.getsize(self.indexFile) < HEADER.size: return None
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        magic, version, token = HEADER.unpack(m[:HEADER.size])
+        if magic != INDEX_MAGIC or token != self.token:
+            m.close()
+            return None
+        pos, end, size = HEADER.size, HEADER.size, len(m)
+        while pos + ENTRY.size <= size:
+            offset, length, i, n = ENTRY.unpack(m[pos:pos+ENTRY.size])
+            if pos + ENTRY.size + n > size: break
+            name = m[pos+ENTRY.size:pos+ENTRY.size+n]
+            pos += ENTRY.size + n
+            self.setEntry(name, i, offset, length)
+            end = max(end, offset if length == DELETED else offset + length)
+        m.close()
+        return end
+
+    # index the data records from pos on; a partially written record at the end is cut off
+    def rebuildIndex(self, pos):
+        size = os.path.getsize(self.dataFile)
+        if pos >= size: return
+        m = self.mapped(size)
+        entries = []
+        while pos + RECORD.size <= size:
+            magic, n, i, length = RECORD.unpack(m[pos:pos+RECORD.size])
+            stored = 0 if length == DELETED else length
+            if magic != RECORD_MAGIC or pos + RECORD.size + n + stored > size: break
+            name = m[pos+RECORD.size:pos+RECORD.size+n]
+            offset = pos + RECORD.size + n
+            self.setEntry(name, i, offset, length)
+            entries.append((name, i, offset, length))
+            pos = offset + stored
+        if pos < size:
+            print 'Cutting off incomplete mask archive record at', pos
+            self.closeData()
+            f = open(self.dataFile, 'r+b')
+            f.truncate(pos)
+            f.close()
+        self.appendIndex(entries)
+
+    def setEntry(self, name, i, offset, length):
+        if length == DELETED:
+            self.entries.pop((name, i), None)
+        else:
+            self.entries[(name, i)] = (offset, length)
+            self.counts[name] = max(self.counts.get(name, 0), i+1)
+
+    # the data file, mapped at least up to end
+    def mapped(self, end):
+        if self.data is None or len(self.data) < end:
+            self.closeData()
+            self.dataFileObj = open(self.dataFile, 'rb')
+            self.data = mmap.mmap(self.dataFileObj.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.data
+    def closeData(self):
+        if self.data is not None: self.data.close()
+        if self.dataFileObj is not None: self.dataFileObj.close()
+        self.data, self.dataFileObj = None, None
+
+    def create(self):
+        self.token = os.urandom(16)
+        f = open(self.dataFile, 'wb')
+        f.write(HEADER.pack(DATA_MAGIC, ARCHIVE_VERSION, self.token))
+        f.close()
+        f = open(self.indexFile, 'wb')
+        f.write(HEADER.pack(INDEX_MAGIC, ARCHIVE_VERSION, self.token))
+        f.close()
+
+    def appendIndex(self, entries):
+        if len(entries) == 0: return
+        f = open(self.indexFile, 'ab')
+        for name, i, offset, length in entries:
+            f.write(ENTRY.pack(offset, length, i, len(name)) + name)
+        f.close()
+
+    # append masks to the archive: list of (image name, object index, png data or None to remove)
+    def write(self, records):
+        if len(records) == 0: return
+        self.lock.acquire()
+        try:
+            if self.token is None or not os.path.exists(self.dataFile): self.create()
+            f = open(self.dataFile, 'ab')
+            f.seek(0, 2)
+            pos = f.tell()
+            entries = []
+            for name, i, png in records:
+                if png is None:
+                    f.write(RECORD.pack(RECORD_MAGIC, len(name), i, DELETED) + name)
+                    pos += RECORD.size + len(name)
+                    entries.append((name, i, pos, DELETED))
+                    continue
+                f.write(RECORD.pack(RECORD_MAGIC, len(name), i, len(png)) + name + png)
+                offset = pos + RECORD.size + len(name)
+                entries.append((name, i, offset, len(png)))
+                pos = offset + len(png)
+            f.close()
+            # the index is written after the data; if this does not happen, the
+            # records are indexed again the next time the archive is opened
+            self.appendIndex(entries)
+            for e in entries: self.setEntry(*e)
+        finally:
+            self.lock.release()
+
+    def exists(self, imgName, i):
+        if (imgName, i) in self.entries: return True
+        return self.files.exists(imgName, i)
+    def read(self, imgName, i):
+        self.lock.acquire()
+        try:
+            e = self.entries.get((imgName, i))
+            if e is None: return self.files.read(imgName, i)
+            offset, length = e
+            png = self.mapped(offset + length)[offset:offset+length]
+        finally:
+            self.lock.release()
+        return decodeMaskImage(QImage.fromData(png, 'PNG'))
+
+    # save the masks of the image that changed, and remove the unused ones
+    def saveImageMasks(self, ximage):
+        imgName = os.path.splitext(ximage.fname)[0]
+        objects = ximage.objects
+        for i in range(len(objects)):
+            obj = objects[i]
+            archived = (imgName, i) in self.entries
+            if obj.maskSource is None and not obj.saveMask and not archived and self.files.exists(imgName, i):
+                # a loose mask never loaded: moved into the archive with the others
+                obj.loadMaskFrom(self.files, imgName, i)
+            if obj.maskSource is not None and (obj.maskSource != (self, imgName, i) or not archived):
+                # loose file, or the object index changed (objects before it were deleted)
+                obj.cmask
+                obj.saveMask = True
+            elif obj.saveMask: obj.cmask
+        records, saved = [], []
+        for i in range(len(objects)):
+            obj = objects[i]
+            if not obj.saveMask or obj.cmask is None: continue
+            png = encodeMaskPNG(obj.cmask, obj.x1, obj.y1, obj.frameSize)
+            if png is None: print 'Error encoding object mask ', obj.id; continue
+            records.append((imgName, i, png))
+            saved.append(i)
+        for i in range(len(objects), self.counts.get(imgName, 0)):
+            if (imgName, i) in self.entries: records.append((imgName, i, None))
+        self.write(records)
+        for i in saved:
+            objects[i].maskSource = (self, imgName, i)
+            objects[i].saveMask = False
+        if len(saved) > 0: print 'Saved', len(saved), 'object masks of', imgName, 'to', self.dataFile
+        # the archive replaces the loose files of the image
+        self.files.removeFrom(imgName, 0)
+        self.files.removeLabelMap(imgName)
+
+    # bytes of the data file used by superseded or removed masks
+    def garbage(self):
+        if not os.path.exists(self.dataFile): return 0
+        used = HEADER.size
+        for (name, i), (offset, length) in self.entries.items():
+            used += RECORD.size + len(name) + length
+        return os.path.getsize(self.dataFile) - used
+
+    # rewrite the archive with the current masks only
+    def compact(self):
+        self.lock.acquire()
+        try:
+            if not os.path.exists(self.dataFile): return 0
+            before = os.path.getsize(self.dataFile)
+            token = os.urandom(16)
+            live = sorted(self.entries.items(), key=lambda e: e[1][0])
+            m = self.mapped(before)
+            df = open(self.dataFile + '.new', 'wb')
+            df.write(HEADER.pack(DATA_MAGIC, ARCHIVE_VERSION, token))
+            xf = open(self.indexFile + '.new', 'wb')
+            xf.write(HEADER.pack(INDEX_MAGIC, ARCHIVE_VERSION, token))
+            pos = HEADER.size
+            entries = {}
+            for (name, i), (offset, length) in live:
+                df.write(RECORD.pack(RECORD_MAGIC, len(name), i, length) + name)
+                df.write(m[offset:offset+length])
+                noffset = pos + RECORD.size + len(name)
+                xf.write(ENTRY.pack(noffset, length, i, len(name)) + name)
+                entries[(name, i)] = (noffset, length)
+                pos = noffset + length
+            for f in (df, xf):
+                f.flush()
+                os.fsync(f.fileno())
+                f.close()
+            self.closeData()
+            # data first: until the index is replaced as well, the tokens differ
+            # and the index is rebuilt from the data when the archive is opened
+            for name in (self.dataFile, self.indexFile):
+                if os.name == 'nt' and os.path.exists(name): os.remove(name)
+                os.rename(name + '.new', name)
+            self.token = token
+            self.entries = entries
+            print 'Mask archive compacted:', before, '->', pos, 'bytes'
+            return before - pos
+        finally:
+            self.lock.release()
+
+# threads that write masks in saveMasksParallel (0: one per core)
+MASK_FLUSH_THREADS = 0
+
+# saves the masks of one image in a worker of the flush pool
+class MaskSaveTask(QRunnable):
+    def __init__(self, flush, store, ximage):
+        super(MaskSaveTask, self).__init__()
+        self.flush = flush
+        self.store = store
+        self.ximage = ximage
+    def run(self):
+        objects = list(self.ximage.objects)
+        dirty = [obj for obj in objects if obj.saveMask]
+        try:
+            self.store.saveImageMasks(self.ximage)
+            ok = not any(obj.saveMask and obj.hasMask() for obj in objects)
+        except Exception, e:
+            print 'Error saving the masks of', self.ximage.fname, ':', e
+            ok = False
+        self.flush.done(self.ximage, len([obj for obj in dirty if not obj.saveMask]), ok)
+
+# one run of saveMasksParallel; progress(images done, images, masks saved) is
+# called from the workers after each image
+class MaskFlush:
+    def __init__(self, total, progress=None):
+        self.total = total
+        self.progress = progress
+        self.lock = threading.Lock()
+        self.images = 0         # images done
+        self.saved = 0          # masks written
+        self.failed = []        # images whose masks could not all be written
+        self.start = time.time()
+        self.seconds = 0.0
+    def done(self, ximage, saved, ok):
+        self.lock.acquire()
+        try:
+            self.images += 1
+            self.saved += saved
+            if not ok: self.failed.append(ximage)
+            self.seconds = time.time() - self.start
+            images, saved = self.images, self.saved
+        finally:
+            self.lock.release()
+        if self.progress: self.progress(images, self.total, saved)
+    def rate(self):
+        return self.saved / self.seconds if self.seconds > 0 else 0.0
+
+# save the masks of many images on a pool of numThreads threads, one image per
+# task (the masks of an image are renumbered and removed together); returns
+# the MaskFlush
+def saveMasksParallel(annotationDir, images, numThreads=None, progress=None, storage=None):
+    flush = MaskFlush(len(images), progress)
+    if len(images) == 0: return flush
+    if not os.path.isdir(annotationDir): os.makedirs(annotationDir)
+    store = maskStore(annotationDir, storage)
+    if numThreads is None: numThreads = MASK_FLUSH_THREADS
+    if numThreads <= 0: numThreads = QThread.idealThreadCount()
+    pool = QThreadPool()
+    pool.setMaxThreadCount(max(1, min(numThreads, len(images))))
+    tasks = [MaskSaveTask(flush, store, ximage) for ximage in images]
+    for task in tasks:
+        task.setAutoDelete(False)
+        pool.start(task)
+    pool.waitForDone()
+    print 'Saved', flush.saved, 'masks of', len(images), 'images in %.1f s (%d masks/s, %d threads)' % (flush.seconds, flush.rate(), pool.maxThreadCount())
+    return flush
+
+# mask stores by (annotation directory, storage); by default the archive if
+# the directory has one (it reads all the masks), otherwise MASK_STORAGE
+stores = {}
+def maskStore(annotationDir, storage=None):
+    if storage is None:
+        storage = STORE_ARCHIVE if os.path.exists(annotationDir + ARCHIVE_DATA) else MASK_STORAGE
+    key = (annotationDir, storage)
+    if key not in stores:
+        if storage == STORE_ARCHIVE: stores[key] = MaskArchiveStore(annotationDir)
+        else: stores[key] = MaskFileStore(annotationDir, storage == STORE_LABELS)
+    return stores[key]
+
+# whether the directory has the mask in any store: the archive store also
+# reads the per-object files and label maps
+def maskExists(annotationDir, imgName, i):
+    return maskStore(annotationDir, STORE_ARCHIVE).exists(imgName, i)
+
+# convert one legacy mask file in place; returns True if converted
+def migrateMaskFile(fname):
+    mask, offset, frame = readMaskFile(fname)
+    if mask is None:
+        print 'Could not read mask file', fname
+        return False
+    if offset is not None: return False    # already cropped
+    x1, y1, w, h = getMBR_numpy(mask)
+    if x1 < 0:
+        print 'Empty mask, left as is:', fname
+        return False
+    # write next to the original and rename, so that an interrupted run
+    # never leaves a broken mask file
+    tmpName = fname + '.tmp'
+    if not writeMaskFile(tmpName, mask.copy(x1, y1, w, h), x1, y1, (mask.width(), mask.height()), True):
+        print 'Could not write', tmpName
+        return False
+    if os.name == 'nt' and os.path.exists(fname): os.remove(fname)
+    os.rename(tmpName, fname)
+    return True
+
+# convert all legacy mask files under annotationDir (including subdirectories)
+def migrateAnnotationDir(annotationDir):
+    converted, total = 0, 0
+    for root, dirs, files in os.walk(annotationDir):
+        for f in sorted(files):
+            if not MASK_FILE_RE.match(f): continue
+            total += 1
+            if migrateMaskFile(os.path.join(root, f)): converted += 1
+    print 'Mask files:', total, ', converted to cropped format:', converted
+    return converted
+
+# convert the masks of all images under annotationDir to the given storage
+# (STORE_FILES, STORE_LABELS or STORE_ARCHIVE); every converted image is read back and compared
+def convertAnnotationDir(annotationDir, storage):
+    from Annotation23 import XImage, XObject
+    converted, total, skipped = 0, 0, []
+    for root, dirs, files in os.walk(annotationDir):
+        imgNames = set()
+        for f in files:
+            m = MASK_FILE_RE.match(f)
+            if m: imgNames.add(m.group(1))
+            elif f.endswith(LABEL_MAP_SUFFIX): imgNames.add(f[:-len(LABEL_MAP_SUFFIX)])
+        # the archive store reads loose files too
+        src = MaskArchiveStore(root + '/')
+        for name, i in src.entries: imgNames.add(name)
+        if storage == STORE_ARCHIVE: dst = MaskArchiveStore(root + '/')
+        else: dst = MaskFileStore(root + '/', storage == STORE_LABELS)
+        for imgName in sorted(imgNames):
+            total += 1
+            ximg = XImage(imgName + '.png')
+            i = 0
+            while src.exists(imgName, i):
+                obj = XObject(id=i)
+                obj.loadMaskFrom(src, imgName, i)
+                ximg.objects.append(obj)
+                i += 1
+            # the masks are numbered by object index, an image with an unreadable
+            # mask is left as it is rather than renumbered
+            bad = [j for j in range(len(ximg.objects)) if ximg.objects[j].cmask is None]
+            if bad:
+                print 'Error! Could not read mask', ', '.join(map(str, bad)), 'of', imgName, ', not converted'
+                skipped.append(imgName)
+                continue
+            masks = [numpy.array(qimageToNumpy(obj.cmask)) for obj in ximg.objects]
+            dst.saveImageMasks(ximg)
+            if storage != STORE_ARCHIVE:
+                # the masks are now loose files
+                src.write([(imgName, i, None) for i in range(src.counts.get(imgName, 0)) if (imgName, i) in src.entries])
+            # read back
+            if storage != STORE_ARCHIVE: dst.labelCache.clear()
+            for i in range(len(masks)):
+                mask, offset, frame = dst.read(imgName, i)
+                obj = ximg.objects[i]
+                if mask is None or offset != (obj.x1, obj.y1) or not numpy.array_equal(numpy.array(qimageToNumpy(mask)), masks[i]):
+                    print 'Error! Mask', i, 'of', imgName, 'did not round-trip'
+            converted += 1
+        if storage != STORE_ARCHIVE and os.path.exists(src.dataFile) and not src.entries:
+            # all the masks are loose files now, the directory is no longer read through the archive
+            src.closeData()
+            for name in (src.dataFile, src.indexFile):
+                if os.path.exists(name): os.remove(name)
+    print 'Images:', total, ', converted:', converted
+    if skipped: print 'Not converted (unreadable masks):', ' '.join(skipped)
+    return converted
+
+if __name__ == "__main__":
+    commands = ('migrate', 'compact', STORE_FILES, STORE_LABELS, STORE_ARCHIVE)
+    if len(sys.argv) < 3 or sys.argv[1] not in commands:
+        print 'usage: python MaskStore.py ' + '|'.join(commands) + ' <annotation dir> [<annotation dir> ...]'
+        sys.exit(1)
+    for d in sys.argv[2:]:
+        if not d.endswith('/'): d += '/'
+        print sys.argv[1], d
+        if sys.argv[1] == 'migrate': migrateAnnotationDir(d)
+        elif sys.argv[1] == 'compact':
+            store = MaskArchiveStore(d)
+            print 'Superseded data:', store.garbage(), 'bytes'
+            store.compact()
+        else: convertAnnotationDir(d, sys.argv[1])
@@ -0,0 +1,102 @@
+# Memory accounting for the images held by the annotation tool.
+# Every background, foreground, object mask and object region is registered
+# here with its size. When the total exceeds the budget, the least recently
+# used masks and regions are dropped; their owners reload them lazily from
+# the annotation directory when they are needed again.
+
+import threading
+import weakref
+from collections import OrderedDict
+
+# image kinds that can be dropped and reloaded later
+EVICTABLE = ('mask', 'region')
+
+# size of a QImage, QPixmap or TilePyramid in bytes
+def imageBytes(image):
+    if image is None: return 0
+    if isinstance(image, (int, long)): return image
+    if hasattr(image, 'byteCount'): return image.byteCount()
+    return image.width() * image.height() * image.depth() / 8
+
+class MemoryManager:
+    def __init__(self, budget=1024*1024*1024):
+        self.budget = budget
+        # (id(owner), kind) -> [weakref(owner), kind, bytes], least recently used first
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+    def setBudget(self, budget):
+        self.budget = budget
+
+    # register (or update) the image of the given kind held by owner;
+    # the entry is removed when the owner is garbage collected
+    def track(self, owner, kind, image):
+        key = (id(owner), kind)
+        nbytes = imageBytes(image)
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(key, None)
+            if entry is not None: self.nbytes -= entry[2]
+            if nbytes > 0:
+                ref = weakref.ref(owner, lambda r, key=key: self.forget(key))
+                self.entries[key] = [ref, kind, nbytes]
+                self.nbytes += nbytes
+        finally:
+            self.lock.release()
+
+    def release(self, owner, kind):
+        self.forget((id(owner), kind))
+
+    def forget(self, key):
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(key, None)
+            if entry is not None: self.nbytes -= entry[2]
+        finally:
+            self.lock.release()
+
+    # mark as recently used
+    def touch(self, owner, kind):
+        key = (id(owner), kind)
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(key, None)
+            if entry is not None: self.entries[key] = entry
+        finally:
+            self.lock.release()
+
+    def usage(self, kind=None):
+        self.lock.acquire()
+        try:
+            if kind is None: return self.nbytes
+            return sum(e[2] for e in self.entries.values() if e[1] == kind)
+        finally:
+            self.lock.release()
+
+    # drop least recently used masks and regions until the budget is met;
+    # to be called from the GUI thread, the owners are not locked.
+    # owners implement canEvict(kind) and evict(kind), evict() releases the entry
+    def collect(self):
+        if self.nbytes <= self.budget: return 0
+        self.lock.acquire()
+        try:
+            candidates = [(e[0], e[1]) for e in self.entries.values() if e[1] in EVICTABLE]
+        finally:
+            self.lock.release()
+        count = 0
+        for ref, kind in candidates:
+            if self.nbytes <= self.budget: break
+            owner = ref()
+            if owner is None or not owner.canEvict(kind): continue
+            owner.evict(kind)
+            count += 1
+        self.evictions += count
+        return count
+
+    def stats(self):
+        return 'memory: %d/%d MB' % (self.nbytes / 1048576, self.budget / 1048576)
+
+# the memory manager used by the annotation classes and the GUI
+memoryManager = MemoryManager()
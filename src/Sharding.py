@@ -0,0 +1,312 @@
+# Sharding of one annotation list across several annotators.
+#
+# The images of the list (the canonical list) are split into batches of
+# consecutive images. An annotator leases a batch and works on its shard, a
+# list file of the images of the batch: each XRanT3 instance writes only its
+# own shard (and its journal, see Journal), and the masks of its images into
+# the shared annotation directory. Per-object mask files and label maps are
+# per image, but the mask archive (MaskStore.STORE_ARCHIVE) is one file
+# without a lock across processes: it is not for sharded lists.
+# mergeShards writes the shards back into the canonical list.
+#
+# The files are in <annotation directory>/<list name>.shards/:
+#   manifest            the list, its number of images and the batch size
+#   batch0007.txt       the shard of batch 7, created from the list when first leased
+#   batch0007.lease     owner, host, process and expiry time of the lease
+#   batch0007.done      the batch is finished
+#   batch0007.takeover  an instance is taking over the lease
+# A lease is created with O_EXCL; it is renewed by its holder and can be taken
+# over when it has expired (the holder crashed or lost the network). Takeovers
+# are serialized by the takeover file, created with O_EXCL: its creator checks
+# that the lease is still the expired one before replacing it.
+#
+# usage: python Sharding.py init <list file> [batch size]
+#        python Sharding.py status <list file>
+#        python Sharding.py merge <list file> [output file]
+
+import os
+import sys
+import time
+import errno
+import socket
+import getpass
+from AnnotationCore import *
+from BinaryList import writeTextList
+from Journal import loadJournaledList
+
+SHARDS_SUFFIX = '.shards'
+SHARDS_MAGIC = '#XRanT-shards'
+BATCH_SIZE = 500
+# a lease expires when not renewed for this long; holders renew it every
+# LEASE_RENEW_SECONDS
+LEASE_SECONDS = 15 * 60
+LEASE_RENEW_SECONDS = 60
+# a takeover file this old was left by a crashed instance
+TAKEOVER_SECONDS = 60
+
+# the annotator: user@host
+def defaultOwner():
+    return '%s@%s' % (getpass.getuser(), socket.gethostname())
+
+def processAlive(pid):
+    try: os.kill(pid, 0)
+    except OSError, e: return e.errno == errno.EPERM
+    return True
+
+# a list file written next to it and renamed over it
+def writeListFile(fname, parsed):
+    if os.path.exists(fname) and isBinaryList(fname): writeBinaryList(fname, parsed); return
+    writeTextList(fname + '.tmp', parsed, FT_V2)
+    os.rename(fname + '.tmp', fname)
+
+# images start:end of a ParsedList
+def sliceParsed(parsed, start, end):
+    part = ParsedList(parsed.ftype)
+    part.className, part.subclassName = parsed.className, parsed.subclassName
+    part.dirPath, part.folder, part.annotationDir = parsed.dirPath, parsed.folder, parsed.annotationDir
+    part.names = parsed.names[start:end]
+    part.images = parsed.images[start:end].copy()
+    part.objects = parsed.objects[parsed.offsets[start]:parsed.offsets[end]].copy()
+    part.offsets = parsed.offsets[start:end+1] - parsed.offsets[start]
+    return part
+
+# ParsedLists one after the other, with the header of the first
+def concatParsed(parts):
+    parsed = sliceParsed(parts[0], 0, 0)
+    parsed.names = [name for part in parts for name in part.names]
+    parsed.images = numpy.concatenate([part.images for part in parts])
+    parsed.objects = numpy.concatenate([part.objects for part in parts])
+    parsed.offsets = numpy.zeros(len(parsed.names) + 1, numpy.int64)
+    numpy.cumsum(parsed.images[:, IC_COUNT], out=parsed.offsets[1:])
+    return parsed
+
+# the first line and the 'name value' lines of the manifest, lease and done files
+def readFields(fname):
+    ifs = open(fname)
+    try: lines = ifs.read().split('\n')
+    finally: ifs.close()
+    fields = {}
+    for line in lines:
+        tokens = line.split(None, 1)
+        if len(tokens) == 2: fields[tokens[0]] = tokens[1]
+    return lines[0], fields
+
+# a lease held by this instance
+class Lease:
+    def __init__(self, shards, batch, owner):
+        self.shards, self.batch, self.owner = shards, batch, owner
+        self.shardFile = shards.batchFile(batch, '.txt')
+        self.leaseFile = shards.batchFile(batch, '.lease')
+        self.expires = 0
+        self.lost = False
+
+    def content(self):
+        return 'owner %s\nhost %s\npid %d\nexpires %d\n' % (self.owner, socket.gethostname(), os.getpid(), int(self.expires))
+    def holds(self, fields):
+        return fields.get('owner') == self.owner and fields.get('host') == socket.gethostname() and fields.get('pid') == str(os.getpid())
+
+    # extend the lease; False if it has been taken over
+    def renew(self):
+        if self.lost: return False
+        try: fields = readFields(self.leaseFile)[1]
+        except IOError: fields = {}
+        if not self.holds(fields):
+            self.lost = True
+            print 'Lost the lease of batch', self.batch, 'to', fields.get('owner', 'nobody')
+            return False
+        self.expires = time.time() + LEASE_SECONDS
+        tmpName = self.leaseFile + '.%d.tmp' % os.getpid()
+        f = open(tmpName, 'w')
+        f.write(self.content())
+        f.close()
+        os.rename(tmpName, self.leaseFile)
+        return True
+
+    # give the batch back; done: it is finished, nobody leases it again
+    def release(self, done=False):
+        if self.lost: return
+        if done:
+            f = open(self.shards.batchFile(self.batch, '.done'), 'w')
+            f.write('owner %s\nfinished %d\n' % (self.owner, int(time.time())))
+            f.close()
+        try:
+            if self.holds(readFields(self.leaseFile)[1]): os.remove(self.leaseFile)
+        except (IOError, OSError):
+            pass
+        self.lost = True
+
+# the batches of a list
+class ShardSet:
+    def __init__(self, listFile, batchSize=BATCH_SIZE):
+        self.listFile = os.path.abspath(str(listFile))
+        self.parsed = None          # the canonical list, read when a shard is created
+        self.readManifest(batchSize)
+
+    def readManifest(self, batchSize):
+        header = readListFields(self.listFile)
+        self.directory = os.path.join(header[0], os.path.basename(self.listFile) + SHARDS_SUFFIX)
+        manifest = os.path.join(self.directory, 'manifest')
+        if not os.path.exists(manifest):
+            if not os.path.isdir(self.directory):
+                try: os.makedirs(self.directory)
+                except OSError, e:
+                    if e.errno != errno.EEXIST: raise
+            # the first instance writes the manifest, linked so that only one does
+            tmpName = manifest + '.%s.%d.tmp' % (socket.gethostname(), os.getpid())
+            f = open(tmpName, 'w')
+            f.write('%s 1\nlist %s\nimages %d\nbatch %d\n' % (SHARDS_MAGIC, self.listFile, header[1], batchSize))
+            f.close()
+            try: os.link(tmpName, manifest)
+            except OSError, e:
+                if e.errno != errno.EEXIST: raise
+            os.remove(tmpName)
+        magic, fields = readFields(manifest)
+        if magic.split()[:1] != [SHARDS_MAGIC]: raise ValueError('%s: not a shard manifest' % manifest)
+        self.numImages, self.batchSize = int(fields['images']), int(fields['batch'])
+        if header[1] != self.numImages:
+            raise ValueError('%s has %d images, it was sharded with %d' % (self.listFile, header[1], self.numImages))
+
+    def numBatches(self):
+        return (self.numImages + self.batchSize - 1) / self.batchSize
+    def batchRange(self, batch):
+        return batch * self.batchSize, min((batch + 1) * self.batchSize, self.numImages)
+    def batchFile(self, batch, suffix):
+        return os.path.join(self.directory, 'batch%04d%s' % (batch, suffix))
+    def isDone(self, batch):
+        return os.path.exists(self.batchFile(batch, '.done'))
+    # owner of the lease of a batch, None if not leased or expired
+    def leaseOwner(self, batch):
+        try: fields = readFields(self.batchFile(batch, '.lease'))[1]
+        except IOError: return None
+        if int(fields.get('expires', 0)) < time.time(): return None
+        return fields.get('owner')
+
+    # lease a batch: one of owner's leases that is no longer held (the instance
+    # was closed or crashed), else the first free or expired batch; None if all
+    # batches are done or leased
+    def acquire(self, owner=None):
+        owner = owner or defaultOwner()
+        batches = [b for b in range(self.numBatches()) if not self.isDone(b)]
+        batches.sort(key=lambda b: self.leaseOwner(b) != owner)
+        for batch in batches:
+            lease = Lease(self, batch, owner)
+            if self.tryLease(lease):
+                if not os.path.exists(lease.shardFile): self.createShard(batch)
+                return lease
+        return None
+    def tryLease(self, lease):
+        if self.createLease(lease): return True
+        return self.takeOver(lease)
+    # create the lease file; False if there is one
+    def createLease(self, lease):
+        lease.expires = time.time() + LEASE_SECONDS
+        try:
+            fd = os.open(lease.leaseFile, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+        except OSError, e:
+            if e.errno != errno.EEXIST: raise
+            return False
+        os.write(fd, lease.content())
+        os.close(fd)
+        return True
+    # take over an expired lease, or one of the same owner whose process is gone
+    def takeOver(self, lease):
+        try: fields = readFields(lease.leaseFile)[1]
+        except IOError: return False
+        sameHost = fields.get('host') == socket.gethostname()
+        ownerGone = fields.get('owner') == lease.owner and sameHost and not processAlive(int(fields.get('pid', 0)))
+        if int(fields.get('expires', 0)) >= time.time() and not ownerGone: return False
+        lockFile = self.batchFile(lease.batch, '.takeover')
+        if not self.lockTakeover(lockFile): return False
+        try:
+            # renewed, released or taken over since it was read
+            try:
+                if readFields(lease.leaseFile)[1] != fields: return False
+            except IOError: return False
+            os.remove(lease.leaseFile)
+            if not self.createLease(lease): return False
+        finally:
+            os.remove(lockFile)
+        print 'Took over the lease of batch', lease.batch, 'from', fields.get('owner')
+        return True
+    # create the takeover file of a batch; False if another instance has it
+    def lockTakeover(self, lockFile):
+        for attempt in range(2):
+            try:
+                fd = os.open(lockFile, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+            except OSError, e:
+                if e.errno != errno.EEXIST: raise
+                try:
+                    if time.time() - os.path.getmtime(lockFile) < TAKEOVER_SECONDS: return False
+                    os.remove(lockFile)
+                except OSError:
+                    pass
+                continue
+            os.write(fd, '%s %d\n' % (socket.gethostname(), os.getpid()))
+            os.close(fd)
+            return True
+        return False
+
+    # the shard of a batch, from the canonical list
+    def createShard(self, batch):
+        if self.parsed is None: self.parsed = loadJournaledList(self.listFile).toParsedList()
+        start, end = self.batchRange(batch)
+        writeListFile(self.batchFile(batch, '.txt'), sliceParsed(self.parsed, start, end))
+
+    def status(self):
+        lines = []
+        for batch in range(self.numBatches()):
+            start, end = self.batchRange(batch)
+            if self.isDone(batch): state = 'done'
+            elif self.leaseOwner(batch): state = 'leased by ' + self.leaseOwner(batch)
+            elif os.path.exists(self.batchFile(batch, '.txt')): state = 'started'
+            else: state = 'free'
+            lines.append('batch %4d  images %7d-%-7d %s' % (batch, start + 1, end, state))
+        return lines
+
+# the number of images and the annotation directory of a list, from its header
+def readListFields(fname):
+    if isBinaryList(fname):
+        blist = BinaryList(fname)
+        fields = (blist.annotationDir, blist.numImages())
+        blist.close()
+        return fields
+    ifs = open(fname)
+    try: className, subclassName, dirPath, folder, annotationDir, numImages = readListHeader(ifs)
+    finally: ifs.close()
+    return annotationDir, numImages
+
+# write the shards (with the edits of their journals) into the canonical list,
+# or into outFile; the batches nobody has started are copied from the list
+def mergeShards(listFile, outFile=None):
+    shards = ShardSet(listFile)
+    parsed = loadJournaledList(shards.listFile).toParsedList()
+    parts, merged = [], 0
+    for batch in range(shards.numBatches()):
+        start, end = shards.batchRange(batch)
+        part = sliceParsed(parsed, start, end)
+        shardFile = shards.batchFile(batch, '.txt')
+        if os.path.exists(shardFile):
+            shard = loadJournaledList(shardFile).toParsedList()
+            if shard.names != part.names:
+                raise ValueError('%s does not have the images %d-%d of %s' % (shardFile, start + 1, end, listFile))
+            part.images, part.objects, part.offsets = shard.images, shard.objects, shard.offsets
+            merged += 1
+        parts.append(part)
+    writeListFile(outFile or shards.listFile, concatParsed(parts))
+    print 'Merged', merged, 'of', shards.numBatches(), 'batches into', outFile or shards.listFile
+    return merged
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] not in ('init', 'status', 'merge'):
+        print 'usage: python Sharding.py init <list file> [batch size]'
+        print '       python Sharding.py status <list file>'
+        print '       python Sharding.py merge <list file> [output file]'
+        sys.exit(1)
+    command, listFile = sys.argv[1], sys.argv[2]
+    if command == 'init':
+        shards = ShardSet(listFile, int(sys.argv[3]) if len(sys.argv) > 3 else BATCH_SIZE)
+        print shards.numBatches(), 'batches of', shards.batchSize, 'images in', shards.directory
+    elif command == 'status':
+        for line in ShardSet(listFile).status(): print line
+    else:
+        mergeShards(listFile, sys.argv[3] if len(sys.argv) > 3 else None)
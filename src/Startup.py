@@ -0,0 +1,61 @@
+# Startup time of the GUI.
+# Modules that are not needed to show the main window are imported on first
+# use (lazyImport); XRanT3 --profile-startup prints the time of each startup
+# step since the start of the process, with the lazy imports done in between.
+
+import os
+import sys
+import time
+
+# the start of the process, from the system uptime and the start time of the
+# process in clock ticks since boot (Linux); None if not available
+def processStartTime():
+    try:
+        f = open('/proc/self/stat')
+        try: ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        finally: f.close()
+        f = open('/proc/uptime')
+        try: uptime = float(f.read().split()[0])
+        finally: f.close()
+        return time.time() - (uptime - ticks / float(os.sysconf('SC_CLK_TCK')))
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+class StartupProfile:
+    def __init__(self):
+        self.start = processStartTime() or time.time()
+        self.marks = []         # (step, seconds since the start)
+        self.enabled = False
+        self.reported = False
+    def mark(self, step):
+        self.marks.append((step, time.time() - self.start))
+    def report(self):
+        if self.reported: return
+        self.reported = True
+        if not self.enabled: return
+        print 'Startup profile (seconds since the start of the process):'
+        last = 0.0
+        for step, t in self.marks:
+            print '  %7.3f  %+7.3f  %s' % (t, t - last, step)
+            last = t
+
+startupProfile = StartupProfile()
+
+# a module imported the first time one of its attributes is used, e.g.
+#   numpy = lazyImport('numpy')
+class LazyModule(object):
+    def __init__(self, name):
+        self.__dict__['_lazyName'] = name
+    def __getattr__(self, attr):
+        name = self.__dict__['_lazyName']
+        loaded = name in sys.modules
+        t = time.time()
+        __import__(name)
+        module = sys.modules[name]
+        if not loaded: startupProfile.mark('import %s (lazy, %.3f s)' % (name, time.time() - t))
+        # later lookups find the attributes without __getattr__
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+def lazyImport(name):
+    return LazyModule(name)
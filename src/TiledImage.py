@@ -0,0 +1,97 @@
+# Tiled multi-resolution (pyramid) representation of large images.
+# Only the tiles intersecting the exposed area are drawn, at the level of
+# detail matching the current zoom of the view.
+
+import math
+from collections import OrderedDict
+from PyQt4.QtCore import *
+from PyQt4.QtGui import *
+
+# tile size in pixels
+TILE_SIZE = 512
+# images up to this size (width and height) are drawn as a single pixmap
+TILE_MIN_SIZE = 2048
+
+class TilePyramid:
+    def __init__(self, image, tileSize=TILE_SIZE, minSize=TILE_MIN_SIZE):
+        if isinstance(image, QPixmap): image = image.toImage()
+        self.w, self.h = image.width(), image.height()
+        self.tileSize = tileSize
+        self.pixmap = None
+        self.levels = []        # level k: the image downscaled by 2^k
+        self.tiles = []         # level k: (column, row) -> QPixmap, created when first drawn
+        if self.w <= minSize and self.h <= minSize:
+            self.pixmap = QPixmap.fromImage(image)
+            return
+        level = image
+        while True:
+            self.levels.append(level)
+            self.tiles.append({})
+            if level.width() <= tileSize and level.height() <= tileSize: break
+            level = level.scaled((level.width()+1)//2, (level.height()+1)//2, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+
+    def width(self):
+        return self.w
+    def height(self):
+        return self.h
+    def numLevels(self):
+        return len(self.levels)
+    # memory held by the pyramid, the full resolution level is shared with the image cache
+    def byteCount(self):
+        if self.pixmap: return self.w * self.h * self.pixmap.depth() / 8
+        nbytes = sum(level.byteCount() for level in self.levels[1:])
+        for tiles in self.tiles:
+            for pix in tiles.values():
+                nbytes += pix.width() * pix.height() * pix.depth() / 8
+        return nbytes
+
+    # coarsest level that still has at least one image pixel per screen pixel
+    def levelFor(self, scale):
+        if scale <= 0: return len(self.levels) - 1
+        level = int(math.floor(math.log(1.0 / scale, 2)))
+        return min(max(level, 0), len(self.levels) - 1)
+
+    def tile(self, level, col, row):
+        pix = self.tiles[level].get((col, row))
+        if pix is None:
+            ts = self.tileSize
+            pix = QPixmap.fromImage(self.levels[level].copy(col*ts, row*ts, ts, ts))
+            self.tiles[level][(col, row)] = pix
+        return pix
+
+    # draw the part of the image within rect (scene coordinates)
+    def draw(self, painter, rect):
+        if self.pixmap:
+            painter.drawPixmap(0, 0, self.pixmap)
+            return
+        t = painter.worldTransform()
+        scale = max(abs(t.m11()), abs(t.m22()))
+        level = self.levelFor(scale)
+        limg = self.levels[level]
+        # size of one level pixel in image (scene) coordinates
+        sx, sy = self.w / float(limg.width()), self.h / float(limg.height())
+        ts = self.tileSize
+        ncols, nrows = (limg.width()+ts-1)//ts, (limg.height()+ts-1)//ts
+        c0, c1 = max(0, int(rect.left() / (ts*sx))), min(ncols-1, int(rect.right() / (ts*sx)))
+        r0, r1 = max(0, int(rect.top() / (ts*sy))), min(nrows-1, int(rect.bottom() / (ts*sy)))
+        if level > 0: painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        for row in range(r0, r1+1):
+            for col in range(c0, c1+1):
+                pix = self.tile(level, col, row)
+                target = QRectF(col*ts*sx, row*ts*sy, pix.width()*sx, pix.height()*sy)
+                painter.drawPixmap(target, pix, QRectF(pix.rect()))
+
+# the pyramids of the most recently shown images, by file name
+class PyramidCache:
+    def __init__(self, maxCount=3):
+        self.maxCount = maxCount
+        self.pyramids = OrderedDict()
+    def get(self, fname, image):
+        pyramid = self.pyramids.pop(fname, None)
+        if pyramid is None: pyramid = TilePyramid(image)
+        self.pyramids[fname] = pyramid
+        while len(self.pyramids) > self.maxCount:
+            self.pyramids.popitem(last=False)
+        return pyramid
+    def clear(self):
+        self.pyramids.clear()
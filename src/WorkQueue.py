@@ -0,0 +1,163 @@
+# Work queue of the images that still need annotating.
+#
+# An image is pending when it fails one of the criteria of the queue (no
+# difficulty level, no image label, no objects, an object without a model ID)
+# and has not been marked done by the annotator (an image with nothing to
+# annotate). The pending images are kept in list order as a bool array over the
+# images; the edits of the annotation (Annotation.addEditListener) update the
+# row of the edited image. next/upcoming give the next pending images in either
+# direction, wrapping around, for navigation and prefetching.
+#
+# The criteria, the done images, the current image and whether navigation
+# follows the queue are kept in <list file>.queue, next to the list.
+
+import os
+from Startup import lazyImport
+from ListParser import IC_LEVEL, IC_LABEL, IC_COUNT, OC_MID
+from AnnotationCore import L0, LSKIP
+numpy = lazyImport('numpy')
+
+QUEUE_SUFFIX = '.queue'
+QUEUE_MAGIC = '#XRanT-queue'
+# the criteria: an image is pending if
+#   level: its level is L0, label: its label is LSKIP, objects: it has no
+#   objects, mid: it has an object with model ID 0
+CRITERIA = ('level', 'label', 'objects', 'mid')
+DEFAULT_CRITERIA = ('level', 'objects')
+
+# whether an image fails a criterion
+def imageNeeds(ximg, criterion):
+    if criterion == 'level': return ximg.level == L0
+    if criterion == 'label': return ximg.label == LSKIP
+    if criterion == 'objects': return len(ximg.objects) == 0
+    return any(obj.mid == 0 for obj in ximg.objects)
+
+class WorkQueue:
+    def __init__(self, ann, queueFile=None, criteria=DEFAULT_CRITERIA):
+        self.ann = ann
+        self.queueFile = queueFile
+        if queueFile is None and ann.annfilename: self.queueFile = str(ann.annfilename) + QUEUE_SUFFIX
+        self.criteria = tuple(criteria)
+        self.position = 0           # the current image when saved
+        self.navigate = False       # prev/next go to the pending images
+        n = ann.numImages()
+        self.done = numpy.zeros(n, bool)
+        if self.queueFile and os.path.exists(self.queueFile): self.load()
+        self.build()
+        ann.addEditListener(self.onAnnotationEdit)
+
+    # the criteria arrays of all the images, from the arrays of the list
+    def build(self):
+        parsed = self.ann.toParsedList()
+        n = len(parsed.names)
+        self.needs = {}
+        if 'level' in self.criteria: self.needs['level'] = parsed.images[:, IC_LEVEL] == L0
+        if 'label' in self.criteria: self.needs['label'] = parsed.images[:, IC_LABEL] == LSKIP
+        if 'objects' in self.criteria: self.needs['objects'] = parsed.images[:, IC_COUNT] == 0
+        if 'mid' in self.criteria:
+            owners = numpy.repeat(numpy.arange(n), numpy.diff(parsed.offsets))
+            self.needs['mid'] = numpy.zeros(n, bool)
+            self.needs['mid'][owners[parsed.objects[:, OC_MID] == 0]] = True
+        self.pending = numpy.zeros(n, bool)
+        for needs in self.needs.values(): self.pending |= needs
+        self.pending &= ~self.done
+
+    def setCriteria(self, criteria):
+        self.criteria = tuple(c for c in CRITERIA if c in criteria)
+        self.build()
+        self.save()
+
+    # Annotation edit listener
+    def onAnnotationEdit(self, op, args):
+        if op in ('labelall', 'levelall'):
+            criterion = 'label' if op == 'labelall' else 'level'
+            if criterion not in self.needs: return
+            self.needs[criterion][:] = args[0] == (LSKIP if criterion == 'label' else L0)
+            self.pending[:] = False
+            for needs in self.needs.values(): self.pending |= needs
+            self.pending &= ~self.done
+            return
+        index = args[0]
+        if index >= len(self.pending): return
+        ximg = self.ann.image(index)
+        for criterion, needs in self.needs.items(): needs[index] = imageNeeds(ximg, criterion)
+        self.pending[index] = not self.done[index] and any(needs[index] for needs in self.needs.values())
+
+    # the image to start at: the current image of the last session
+    def resumeIndex(self):
+        return self.position if 0 <= self.position < len(self.pending) else 0
+    def numPending(self):
+        return int(self.pending.sum())
+    def isPending(self, index):
+        return 0 <= index < len(self.pending) and bool(self.pending[index])
+    # the criteria an image fails
+    def needsOf(self, index):
+        return [c for c in self.criteria if self.needs[c][index]]
+
+    # the next pending image after index in direction step (1 or -1), wrapping
+    # around; -1 if no other image is pending
+    def next(self, index, step=1):
+        if step > 0:
+            found = numpy.flatnonzero(self.pending[index+1:])
+            if len(found): return index + 1 + int(found[0])
+            found = numpy.flatnonzero(self.pending[:max(index, 0)])
+            return int(found[0]) if len(found) else -1
+        found = numpy.flatnonzero(self.pending[:max(index, 0)])
+        if len(found): return int(found[-1])
+        found = numpy.flatnonzero(self.pending[index+1:])
+        return index + 1 + int(found[-1]) if len(found) else -1
+    # the next count pending images in direction step, for prefetching
+    def upcoming(self, index, count, step=1):
+        images = []
+        i = index
+        for k in range(count):
+            i = self.next(i, step)
+            if i < 0 or i == index or i in images: break
+            images.append(i)
+        return images
+
+    # an image with nothing to annotate leaves the queue (done=False: it is back)
+    def markDone(self, index, done=True):
+        if index >= len(self.done): return
+        self.done[index] = done
+        self.pending[index] = not done and any(needs[index] for needs in self.needs.values())
+        self.save()
+
+    def load(self):
+        ifs = open(self.queueFile)
+        lines = ifs.read().split('\n')
+        ifs.close()
+        if not lines or lines[0].split()[:1] != [QUEUE_MAGIC]:
+            print 'Not a work queue file:', self.queueFile
+            return
+        for line in lines[1:]:
+            tokens = line.split()
+            if not tokens: continue
+            try:
+                if tokens[0] == 'criteria': self.criteria = tuple(c for c in CRITERIA if c in tokens[1:])
+                elif tokens[0] == 'position': self.position = int(tokens[1])
+                elif tokens[0] == 'navigate': self.navigate = tokens[1] == '1'
+                elif tokens[0] == 'done':
+                    done = numpy.array([int(t) for t in tokens[1:]], numpy.int64)
+                    self.done[done[done < len(self.done)]] = True
+            except (ValueError, IndexError):
+                print 'Bad line in the work queue file', self.queueFile, ':', line
+    # written next to the file and renamed over it
+    def save(self):
+        if not self.queueFile: return
+        try:
+            ofs = open(self.queueFile + '.tmp', 'w')
+            ofs.write('%s 1\n' % QUEUE_MAGIC)
+            ofs.write('criteria %s\n' % ' '.join(self.criteria))
+            ofs.write('position %d\n' % self.position)
+            ofs.write('navigate %d\n' % (1 if self.navigate else 0))
+            ofs.write('done %s\n' % ' '.join(map(str, numpy.flatnonzero(self.done).tolist())))
+            ofs.close()
+            os.rename(self.queueFile + '.tmp', self.queueFile)
+        except (IOError, OSError), e:
+            print 'Could not save the work queue', self.queueFile, ':', e
+
+    def close(self, position=None):
+        if position is not None: self.position = position
+        self.ann.removeEditListener(self.onAnnotationEdit)
+        self.save()
@@ -5,12 +5,29 @@
 
 # This is for ID annotation of objects, July 5, 2012
 
+# usage: python XRanT3.py [--profile-startup] [--shard] [annotation list]
+#        --profile-startup: print the time of the startup steps (first paint,
+#        first image of the list) and of the imports
+#        --shard: annotate a batch of the list, leased from the batches the
+#        annotators share (see Sharding)
+
 import sys
 import os
 import functools
+from Startup import startupProfile
 from PyQt4.QtCore import *
 from PyQt4.QtGui import *
+startupProfile.mark('import PyQt4')
 from Annotation23 import *
+from ImageCache import ImageCache
+from TiledImage import PyramidCache
+from MemoryManager import memoryManager
+from Journal import Journal
+from AutoSave import AutoSaver
+from WorkQueue import WorkQueue, CRITERIA
+from Sharding import ShardSet, LEASE_RENEW_SECONDS
+from ImageTableModel import ImageTableModel
+startupProfile.mark('import XRanT3 modules')
 
 ### GLOBAL VARIABLES ###
 
@@ -31,6 +48,21 @@ DRAWPOLY = 4    # paint filled rounded rectangle
 BRUSH_TYPES_STR = ["Line", "Circle", "Rectangle", "Rounded rect.", "Polygon"]
 BRUSH_TYPES_INT = [DRAWL, DRAWELL, DRAWRECT, DRAWRECTR, DRAWPOLY]
 
+# image prefetching: number of images decoded ahead in the navigation direction,
+# memory budget of the decoded image cache and number of decoding threads
+PREFETCH_COUNT = 3
+IMAGE_CACHE_MB = 512
+PREFETCH_THREADS = 2
+# memory budget for the scene images, object masks and regions; least recently
+# used masks and regions are dropped (and reloaded when needed) above this
+MEMORY_BUDGET_MB = 1024
+# keep the fields of loaded annotation lists in numpy arrays (ColumnarAnnotation)
+# instead of one XImage/XObject instance per image and object
+COLUMNAR_ANNOTATION = False
+# record the edits of a loaded list in a journal next to it (see Journal), the
+# list itself is rewritten in the background
+USE_JOURNAL = True
+
 # IDs of objects
 #idvaluesstrs=[("1: ", 1), ("2: ", 2), ("3: ", 3), ("4: ", 4), ("5: ", 5), ("6: ", 6), ("7: ", 7), ("8: ", 8), ("9: ", 9), ("10: ", 10), ("11: ", 11), ("12: ", 12), ("13: ", 13), ("14: ", 14), ("15: ", 15), ("16: ", 16), ("17: ", 17), ("18: ", 18), ("19: ", 19), ("20: ", 20), ("0: skip", 0)]
 idvaluesstrs=[("1: ", 1), ("2: ", 2), ("3: ", 3)]
@@ -123,6 +155,8 @@ class ImageDrawScene(QGraphicsScene):
         self.foregroundImage = None
         self.setSceneRect(0, 0, WMIN, HMIN)        
         self.w, self.h = 1,1
+        # union of the foreground areas painted since the last reset
+        self.dirtyRect = QRect()
         
         # painting related
         self.showBrush = False
@@ -182,9 +216,13 @@ class ImageDrawScene(QGraphicsScene):
         #self.foregroundImage = QImage(w, h, QImage.Format_ARGB32_Premultiplied)
         self.foregroundImage = QImage(w, h, QImage.Format_ARGB32)
         self.foregroundImage.fill(QColor(0, 0, 0, 0).rgba())        
+        memoryManager.track(self, 'foreground', self.foregroundImage)
+        self.dirtyRect = QRect()
     # reset painting
     def resetForeground(self):
-        if self.w > 1 and self.h > 1:
+        if self.foregroundImage and self.foregroundImage.size() == QSize(self.w, self.h):
+            self.clearDirtyRect()
+        elif self.w > 1 and self.h > 1:
             self.setForeground(self.w, self.h)
         if self.dtype == DRAWPOLY:
             self.startPolygon()
@@ -200,9 +238,41 @@ class ImageDrawScene(QGraphicsScene):
             return self.foregroundImage.alphaChannel()
         else: return None
     
+    # add the area touched by a paint stroke to the dirty region
+    def markDirty(self, rect):
+        # 1 pixel margin for antialiased edges
+        r = rect.toAlignedRect().adjusted(-1, -1, 1, 1)
+        r = r.intersected(QRect(0, 0, self.w, self.h))
+        if not r.isEmpty():
+            self.dirtyRect = self.dirtyRect.united(r)
+    # clear only the painted part of the foreground
+    def clearDirtyRect(self):
+        if not self.dirtyRect.isEmpty():
+            painter = QPainter(self.foregroundImage)
+            painter.setCompositionMode(QPainter.CompositionMode_Clear)
+            painter.fillRect(self.dirtyRect, Qt.transparent)
+            painter.end()
+        self.dirtyRect = QRect()
+    # MBR of the painted object, only the dirty region is scanned
+    def getObjectMBR(self):
+        if not self.foregroundImage or self.dirtyRect.isEmpty(): return -1, -1, 1, 1
+        dx, dy = self.dirtyRect.x(), self.dirtyRect.y()
+        cmask = self.foregroundImage.copy(self.dirtyRect).alphaChannel()
+        x1, y1, w, h = getMBR_numpy(cmask)
+        if x1 < 0:
+            # everything was erased
+            self.dirtyRect = QRect()
+            return -1, -1, 1, 1
+        x1, y1 = x1 + dx, y1 + dy
+        # erased parts of the dirty region need not be scanned again
+        self.dirtyRect = QRect(x1, y1, w, h)
+        return x1, y1, w, h
+    
+    # image: TilePyramid, shared with the object list scene
     def setBackground(self, image):
         if image:
-            self.backgroundImage = image.copy()            
+            self.backgroundImage = image
+            memoryManager.track(image, 'background', image)
             self.update()
     
     # overridden
@@ -232,7 +302,7 @@ class ImageDrawScene(QGraphicsScene):
     # overridden
     def drawBackground (self, painter, rect):
         if self.backgroundImage:
-            painter.drawPixmap(0, 0, self.backgroundImage)
+            self.backgroundImage.draw(painter, rect)
     
     def contextMenuEvent(self, event):
         return
@@ -335,9 +405,17 @@ class ImageDrawScene(QGraphicsScene):
             painter.drawRoundedRect(x-self.dradius, y-self.dradius, 2*self.dradius, 2*self.dradius, 25.0, 25.0, mode=Qt.RelativeSize)
         elif dtype == DRAWL and self.x0 >= 0 and self.y0 >= 0:            
             painter.drawLine(self.x0, self.y0, x, y)
-        self.x0, self.y0 = x, y
-            
         painter.end()
+        
+        # erasing never extends the painted area
+        if not self.erasing:
+            r = self.dradius
+            if dtype == DRAWL:
+                if self.x0 >= 0 and self.y0 >= 0:
+                    self.markDirty(QRectF(QPointF(self.x0, self.y0), QPointF(x, y)).normalized().adjusted(-r, -r, r, r))
+            else:
+                self.markDirty(QRectF(x-r, y-r, 2*r, 2*r))
+        self.x0, self.y0 = x, y
     
     def drawPolygonOnImage(self):
         if self.polygon.size() < 3 or not (self.foregroundImage and self.backgroundImage): return
@@ -346,6 +424,8 @@ class ImageDrawScene(QGraphicsScene):
         painter.setBrush(self.dbrush)
         painter.drawPolygon(self.polygon)
         painter.end()
+        if not self.erasing:
+            self.markDirty(self.polygon.boundingRect())
     # draw the current brush    
     def drawCursor(self, painter):
         painter.setPen(Qt.black)
@@ -411,10 +491,10 @@ class ObjectListScene(QGraphicsScene):
         for item in items:
             self.deleteObject(item)
     
-    # set the (background) image of the scene
+    # set the (background) image of the scene, a TilePyramid
     def setImage(self, image):
         if image:
-            self.backgroundImage = image.copy()
+            self.backgroundImage = image
             w,h = image.width(), image.height()
             self.setSceneRect(0, 0, w, h)
             self.update()
@@ -424,7 +504,7 @@ class ObjectListScene(QGraphicsScene):
     # overridden
     def drawBackground (self, painter, rect):
         if self.backgroundImage:
-            painter.drawPixmap(0, 0, self.backgroundImage)
+            self.backgroundImage.draw(painter, rect)
     
     def contextMenuEvent(self, event):
         item = self.itemAt(event.scenePos())
@@ -470,32 +550,59 @@ class ObjectListScene(QGraphicsScene):
             item.opacity = self.opacity
         self.update()
     
-class ImageTable(QTableWidget):
-    def __init__(self, rows, columns, main):
-        super(ImageTable, self).__init__(rows, columns, main)
+# view of the images of the annotation (ImageTableModel); only the visible
+# rows are read from the annotation. Rows are filtered and sorted by the model,
+# the methods take image indices, not rows
+class ImageTable(QTableView):
+    def __init__(self, main):
+        super(ImageTable, self).__init__(main)
         self.main = main
         self.ann = None
-        self.setHorizontalHeaderLabels(["image filename", "objects", "label", "level"])
+        self.tableModel = ImageTableModel(self)
+        self.setModel(self.tableModel)
+        # fixed row heights: no per-row size computation
+        self.verticalHeader().setResizeMode(QHeaderView.Fixed)
+        self.verticalHeader().setDefaultSectionSize(self.fontMetrics().height() + 6)
         self.resizeColumnsToContents()
         self.setSelectionMode(QAbstractItemView.ExtendedSelection)
         self.setAlternatingRowColors(True)
+        # click on a column header to sort; no sort indicator: the list order
+        self.horizontalHeader().setSortIndicator(-1, Qt.AscendingOrder)
+        self.setSortingEnabled(True)
         
-    def select(self, row, column):
+    def select(self, index, column):
+        row = self.tableModel.rowOfImage(index)
+        if row < 0: return
         self.clearSelection()
-        self.setCurrentCell(row, column)        
+        self.setCurrentIndex(self.tableModel.index(row, column))
+    # the image shown step rows before/after image index, index if there is none
+    def neighbour(self, index, step):
+        row = self.tableModel.rowOfImage(index)
+        if row < 0: return self.tableModel.imageAt(0) if self.tableModel.rowCount() else index
+        next = self.tableModel.imageAt(row + step)
+        return next if next >= 0 else index
     
-    def setBGColor(self, row, column, color):
-        item = self.item(row, column)
-        item.setBackgroundColor(color) 
+    def setBGColor(self, index, column, color):
+        self.tableModel.setBackground(index, column, color)
     
     def selectionChanged(self, selected, deselected):        
-        items = self.selectedItems()
-        rows = []
-        for item in items:
-            r,c = item.row(), item.column()            
-            if c == 0 and r not in rows: rows.append(r)
+        super(ImageTable, self).selectionChanged(selected, deselected)
+        rows = set(index.row() for index in self.selectedIndexes())
         if len(rows) == 1:      # only one row is selected, go to that image
-            self.main.toImage(rows[0])
+            self.main.toImage(self.tableModel.imageAt(rows.pop()))
+    
+    # select the next image whose file name contains text
+    def find(self, text):
+        row = self.tableModel.findRow(text, self.currentIndex().row())
+        if row < 0: self.main.statusMessage('No image name contains "%s"' % text); return
+        self.select(self.tableModel.imageAt(row), 0)
+        self.scrollTo(self.currentIndex())
+    # show only the images of the given levels with objects of the given model
+    # IDs (None: all)
+    def showImages(self, levels, mids):
+        current = self.main.ann.index if self.main.ann else -1
+        self.tableModel.setFilter(levels, None, mids)
+        if current >= 0: self.select(current, 0)
     
     def contextMenuEvent(self, event):
         if not self.main.ann: return
@@ -513,35 +620,23 @@ class ImageTable(QTableWidget):
             menu.addAction(text, wrapper)        
         menu.exec_(event.globalPos())
     
+    # the rows are updated by the model, from the edit notifications
     def setLevel(self, level, text):        
         if level in (0,1,2,3,4,5):            
             self.main.ann.setLevelAll(level)
             print 'SET ALL IMAGES TO: ', text
-            #self.updateTableRow(self.ann, index)
-            self.updateTableView(self.main.ann)
-            
     
-    # populate the table with the images
+    # show the images of the annotation
     def updateTableView(self, annotation):
         if annotation is None: return
-        if annotation.numImages() > 0:
-            self.clearContents()
-            self.setRowCount (annotation.numImages())
-        for i in range(annotation.numImages()):
-            self.updateTableRow(annotation, i)
         self.ann = annotation
+        self.tableModel.setAnnotation(annotation)
+        # sized on the visible rows
         self.resizeColumnsToContents()
     
     def updateTableRow(self, annotation, index):
         if annotation is None: return
-        nameItem = QTableWidgetItem(annotation.imageName(index))
-        numItem = QTableWidgetItem(str(annotation.numObjects(index)))
-        labelItem = QTableWidgetItem(str(annotation.image(index).label))
-        levelItem = QTableWidgetItem(str(annotation.image(index).level))
-        self.setItem(index, 0, nameItem)
-        self.setItem(index, 1, numItem)
-        self.setItem(index, 2, labelItem)
-        self.setItem(index, 3, levelItem)
+        self.tableModel.rowChanged(index)
 
 class GraphicsView(QGraphicsView):
 
@@ -578,17 +673,35 @@ class GraphicsView(QGraphicsView):
 
 # main window containing all the widgets
 class MainWindow(QMainWindow):
-    def __init__(self):
+    # startupList: annotation list opened once the window is shown (a leased
+    # batch of it if startupShard)
+    def __init__(self, startupList=None, startupShard=False):
         super(MainWindow, self).__init__()
         
-        self.createMenus()
+        # menus and the autosaver are created after the first paint (finishStartup)
+        self.startupList = startupList
+        self.startupShard = startupShard
+        self.painted = False
+        self.autoSaver = None
         
         # annotations, image list, etc.
         self.ann = None
+        self.journal = None
+        self.workQueue = None       # the images still to annotate, see WorkQueue
+        self.lease = None           # the leased batch when annotating a shard (Sharding.Lease)
+        self.leaseTimer = QTimer(self)
+        self.leaseTimer.setInterval(LEASE_RENEW_SECONDS * 1000)
+        self.connect(self.leaseTimer, SIGNAL('timeout()'), self.renewLease)
         self.imageDir = None
         # current image shown
         piximage = None
         self.startUp = True
+        # decoded images, prefetched in the navigation direction
+        self.imageCache = ImageCache(IMAGE_CACHE_MB*1024*1024, PREFETCH_THREADS)
+        self.direction = 1
+        # tile pyramids of the last shown images
+        self.pyramids = PyramidCache()
+        memoryManager.setBudget(MEMORY_BUDGET_MB*1024*1024)
         
         ## drawing scene and view on the right
         self.sceneDraw = ImageDrawScene(self)
@@ -606,7 +719,23 @@ class MainWindow(QMainWindow):
         self.viewList.setStatusTip('List of already selected objects')
         
         ## list of images
-        self.imageListTable = ImageTable(10, 4, self)
+        self.imageListTable = ImageTable(self)
+        # search by file name, filter by level and object model ID
+        self.findText = QLineEdit("")
+        self.findText.setStatusTip('Go to the next image whose file name contains the text  [ Enter ]')
+        self.connect(self.findText, SIGNAL('returnPressed()'), self.onFind)
+        findLabel = QLabel("&Find:")
+        findLabel.setBuddy(self.findText)
+        self.levelFilter = QComboBox()
+        self.levelFilter.addItems(["all levels"] + ["level %d" % level for level in (0,1,2,3,4,5)])
+        self.levelFilter.setStatusTip('Show only the images of a level')
+        self.connect(self.levelFilter, SIGNAL('activated(int)'), self.onImageFilter)
+        self.midFilter = QLineEdit("")
+        self.midFilter.setMaximumWidth(80)
+        self.midFilter.setStatusTip('Show only the images with objects of these model IDs, e.g. "17 18"; empty: all  [ Enter ]')
+        self.connect(self.midFilter, SIGNAL('returnPressed()'), self.onImageFilter)
+        midFilterLabel = QLabel("&MID:")
+        midFilterLabel.setBuddy(self.midFilter)
         
         # text fields for class/subclass name
         classLabel = QLabel("Class:")
@@ -703,6 +832,13 @@ class MainWindow(QMainWindow):
         ## status bar
         self.statusBar = QStatusBar(self)
         self.setStatusBar(self.statusBar)
+        self.cacheLabel = QLabel("")
+        self.statusBar.addPermanentWidget(self.cacheLabel)
+        # masks and list are saved in the background, shortly after the edits
+        self.saveLabel = QLabel("")
+        self.statusBar.addPermanentWidget(self.saveLabel)
+        self.queueLabel = QLabel("")
+        self.statusBar.addPermanentWidget(self.queueLabel)
         
         ### Layouts ### 
         # images & image list in the center
@@ -728,9 +864,18 @@ class MainWindow(QMainWindow):
         layoutR1.addSpacing(10)
         layoutR1.addWidget(self.buttonBrushColor)
         
+        layoutRF = QHBoxLayout()
+        layoutRF.addWidget(findLabel)
+        layoutRF.addWidget(self.findText)
+        layoutRF.addSpacing(10)
+        layoutRF.addWidget(self.levelFilter)
+        layoutRF.addWidget(midFilterLabel)
+        layoutRF.addWidget(self.midFilter)
+        
         layoutR = QVBoxLayout()
         layoutR.addItem(layoutR0)
         layoutR.addSpacing(10)
+        layoutR.addItem(layoutRF)
         layoutR.addWidget(self.imageListTable)
         layoutR.addSpacing(10)        
         layoutR.addItem(layoutR1)
@@ -772,6 +917,28 @@ class MainWindow(QMainWindow):
         #self.setWindowIcon(QIcon('./icons/xray-icon.png'))
         
         self.statusMessage("XRanT2 ready. Browse an image directory to get started [File/Ctrl-O]")
+        startupProfile.mark('main window built')
+    
+    def paintEvent(self, event):
+        super(MainWindow, self).paintEvent(event)
+        if not self.painted:
+            self.painted = True
+            startupProfile.mark('first paint')
+            QTimer.singleShot(0, self.finishStartup)
+    # what the first paint does not need: menus, the autosaver (a worker
+    # thread), and the list given on the command line
+    def finishStartup(self):
+        self.createMenus()
+        self.autoSaver = AutoSaver(self)
+        self.connect(self.autoSaver, SIGNAL('statusChanged()'), self.updateSaveStatus)
+        startupProfile.mark('menus and autosaver')
+        if self.startupList and self.startupShard:
+            self.openShard(self.startupList)
+            startupProfile.mark('shard loaded')
+        elif self.startupList:
+            self.openAnnotationList(self.startupList)
+            startupProfile.mark('list loaded')
+        if self.ann is None or self.ann.numImages() == 0: startupProfile.report()
             
     def createMenus(self):
         menuBar = self.menuBar()
@@ -798,6 +965,14 @@ class MainWindow(QMainWindow):
         self.loadAnn2.setStatusTip("Load existing annotation list with object IDs from file")
         self.fileMenu.addAction(self.loadAnn2)
         
+        self.loadShard = QAction("Annotate a shard of a list..", self, triggered=self.loadAnnotationShard)
+        self.loadShard.setStatusTip("Lease a batch of a list shared with other annotators and annotate it")
+        self.fileMenu.addAction(self.loadShard)
+        
+        self.finishShard = QAction("Finish this shard, take the next", self, triggered=self.finishAnnotationShard)
+        self.finishShard.setStatusTip("Mark the leased batch done and lease the next free batch of the list")
+        self.fileMenu.addAction(self.finishShard)
+        
         self.fileMenu.addSeparator()
         
         #self.saveAll = QAction("Save (over-write)", self, triggered=self.onButtonSave)
@@ -816,6 +991,10 @@ class MainWindow(QMainWindow):
         self.saveAnnAs2.setStatusTip("Save a copy of annotation list with object IDs to a specified file")
         self.fileMenu.addAction(self.saveAnnAs2)
         
+        self.saveMasks = QAction("Save all edited masks", self, shortcut="Ctrl+Shift+S", triggered=self.saveAllMasks)
+        self.saveMasks.setStatusTip("Write the edited object masks of all images now, in parallel")
+        self.fileMenu.addAction(self.saveMasks)
+        
         self.fileMenu.addSeparator()
                 
         
@@ -823,21 +1002,79 @@ class MainWindow(QMainWindow):
         self.fileExitAct.setStatusTip("Exit the application!")
         self.fileMenu.addAction(self.fileExitAct)
         
+        ## Queue menu: the images that still need annotating (WorkQueue)
+        self.queueMenu = menuBar.addMenu("&Queue")
+        self.queueNext = QAction("Next pending image", self, shortcut="Ctrl+N", triggered=self.nextPendingImage)
+        self.queueNext.setStatusTip("Go to the next image that still needs annotating")
+        self.queueMenu.addAction(self.queueNext)
+        self.queuePrev = QAction("Previous pending image", self, shortcut="Ctrl+P", triggered=self.prevPendingImage)
+        self.queuePrev.setStatusTip("Go to the previous image that still needs annotating")
+        self.queueMenu.addAction(self.queuePrev)
+        self.queueDone = QAction("Mark image done", self, shortcut="Ctrl+D", triggered=self.markImageDone)
+        self.queueDone.setStatusTip("Nothing to annotate in this image: remove it from the queue and go to the next pending image")
+        self.queueMenu.addAction(self.queueDone)
+        self.queueMenu.addSeparator()
+        self.queueNavigate = QAction("Previous/Next go to pending images", self, checkable=True, triggered=self.setQueueNavigation)
+        self.queueNavigate.setStatusTip("The Previous and Next buttons skip the images that are already annotated")
+        self.queueMenu.addAction(self.queueNavigate)
+        criteriaMenu = self.queueMenu.addMenu("Pending images need")
+        self.queueCriteria = {}
+        for criterion in CRITERIA:
+            action = QAction({'level': 'a difficulty level', 'label': 'an image label', 'objects': 'objects', 'mid': 'object model IDs'}[criterion], self, checkable=True, triggered=self.setQueueCriteria)
+            criteriaMenu.addAction(action)
+            self.queueCriteria[criterion] = action
+        
         self.helpMenu = menuBar.addMenu("&Help")
         self.helpAbout = QAction("&About", self, triggered=self.helpAbout)
         self.helpMenu.addAction(self.helpAbout)   
     
     ### ### ### Event handling    ### ### ###
     
-    # handle previous/next image button events
+    # handle previous/next image button events; in the order of the image table,
+    # or the pending images of the work queue
     def onButtonPrev(self):
-        ind = self.ann.prev()
+        if self.ann is None: return
+        if self.workQueue is not None and self.workQueue.navigate: self.prevPendingImage(); return
+        ind = self.imageListTable.neighbour(self.ann.index, -1)
         if ind != self.ann.index:
             self.imageListTable.select(ind, 0)
     def onButtonNext(self):        
-        ind = self.ann.next()
+        if self.ann is None: return
+        if self.workQueue is not None and self.workQueue.navigate: self.nextPendingImage(); return
+        ind = self.imageListTable.neighbour(self.ann.index, 1)
         if ind != self.ann.index:
             self.imageListTable.select(ind, 0)
+    def nextPendingImage(self):
+        self.toPendingImage(1)
+    def prevPendingImage(self):
+        self.toPendingImage(-1)
+    def toPendingImage(self, step):
+        if self.workQueue is None: return
+        ind = self.workQueue.next(self.ann.index, step)
+        if ind < 0: self.statusMessage('No other image needs annotating'); return
+        self.direction = step
+        self.imageListTable.select(ind, 0)
+    def markImageDone(self):
+        if self.workQueue is None: return
+        self.workQueue.markDone(self.ann.index)
+        self.updateQueueStatus()
+        self.nextPendingImage()
+    def setQueueNavigation(self, navigate):
+        if self.workQueue is None: return
+        self.workQueue.navigate = navigate
+        self.workQueue.save()
+    def setQueueCriteria(self, *args):
+        if self.workQueue is None: return
+        self.workQueue.setCriteria([c for c in CRITERIA if self.queueCriteria[c].isChecked()])
+        self.updateQueueStatus()
+    def onFind(self):
+        if self.ann is not None: self.imageListTable.find(self.findText.text())
+    def onImageFilter(self, *args):
+        if self.ann is None: return
+        item = self.levelFilter.currentIndex()
+        try: mids = [int(mid) for mid in str(self.midFilter.text()).replace(',', ' ').split()] or None
+        except ValueError: self.statusMessage('Model IDs are numbers: ' + str(self.midFilter.text())); return
+        self.imageListTable.showImages(None if item == 0 else [item - 1], mids)
             
     def onButtonAddObject(self):        
         self.addObject()
@@ -847,21 +1084,73 @@ class MainWindow(QMainWindow):
         self.sceneDraw.resetForeground()
     # TODO: ask overwrite
     def onButtonSave(self):
-        if self.ann is not None:
-            print 'Over-writing the current annotation file..'
-            self.ann.saveAnnotationList(ftype=1)            
-        else: print 'Nothing to save!'
+        self.saveAnnotationList(1)
     def onButtonSave2(self):
-        if self.ann is not None:
-            print 'Over-writing the current annotation file..'
-            self.ann.saveAnnotationList(ftype=2)            
-        else: print 'Nothing to save!'
+        self.saveAnnotationList(2)
+    # saved in the background: the dirty masks, and the list (with a journal,
+    # the edits are already on disk and the list is compacted)
+    def saveAnnotationList(self, ftype):
+        if self.ann is None: print 'Nothing to save!'; return
+        print 'Saving the current annotation file..'
+        self.autoSaver.flush(ftype)
+    # the masks of all edited images, without waiting for the autosave delay
+    def saveAllMasks(self):
+        if self.ann is None: return
+        print 'Saving the masks of', self.ann.numDirtyImages(), 'images..'
+        self.autoSaver.flush()
     def closeEvent(self, event):
 #        if self.ann:
 #            ret = QMessageBox.question(self, "Exit application", "Save annotation list with object IDs before exit?", QMessageBox.Yes | QMessageBox.No | QMessageBox.Cancel)
 #            if ret == QMessageBox.Yes: self.onButtonSave2()
 #            elif ret == QMessageBox.Cancel: event.ignore(); print 'Cancel'; return
+        if self.autoSaver is not None:
+            self.closeWorkQueue()
+            self.closeJournal()
+            self.autoSaver.close()
+            self.setLease(None)     # the shard is written
         event.accept()
+    
+    # journal of the edits of the loaded list (replays the edits of the last session)
+    def openJournal(self):
+        self.closeJournal()
+        if USE_JOURNAL and self.ann is not None and self.ann.annfilename and os.path.exists(str(self.ann.annfilename)):
+            self.journal = Journal(self.ann)
+        self.autoSaver.setAnnotation(self.ann, self.journal)
+        self.updateSaveStatus()
+    # the pending saves of the current annotations are queued first
+    # (flush=False: they are dropped, see dropShard)
+    def closeJournal(self, flush=True):
+        if flush: self.autoSaver.flush()
+        if self.journal is not None: self.journal.close()
+        self.journal = None
+    def updateSaveStatus(self):
+        self.saveLabel.setText(self.autoSaver.status())
+    
+    # work queue of the loaded list, kept next to it; after the journal is
+    # replayed
+    def openWorkQueue(self):
+        self.closeWorkQueue()
+        if self.ann is None: return
+        self.workQueue = WorkQueue(self.ann)
+        self.ann.addEditListener(self.onQueueEdit)
+        self.queueNavigate.setChecked(self.workQueue.navigate)
+        for criterion, action in self.queueCriteria.items(): action.setChecked(criterion in self.workQueue.criteria)
+        self.updateQueueStatus()
+    # the current image is where the next session starts (save=False: the
+    # queue file is left as it is)
+    def closeWorkQueue(self, save=True):
+        if self.workQueue is None: return
+        self.ann.removeEditListener(self.onQueueEdit)
+        if save: self.workQueue.close(self.ann.index)
+        else: self.ann.removeEditListener(self.workQueue.onAnnotationEdit)
+        self.workQueue = None
+    def onQueueEdit(self, op, args):
+        self.updateQueueStatus()
+    def updateQueueStatus(self):
+        if self.workQueue is None: self.queueLabel.setText(''); return
+        needs = self.workQueue.needsOf(self.ann.index) if self.ann.numImages() else []
+        current = ' (this image needs %s)' % ', '.join(needs) if needs else ''
+        self.queueLabel.setText('queue: %d pending%s' % (self.workQueue.numPending(), current))
         
     ### FUNCTIONS ###
     # TODO: ask overwrite
@@ -873,7 +1162,9 @@ class MainWindow(QMainWindow):
     
     def saveAnnotationAs2(self):
         if not self.ann: return
-        fileName = QFileDialog.getSaveFileName(self, "Save a copy of annotation list with object IDs as", self.ann.annotationDir + self.ann.getAnnotationListFile(), "All Files (*);;Text Files (*.txt)")
+        # a shard is not saved over the list it is part of
+        default = self.ann.annfilename if self.lease else self.ann.annotationDir + self.ann.getAnnotationListFile()
+        fileName = QFileDialog.getSaveFileName(self, "Save a copy of annotation list with object IDs as", default, "All Files (*);;Text Files (*.txt)")
         if fileName:
             self.ann.saveAnnotationListAs(fileName, ftype=2)
     
@@ -887,11 +1178,7 @@ class MainWindow(QMainWindow):
         fileName = QFileDialog.getOpenFileName(self, "Load annotation list from file", dir, "All Files (*);;Text Files (*.txt)")
         if fileName:
             print fileName
-            self.ann = Annotation(fileName)
-            self.startUp = True
-            self.updateClassNamesView()
-            self.imageListTable.updateTableView(self.ann)
-            self.imageListTable.select(0,0)
+            self.openAnnotationList(fileName, 1)
     
     # load annotations with object IDs
     def loadAnnotation2(self):
@@ -904,11 +1191,83 @@ class MainWindow(QMainWindow):
         fileName = QFileDialog.getOpenFileName(self, "Load annotation list from file", dir, "All Files (*);;Text Files (*.txt)")
         if fileName:
             print fileName
-            self.ann = Annotation(fileName, ftype=2)
-            self.startUp = True
-            self.updateClassNamesView()
-            self.imageListTable.updateTableView(self.ann)
-            self.imageListTable.select(0,0)
+            self.openAnnotationList(fileName, 2)
+    
+    # lease: the leased batch whose shard fileName is
+    def openAnnotationList(self, fileName, ftype=FT_AUTO, lease=None):
+        self.closeWorkQueue()
+        self.closeJournal()
+        # the previous shard is written before its lease is released
+        self.autoSaver.wait()
+        self.setLease(lease)
+        if COLUMNAR_ANNOTATION and ftype == FT_AUTO:
+            self.ann = ColumnarAnnotation(fileName)
+        else: self.ann = Annotation(fileName, ftype=ftype)
+        self.openJournal()
+        self.openWorkQueue()
+        self.startUp = True
+        self.updateClassNamesView()
+        self.imageListTable.updateTableView(self.ann)
+        self.imageListTable.select(self.workQueue.resumeIndex(), 0)
+    
+    # annotate a leased batch of a list shared by several annotators (Sharding)
+    def loadAnnotationShard(self):
+        if self.ann:
+            ret = QMessageBox.question(self, "Load annotation", "Save current annotations before loading?", QMessageBox.Yes | QMessageBox.No | QMessageBox.Cancel)
+            if ret == QMessageBox.Yes: self.onButtonSave()
+            elif ret == QMessageBox.Cancel: return       
+        dir = "/home/bastan/research/sicura/data/"
+        if self.ann: dir = self.ann.annotationDir
+        fileName = QFileDialog.getOpenFileName(self, "Annotate a shard of annotation list", dir, "All Files (*);;Text Files (*.txt)")
+        if fileName:
+            self.openShard(str(fileName))
+    def openShard(self, listFile):
+        try:
+            shards = ShardSet(listFile)
+            lease = shards.acquire()
+        except (IOError, OSError, ValueError), e:
+            QMessageBox.warning(self, "Annotate a shard", "Could not shard %s:\n%s" % (listFile, e))
+            return
+        if lease is None:
+            QMessageBox.information(self, "Annotate a shard", "All the batches of %s are done or leased by other annotators." % listFile)
+            return
+        self.openAnnotationList(lease.shardFile, FT_AUTO, lease)
+        start, end = shards.batchRange(lease.batch)
+        self.statusMessage('Batch %d of %d (images %d-%d) of %s' % (lease.batch + 1, shards.numBatches(), start + 1, end, listFile))
+    # the shard is written before the batch is marked done
+    def finishAnnotationShard(self):
+        if self.lease is None: self.statusMessage('No shard is open'); return
+        lease = self.lease
+        self.closeWorkQueue()
+        self.closeJournal()
+        self.autoSaver.wait()
+        lease.release(done=True)
+        self.openShard(lease.shards.listFile)
+        if self.lease is lease:
+            # no batch left: the shard stays open, without a lease
+            self.setLease(None)
+            self.openJournal()
+            self.openWorkQueue()
+    # the leased batch (None: none), the previous lease is released
+    def setLease(self, lease):
+        if self.lease is not None and self.lease is not lease: self.lease.release()
+        self.lease = lease
+        if lease is not None: self.leaseTimer.start()
+        else: self.leaseTimer.stop()
+    def renewLease(self):
+        if self.lease is None or self.lease.renew(): return
+        lease = self.lease
+        # before the message box, whose event loop runs the autosave
+        self.setLease(None)
+        self.dropShard()
+        QMessageBox.warning(self, "Annotate a shard", "The lease of batch %d expired and another annotator took it over; a free batch is opened." % (lease.batch + 1))
+        self.openShard(lease.shards.listFile)
+    # the shard belongs to another annotator now: nothing more is written to
+    # it, the unsaved edits and masks are dropped
+    def dropShard(self):
+        self.closeWorkQueue(False)
+        self.autoSaver.discard()
+        self.closeJournal(False)
     
     def changeAnnotationDir(self):
         if not self.ann: print 'No annotation yet!'; return
@@ -930,8 +1289,13 @@ class MainWindow(QMainWindow):
         if fd.exec_() == QDialog.Rejected: return        
         fileExt = fd.selectedNameFilter()
         # load the image file names from the selected directory
+        self.closeWorkQueue()
+        self.closeJournal()
+        self.setLease(None)
         self.ann = Annotation()
         self.ann.loadDir(fd.directory().absolutePath(), fd.directory().dirName(), fd.selectedNameFilter())
+        self.openJournal()
+        self.openWorkQueue()
         self.startUp = True
         self.updateClassNames()
         self.imageListTable.updateTableView(self.ann)
@@ -942,41 +1306,74 @@ class MainWindow(QMainWindow):
             #if not self.startUp:
             #    self.ann.saveCurrentObjectMasks()
             #    self.ann.deleteObjectMasks()
+            if index > self.ann.index: self.direction = 1
+            elif index < self.ann.index: self.direction = -1
             index = self.ann.goto(index)
             self.ann.loadObjectImages(index, self.brushColor, False)
             self.imageListTable.updateTableRow(self.ann, self.ann.index)
             self.sceneList.clear()
             self.showCurrentImage()
+            self.prefetchImages()
+            self.collectMemory()
+            self.updateQueueStatus()
             self.startUp = False
             print 'Image', index+1
+    
+    # decode the next images in the navigation direction in the background; the
+    # next pending images when navigating the work queue
+    def prefetchImages(self):
+        if self.workQueue is not None and self.workQueue.navigate:
+            indices = self.workQueue.upcoming(self.ann.index, PREFETCH_COUNT, self.direction)
+        else:
+            indices = [self.ann.index + k*self.direction for k in range(1, PREFETCH_COUNT+1)]
+            indices = [i for i in indices if 0 <= i < self.ann.numImages()]
+        self.imageCache.prefetch([self.ann.imagePath(i) for i in indices])
+    
+    # drop least recently used masks/regions if over the memory budget
+    def collectMemory(self):
+        # objects of the current image are the most recently used
+        if self.ann.curImage():
+            for obj in self.ann.curImage().objects: obj.region
+        # tiles of the background are created as they are drawn
+        if self.sceneDraw.backgroundImage:
+            memoryManager.track(self.sceneDraw.backgroundImage, 'background', self.sceneDraw.backgroundImage)
+        memoryManager.track(self.imageCache, 'imagecache', self.imageCache.nbytes)
+        n = memoryManager.collect()
+        if n > 0: print 'Memory budget exceeded, dropped', n, 'masks/regions'
+        self.cacheLabel.setText(self.imageCache.stats() + ' | ' + memoryManager.stats())
             
     # load the current image from disk and display it
     def showCurrentImage(self):
         if self.ann is not None and self.ann.numImages() > 0:            
             imageFile = self.ann.curImagePath()
-            if os.path.exists(imageFile):
-                piximage = QPixmap(imageFile)
-                self.showImage(piximage)                
+            image = self.imageCache.get(imageFile)
+            if image is not None:
+                self.showImage(self.pyramids.get(imageFile, image))
     
-    def showImage(self, piximage):        
-        self.sceneList.setImage(piximage)
+    # image: TilePyramid, drawn by both scenes
+    def showImage(self, image):        
+        self.sceneList.setImage(image)
         self.sceneList.addObjects(self.ann.image(self.ann.index))
         self.viewList.fitImageView()
         self.sceneList.update()
-        self.sceneDraw.setImage(piximage)
+        self.sceneDraw.setImage(image)
         self.viewDraw.fitImageView()
         self.sceneDraw.update()        
+        if not startupProfile.reported:
+            startupProfile.mark('first image')
+            startupProfile.report()
     
     # add the selected object to the scene and to the list of annotations
     def addObject(self):
-        mask = self.sceneDraw.getObjectMask()       
-        x1,y1,w,h = getMBR_numpy(mask)
+        x1,y1,w,h = self.sceneDraw.getObjectMBR()
         if x1 < 0: return
         objImg = self.sceneDraw.foregroundImage.copy(x1, y1, w, h)
         self.sceneList.addObjectImage(objImg, x1, y1)
         self.sceneDraw.resetForeground()
-        self.ann.addObject(mask, objImg, x1, y1, self.sceneList.objID)        
+        # the object keeps the mask cropped to its MBR
+        self.ann.addObject(objImg.alphaChannel(), objImg, x1, y1, self.sceneList.objID, (self.sceneDraw.w, self.sceneDraw.h))        
         self.imageListTable.updateTableRow(self.ann, self.ann.index)        
+        self.collectMemory()
     
     def updateClassNames(self):
         className = self.classText.text()
@@ -1022,8 +1419,15 @@ class MainWindow(QMainWindow):
                 "Author: Muhammet Bastan<br>IUPR @TU-KL<br>mubastan@iupr.com<br>July-December 2011")
     
 if __name__ == "__main__":    
+    args = sys.argv[1:]
+    if '--profile-startup' in args:
+        startupProfile.enabled = True
+        args.remove('--profile-startup')
+    shard = '--shard' in args
+    if shard: args.remove('--shard')
     app = QApplication(sys.argv)
-    mainWindow = MainWindow()    
+    startupProfile.mark('QApplication')
+    mainWindow = MainWindow(args[0] if args else None, shard)
     #mainWindow.show()
     mainWindow.showMaximized()
     sys.exit(app.exec_())
\ No newline at end of file
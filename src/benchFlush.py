@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+# mask flush benchmark: the masks of a number of images, all dirty, written
+# with saveMasksParallel on 1, 2, 4, ... threads up to the number of cores,
+# each run into an empty annotation directory
+#
+# usage: python benchFlush.py [number of images] [objects per image] [mask size]
+
+import sys
+import shutil
+import tempfile
+import numpy
+from PyQt4.QtCore import *
+from Annotation23 import *
+from MaskStore import saveMasksParallel
+
+def makeImages(numImages, perImage, size):
+    rng = numpy.random.RandomState(0)
+    images = []
+    for i in range(numImages):
+        ximg = XImage('image%06d.jpg' % i)
+        for j in range(perImage):
+            # a filled ellipse with a noisy edge, as painted masks are
+            yy, xx = numpy.mgrid[:size, :size]
+            r = ((xx - size/2.0)**2 + (yy - size/2.0)**2) / (size/2.0)**2
+            arr = numpy.where(r + rng.uniform(-0.05, 0.05, r.shape) < 1, 255, 0).astype(numpy.uint8)
+            ximg.addObject(None, None, 10*j, 10*j, j)
+            obj = ximg.objects[-1]
+            obj.w, obj.h = size, size
+            obj.frameSize = (size + 10*perImage, size + 10*perImage)
+            obj.cmask = numpyToMask(arr)
+            obj.saveMask = True
+        images.append(ximg)
+    return images
+
+if __name__ == '__main__':
+    app = QCoreApplication(sys.argv)
+    numImages = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    perImage = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    size = int(sys.argv[3]) if len(sys.argv) > 3 else 400
+    images = makeImages(numImages, perImage, size)
+    print '%d images, %d masks of %dx%d' % (numImages, numImages * perImage, size, size)
+    threads, cores = 1, QThread.idealThreadCount()
+    while True:
+        for ximg in images:
+            for obj in ximg.objects: obj.saveMask, obj.maskSource = True, None
+        annotationDir = tempfile.mkdtemp() + '/'
+        try:
+            flush = saveMasksParallel(annotationDir, images, threads)
+        finally:
+            shutil.rmtree(annotationDir)
+        print '%2d threads %8.1f masks/s' % (threads, flush.rate())
+        if threads >= cores: break
+        threads = min(2 * threads, cores)
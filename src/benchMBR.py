@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+# micro-benchmark: object MBR computation from a painted mask
+# old path: save the mask to a png file and read it back with scipy
+# new path: numpy view over the QImage buffer (getMBR_numpy)
+#
+# usage: python benchMBR.py [width height repeats]
+
+import sys
+import os
+import time
+import tempfile
+import numpy
+from PyQt4.QtCore import *
+from PyQt4.QtGui import *
+from MaskImage import getMBR_numpy
+
+# the previous implementation, through a temporary png file
+def getMBR_file(qimage, fname):
+    x1, y1, x2, y2 = -1, -1, -1, -1
+    if qimage:
+        import scipy.misc
+        qimage.save(fname)
+        nimg = scipy.misc.imread(fname)
+        r,c = numpy.where(nimg > 0)
+        if len(r) > 0:
+            x1, y1, x2, y2 = c.min(), r.min(), c.max(), r.max()
+    return x1, y1, x2-x1+1, y2-y1+1
+
+# a foreground image with one painted object, as in ImageDrawScene
+def makeMask(w, h):
+    fg = QImage(w, h, QImage.Format_ARGB32)
+    fg.fill(QColor(0, 0, 0, 0).rgba())
+    painter = QPainter(fg)
+    painter.setPen(Qt.NoPen)
+    painter.setBrush(QBrush(QColor(255, 0, 0, 255)))
+    painter.drawEllipse(QPointF(w*0.6, h*0.4), w*0.05, h*0.08)
+    painter.end()
+    return fg.alphaChannel()
+
+def timeit(func, repeats):
+    best = None
+    for i in range(repeats):
+        t = time.time()
+        result = func()
+        t = time.time() - t
+        if best is None or t < best: best = t
+    return best, result
+
+if __name__ == "__main__":
+    w, h, repeats = 4096, 4096, 5
+    if len(sys.argv) > 3: w, h, repeats = int(sys.argv[1]), int(sys.argv[2]), int(sys.argv[3])
+    app = QApplication(sys.argv)
+    mask = makeMask(w, h)
+    tmpDir = tempfile.mkdtemp()
+    tmpFile = os.path.join(tmpDir, 'tmp.png')
+    try:
+        tfile, rfile = timeit(lambda: getMBR_file(mask, tmpFile), repeats)
+    finally:
+        if os.path.exists(tmpFile): os.remove(tmpFile)
+        os.rmdir(tmpDir)
+    tnp, rnp = timeit(lambda: getMBR_numpy(mask), repeats)
+    print 'Image size: %d x %d, best of %d runs' % (w, h, repeats)
+    print 'png round trip : %8.2f ms  MBR: %s' % (1000*tfile, str(rfile))
+    print 'numpy view     : %8.2f ms  MBR: %s' % (1000*tnp, str(rnp))
+    print 'speed-up       : %8.1fx' % (tfile / max(tnp, 1e-9))
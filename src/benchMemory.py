@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+# memory benchmark: an annotation list loaded into
+# old:      XObject/XImage as before, an instance __dict__ with all the mask
+#           attributes per object
+# slots:    the current XObject/XImage (__slots__, mask state allocated on demand)
+# columnar: ColumnarAnnotation (numpy tables, no instances until accessed)
+# each variant is measured in its own process, as the growth of the resident size
+#
+# usage: python benchMemory.py [number of objects] [objects per image]
+
+import sys
+import os
+import gc
+import subprocess
+import tempfile
+from benchParse import makeList
+
+# the classes before __slots__, with the same attributes
+class OldXObject(object):
+    def __init__(self, x1=0, y1=0, id=0, w=0, h=0, view=0, label=1, mid=0):
+        self.view, self.label = view, label
+        self.x1, self.y1, self.w, self.h = x1, y1, w, h
+        self.id, self.mid = id, mid
+        self.cmaskImage, self.maskRLE, self.regionImage = None, None, None
+        self.frameSize = None
+        self.maskSource = None
+        self.maskFile = None
+        self.brushColor = None
+        self.saveMask = False
+
+class OldXImage:
+    def __init__(self, fname=None, label=0, set=0, level=0):
+        self.label, self.set, self.level = label, set, level
+        self.fname = fname
+        self.objects = []
+
+def buildOldImages(parsed):
+    objects = parsed.objects.tolist()
+    images = []
+    k = 0
+    for i, (set, level, label, count) in enumerate(parsed.images.tolist()):
+        ximg = OldXImage(parsed.names[i], label, set, level)
+        for j in range(count):
+            mid, view, olabel, x1, y1, w, h = objects[k+j]
+            ximg.objects.append(OldXObject(x1, y1, j, w, h, view, olabel, mid))
+        k += count
+        images.append(ximg)
+    return images
+
+# resident size in bytes
+def residentSize():
+    try:
+        ifs = open('/proc/self/statm')
+        pages = int(ifs.read().split()[1])
+        ifs.close()
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def measure(fname, variant):
+    from ListParser import parseListFile
+    from AnnotationCore import buildImages
+    from ColumnarAnnotation import ImageColumns
+    gc.collect()
+    rss0 = residentSize()
+    parsed = parseListFile(fname)
+    numObjects = parsed.numObjects()
+    if variant == 'old': images = buildOldImages(parsed)
+    elif variant == 'slots': images = buildImages(parsed)
+    else: images = ImageColumns(parsed)
+    del parsed
+    gc.collect()
+    nbytes = residentSize() - rss0
+    print '%-10s %8.1f MB %8.1f bytes/object' % (variant, nbytes / 1048576.0, nbytes / float(numObjects))
+    return images
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == '--measure':
+        measure(sys.argv[2], sys.argv[3])
+        sys.exit(0)
+    numObjects = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    perImage = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    fd, fname = tempfile.mkstemp(suffix='.txt')
+    os.close(fd)
+    try:
+        numLines = makeList(fname, numObjects, perImage, 2)
+        print '%d objects, %d images' % (numObjects, numLines)
+        for variant in ('old', 'slots', 'columnar'):
+            subprocess.call([sys.executable, os.path.abspath(__file__), '--measure', fname, variant])
+    finally:
+        os.remove(fname)
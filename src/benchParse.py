@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+# benchmark: loading a large annotation list
+# line parser: Annotation.loadAnnotation, tokens converted one by one
+# bulk parser: ListParser.parseListFile (arrays only) and
+#              Annotation.loadAnnotationBulk (arrays + XImage/XObject)
+#
+# usage: python benchParse.py [number of objects] [objects per image] [ftype]
+
+import sys
+import os
+import time
+import random
+import tempfile
+from ListParser import parseListFile, detectListFormat
+from AnnotationCore import Annotation
+
+# a synthetic list file in the format written by Annotation.saveAnnotationListAs
+def makeList(fname, numObjects, perImage, ftype):
+    rnd = random.Random(0)
+    numImages = (numObjects + perImage - 1) // perImage
+    ofs = open(fname, 'w')
+    ofs.write('car sedan\n./ images\n./annotation/\n%d\n' % numImages)
+    left = numObjects
+    for i in range(numImages):
+        n = min(perImage, left)
+        left -= n
+        fields = ['1', str(rnd.randint(0, 5)), '1', str(n), 'img%07d.jpg' % i]
+        for j in range(n):
+            fields += [str(rnd.randint(0, 3)), '1']
+            if ftype == 2: fields.append(str(rnd.randint(0, 99)))
+            fields += [str(rnd.randint(0, 1000)), str(rnd.randint(0, 1000)), str(rnd.randint(1, 500)), str(rnd.randint(1, 500))]
+        ofs.write(' '.join(fields) + '\n')
+    ofs.close()
+    return numImages
+
+def timeit(label, numLines, f):
+    t = time.time()
+    result = f()
+    dt = time.time() - t
+    print '%-40s %8.2f s %12.0f lines/s' % (label, dt, numLines / dt)
+    return result
+
+if __name__ == '__main__':
+    numObjects = int(sys.argv[1]) if len(sys.argv) > 1 else 5000000
+    perImage = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    ftype = int(sys.argv[3]) if len(sys.argv) > 3 else 2
+    fd, fname = tempfile.mkstemp(suffix='.txt')
+    os.close(fd)
+    try:
+        numLines = makeList(fname, numObjects, perImage, ftype)
+        print '%d objects, %d lines, %d MB, ftype %d' % (numObjects, numLines, os.path.getsize(fname) >> 20, ftype)
+        timeit('detectListFormat', numLines, lambda: detectListFormat(fname))
+        parsed = timeit('parseListFile (arrays)', numLines, lambda: parseListFile(fname))
+        del parsed
+        bulk = Annotation()
+        timeit('loadAnnotationBulk (objects)', numLines, lambda: bulk.loadAnnotationBulk(fname))
+        ann = Annotation()
+        timeit('loadAnnotation (line parser)', numLines, lambda: ann.loadAnnotation(fname, ftype))
+        # both loaders must agree
+        for a, b in zip(ann.images, bulk.images):
+            assert a.toString2() == b.toString2(), (a.toString2(), b.toString2())
+    finally:
+        os.remove(fname)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+# journal replay tests: the edits of a session, journaled and compacted into
+# the list, give the same annotations when the list is opened again
+#
+# usage: python testJournal.py
+
+import os
+import shutil
+import tempfile
+import unittest
+from AnnotationCore import *
+from Journal import Journal, loadJournaledList
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.listFile = os.path.join(self.dir, 'list.txt')
+        f = open(self.listFile, 'w')
+        f.write('car sedan\n%s/color/ cars\n%s/annotation/ sedan\n1\n' % (self.dir, self.dir))
+        f.write('0 1 2 3 img.png 1 2 10 0 0 5 5 1 2 20 5 5 5 5 1 2 30 10 10 5 5\n')
+        f.close()
+        self.ann = Annotation(self.listFile, FT_AUTO)
+        self.journal = Journal(self.ann)
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.dir)
+
+    def mids(self, ann):
+        return [obj.mid for obj in ann.image(0).objects]
+
+    def compact(self):
+        self.journal.compact()
+        self.journal.thread.join()
+
+    def testReplay(self):
+        self.ann.setObjectMID(1, 99)
+        self.ann.setObjectViewLabel(2, V2)
+        self.assertEqual(self.mids(loadJournaledList(self.listFile)), [10, 99, 30])
+        self.assertEqual(loadJournaledList(self.listFile).image(0).objects[2].view, V2)
+
+    # ids are renumbered by position when the list is reloaded, the edits after
+    # a compaction apply to the objects the annotator edited
+    def testReplayAfterCompaction(self):
+        self.ann.deleteObjects([0])
+        self.compact()
+        self.ann.setObjectMID(1, 99)
+        self.assertEqual(self.mids(self.ann), [99, 30])
+        self.assertEqual(self.mids(loadJournaledList(self.listFile)), [99, 30])
+        self.ann.deleteObjects([2])
+        self.assertEqual(self.mids(loadJournaledList(self.listFile)), [99])
+        self.compact()
+        self.assertEqual(self.mids(Annotation(self.listFile, FT_AUTO)), [99])
+
+# the images of a flat list keep their folders and names when it is compacted
+class FlatJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.listFile = os.path.join(self.dir, 'list.txt')
+        f = open(self.listFile, 'w')
+        f.write('cars a 0 1 2 1 10 1 2 0 0 5 5\n')
+        f.write('bags b.v2 0 1 2 0\n')
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testCompactFlat(self):
+        ann = Annotation(self.listFile, FT_AUTO)
+        journal = Journal(ann)
+        ann.setObjectMID(0, 99)
+        journal.compact()
+        journal.thread.join()
+        journal.close()
+        f = open(self.listFile)
+        lines = f.read().split('\n')
+        f.close()
+        self.assertEqual(lines[:2], ['cars a 0 1 2 1 99 1 2 0 0 5 5', 'bags b.v2 0 1 2 0'])
+
+if __name__ == '__main__':
+    unittest.main()